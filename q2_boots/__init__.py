@@ -7,9 +7,13 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
-from ._resample import resample
-from ._alpha import alpha, alpha_collection, alpha_average
-from ._beta import beta, beta_collection, beta_average
+from ._resample import resample, resample_stacked
+from ._alpha import (alpha, alpha_collection, alpha_collection_stacked,
+                     alpha_average, alpha_average_stacked,
+                     alpha_partial_aggregate, alpha_merge_aggregates)
+from ._beta import (beta, beta_collection, beta_collection_stacked,
+                    beta_average, beta_average_stacked, beta_variance,
+                    beta_partial_aggregate, beta_merge_aggregates)
 from ._core_metrics import core_metrics
 from ._kmer_diversity import kmer_diversity
 
@@ -19,11 +23,21 @@ except ModuleNotFoundError:
     __version__ = '0.0.0+notfound'
 
 __all__ = ['resample',
+           'resample_stacked',
            'alpha_average',
+           'alpha_average_stacked',
+           'alpha_partial_aggregate',
+           'alpha_merge_aggregates',
            'alpha_collection',
+           'alpha_collection_stacked',
            'alpha',
-           'beta_average'
+           'beta_average',
+           'beta_average_stacked',
+           'beta_variance',
+           'beta_partial_aggregate',
+           'beta_merge_aggregates',
            'beta_collection',
+           'beta_collection_stacked',
            'beta',
            'core_metrics',
            'kmer_diversity']
@@ -0,0 +1,295 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, Caporaso Lab (https://cap-lab.bio).
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import numpy as np
+
+
+class RunningMoments:
+    """Element-wise running mean and variance of equally-shaped arrays.
+
+    Arrays are consumed one at a time with `update` using Welford's
+    algorithm, so memory use is independent of the number of arrays.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if self.count == 0:
+            self.mean = np.zeros_like(values)
+            self.m2 = np.zeros_like(values)
+        self.count += 1
+        delta = values - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (values - self.mean)
+
+    @property
+    def variance(self):
+        # sample variance; a single observation has no spread, so its
+        # variance is reported as zero
+        if self.count < 2:
+            return np.zeros_like(self.m2)
+        return self.m2 / (self.count - 1)
+
+    def merge(self, other):
+        """Combine with the moments of another, disjoint set of arrays."""
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count = other.count
+            self.mean = other.mean.copy()
+            self.m2 = other.m2.copy()
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * (other.count / count)
+        self.m2 += other.m2 + delta ** 2 * (self.count * other.count / count)
+        self.count = count
+
+
+class QuantileSketch:
+    """Mergeable, element-wise quantile sketch of equally-shaped arrays.
+
+    This is a simplified KLL sketch. Arrays are stored as rows of a
+    compactor at level 0, where each row has weight 1. Because every array
+    contributes one value to each element, all elements share the same row
+    weights.
+
+    When a level holds more rows than it may, its values are sorted
+    independently for each element, and every other row is promoted to the
+    next level, where rows have twice the weight. As in KLL, the top level
+    holds up to `capacity` rows and each level below it 2/3 as many (but at
+    least 8), so the sketch holds at most about 3 * `capacity` rows plus 8
+    per level, and the number of levels only grows with the logarithm of
+    the number of arrays added.
+
+    Until `capacity` arrays have been added the sketch holds every array and
+    quantiles are exact. After that, the rank error of a quantile is on the
+    order of 1 / `capacity` of the number of arrays.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.levels = []
+        self._num_compactions = 0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        self._add_rows(0, values[np.newaxis])
+        self._compress()
+
+    def merge(self, other):
+        for level, rows in enumerate(other.levels):
+            self._add_rows(level, rows)
+        self._num_compactions += other._num_compactions
+        self._compress()
+
+    def median(self):
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(rows), 2 ** level)
+                                  for level, rows in enumerate(self.levels)])
+        order = np.argsort(values, axis=0, kind='stable')
+        values = np.take_along_axis(values, order, axis=0)
+        cumulative_weights = np.cumsum(weights[order], axis=0)
+        half = weights.sum() / 2
+        # with unit weights this averages the two middle values when there
+        # is an even number of them, as np.median does
+        lower = np.argmax(cumulative_weights >= half, axis=0)
+        upper = np.argmax(cumulative_weights > half, axis=0)
+        columns = np.arange(values.shape[1])
+        return (values[lower, columns] + values[upper, columns]) / 2
+
+    def _add_rows(self, level, rows):
+        while len(self.levels) <= level:
+            self.levels.append(np.empty((0,) + rows.shape[1:]))
+        self.levels[level] = np.concatenate([self.levels[level], rows])
+
+    def _level_capacity(self, level):
+        depth = len(self.levels) - 1 - level
+        return min(self.capacity,
+                   max(8, int(self.capacity * (2 / 3) ** depth)))
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            rows = self.levels[level]
+            if len(rows) > self._level_capacity(level):
+                rows = np.sort(rows, axis=0)
+                # alternate which half is promoted, and whether the smallest
+                # or largest values stay behind when there is an odd number
+                # of rows, so that compactions are not all biased in the
+                # same direction
+                if len(rows) % 2 and self._num_compactions % 2:
+                    kept, rows = rows[-1:], rows[:-1]
+                else:
+                    kept, rows = rows[:len(rows) % 2], rows[len(rows) % 2:]
+                offset = self._num_compactions // 2 % 2
+                self._num_compactions += 1
+                self.levels[level] = kept
+                num_levels = len(self.levels)
+                self._add_rows(level + 1, rows[offset::2])
+                if len(self.levels) > num_levels:
+                    # a new top level shrinks the capacity of every level
+                    # below it
+                    level = 0
+                    continue
+            level += 1
+
+
+class PartialAggregate:
+    """Mergeable summary of a collection of alpha or beta diversity results.
+
+    Each result is reduced to a vector of values, one per sample (alpha
+    diversity) or per pair of samples (the condensed form of a distance
+    matrix). The running mean and variance, and a quantile sketch for the
+    median, are kept for each element, so partial aggregates computed on
+    separate subsets of iterations can be merged.
+    """
+
+    def __init__(self, ids, name=None, sketch_capacity=128):
+        self.ids = tuple(ids)
+        self.name = name
+        self.moments = RunningMoments()
+        self.sketch = QuantileSketch(sketch_capacity)
+
+    @property
+    def count(self):
+        return self.moments.count
+
+    def update(self, values):
+        self.moments.update(values)
+        self.sketch.update(values)
+
+    def merge(self, other):
+        if other.ids != self.ids:
+            raise ValueError('Partial aggregates can only be merged if they '
+                             'were computed on the same IDs.')
+        self.moments.merge(other.moments)
+        self.sketch.merge(other.sketch)
+
+    def average(self, average_method):
+        if average_method == 'mean':
+            return self.moments.mean
+        elif average_method == 'median':
+            return self.sketch.median()
+        else:
+            raise ValueError(f"Unknown average method {average_method}. "
+                             "Available options are median and mean.")
+
+    def save(self, fh):
+        levels = self.sketch.levels
+        np.savez(fh,
+                 ids=np.asarray(self.ids, dtype=str),
+                 name=np.asarray('' if self.name is None else self.name),
+                 count=self.moments.count,
+                 mean=self.moments.mean,
+                 m2=self.moments.m2,
+                 sketch_capacity=self.sketch.capacity,
+                 sketch_num_compactions=self.sketch._num_compactions,
+                 sketch_values=np.concatenate(levels),
+                 sketch_levels=np.concatenate(
+                     [np.full(len(rows), level)
+                      for level, rows in enumerate(levels)]))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            name = str(data['name']) or None
+            result = cls(data['ids'].tolist(), name,
+                         int(data['sketch_capacity']))
+            result.moments.count = int(data['count'])
+            result.moments.mean = data['mean']
+            result.moments.m2 = data['m2']
+            result.sketch._num_compactions = \
+                int(data['sketch_num_compactions'])
+            sketch_levels = data['sketch_levels']
+            for level in range(sketch_levels.max() + 1):
+                result.sketch._add_rows(
+                    level, data['sketch_values'][sketch_levels == level])
+        return result
+
+
+def merge_partial_aggregates(aggregates):
+    """Merge partial aggregates into a new one, leaving the inputs as is."""
+    aggregates = list(aggregates)
+    first = aggregates[0]
+    result = PartialAggregate(first.ids, first.name,
+                              first.sketch.capacity)
+    for aggregate in aggregates:
+        result.merge(aggregate)
+    return result
+
+
+class ConvergenceMonitor:
+    """Tracks whether running averages have stopped changing.
+
+    Results are added with `update` under a key (e.g., a metric), and the
+    running average of each key is computed with the average method given
+    for it in `average_methods` ('mean' or 'median'). Each call to
+    `converged` compares every running average with its value at the
+    previous call, and reports convergence if no element of any of them
+    changed by more than `tolerance`.
+
+    Running means are tracked for all elements with RunningMoments. An exact
+    running median needs every result, so medians are only tracked for a
+    fixed random subset of at most `max_median_elements` elements of each
+    key. This keeps the monitor small for results with many elements (e.g.,
+    distance matrices), whose averages are computed from all results once
+    iterations stop.
+    """
+
+    def __init__(self, tolerance, average_methods, max_median_elements=256):
+        self.tolerance = tolerance
+        self.average_methods = average_methods
+        self.max_median_elements = max_median_elements
+        self.moments = {}
+        self.median_elements = {}
+        self.median_values = {}
+        self._previous_averages = None
+
+    def update(self, key, values):
+        values = np.asarray(values, dtype=np.float64)
+        if self.average_methods[key] != 'median':
+            self.moments.setdefault(key, RunningMoments()).update(values)
+            return
+        if key not in self.median_elements:
+            elements = np.arange(len(values))
+            if len(elements) > self.max_median_elements:
+                # the subset is fixed, so convergence checks are repeatable
+                rng = np.random.default_rng(0)
+                elements = np.sort(rng.choice(
+                    elements, self.max_median_elements, replace=False))
+            self.median_elements[key] = elements
+            self.median_values[key] = []
+        self.median_values[key].append(values[self.median_elements[key]])
+
+    def converged(self):
+        # the running mean is updated in place, so it is copied
+        averages = {key: moments.mean.copy()
+                    for key, moments in self.moments.items()}
+        averages.update({key: np.median(values, axis=0)
+                         for key, values in self.median_values.items()})
+        previous_averages, self._previous_averages = \
+            self._previous_averages, averages
+        if previous_averages is None or \
+                previous_averages.keys() != averages.keys():
+            return False
+        for key, average in averages.items():
+            previous_average = previous_averages[key]
+            # undefined values (e.g., alpha diversity of a sample with a
+            # single feature for some metrics) that stay undefined are
+            # unchanged
+            unchanged = ((np.abs(average - previous_average) <=
+                          self.tolerance) |
+                         (np.isnan(average) & np.isnan(previous_average)))
+            if not unchanged.all():
+                return False
+        return True
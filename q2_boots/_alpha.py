@@ -8,56 +8,152 @@
 
 import functools
 
+import numpy as np
 import pandas as pd
+import skbio
 
 from q2_diversity_lib.alpha import METRICS
 
+from q2_boots._aggregate import (PartialAggregate, ConvergenceMonitor,
+                                 merge_partial_aggregates)
+from q2_boots._collection import StackedAlphaDiversities
+from q2_boots._metrics import (NATIVE_ALPHA_METRICS, alpha_diversities,
+                               PhylogenyIndex)
+from q2_boots._resample import (_resampled_table_artifacts,
+                                _table_stacks, _existing_results)
+
+
+def alpha_average(data: pd.Series, average_method: str,
+                  partial_aggregate: PartialAggregate = None) -> pd.Series:
+    _validate_average_method(average_method)
+    if partial_aggregate is not None:
+        # only the new vectors are aggregated, and then merged with the
+        # summary of the earlier ones
+        aggregate = merge_partial_aggregates(
+            [partial_aggregate,
+             alpha_partial_aggregate(data, partial_aggregate.sketch.capacity)])
+        return pd.Series(aggregate.average(average_method),
+                         index=list(aggregate.ids), name=aggregate.name)
 
-def alpha_average(data: pd.Series, average_method: str) -> pd.Series:
     if average_method == "median":
         average = pd.DataFrame.median
-    elif average_method == "mean":
-        average = pd.DataFrame.mean
     else:
-        raise KeyError(f"Invalid average method: '{average_method}'. "
-                       "Valid choices are 'median' and 'mean'.")
+        average = pd.DataFrame.mean
     data = pd.DataFrame(data.values())
     result = average(data, axis=0)
     result.name = data.index[0]
     return result
 
 
+def alpha_average_stacked(data: StackedAlphaDiversities,
+                          average_method: str, n: int = None) -> pd.Series:
+    if n is not None:
+        data = data.head(n)
+    return data.average(average_method)
+
+
+def alpha_partial_aggregate(data: pd.Series,
+                            sketch_capacity: int = 128) -> PartialAggregate:
+    aggregate = None
+    for vector in data.values():
+        if aggregate is None:
+            aggregate = PartialAggregate(vector.index, vector.name,
+                                         sketch_capacity)
+        aggregate.update(vector.reindex(aggregate.ids))
+    return aggregate
+
+
+def alpha_merge_aggregates(aggregates: PartialAggregate,
+                           average_method: str) -> pd.Series:
+    _validate_average_method(average_method)
+    aggregate = merge_partial_aggregates(aggregates.values())
+    return pd.Series(aggregate.average(average_method),
+                     index=list(aggregate.ids), name=aggregate.name)
+
+
 def alpha_collection(ctx, table, sampling_depth, metric, n,
-                     replacement, phylogeny=None):
+                     replacement, phylogeny=None, random_seed=None,
+                     existing_alpha_diversities=None, precision='float64'):
     _validate_alpha_metric(metric, phylogeny)
+    existing = list(_existing_results(existing_alpha_diversities,
+                                      n).values())
 
-    resample_action = ctx.get_action("boots", "resample")
-    alpha_metric_action = _get_alpha_metric_action(ctx, metric, phylogeny)
+    if metric in NATIVE_ALPHA_METRICS:
+        return existing + _native_alpha_collection(
+            ctx, table, sampling_depth, metric, n, replacement, phylogeny,
+            random_seed, start=len(existing), dtype=precision)
 
-    tables, = resample_action(table=table,
-                              sampling_depth=sampling_depth,
-                              n=n,
-                              replacement=replacement)
+    alpha_metric_action = _get_alpha_metric_action(ctx, metric, phylogeny)
 
+    tables = _resampled_table_artifacts(ctx, table, sampling_depth, n,
+                                        replacement, random_seed,
+                                        start=len(existing))
     results = _alpha_collection_from_tables(tables, alpha_metric_action)
-    return results
+    return existing + results
+
+
+def alpha_collection_stacked(ctx, table, sampling_depth, metric, n,
+                             replacement, phylogeny=None, random_seed=None,
+                             precision='float64'):
+    _validate_alpha_metric(metric, phylogeny)
+    vectors = _alpha_series(ctx, table, sampling_depth, metric, n,
+                            replacement, phylogeny, random_seed, precision)
+    return ctx.make_artifact(
+        'SampleData[AlphaDiversityStack]',
+        StackedAlphaDiversities.from_vectors(vectors, precision))
 
 
 def alpha(ctx, table, sampling_depth, metric, n, replacement, phylogeny=None,
-          average_method='median'):
-    alpha_collection_action = ctx.get_action("boots", "alpha_collection")
-    alpha_average_action = ctx.get_action('boots', 'alpha_average')
+          average_method='median', random_seed=None,
+          convergence_tolerance=None, convergence_batch_size=10,
+          precision='float64'):
+    alpha_collection_action = ctx.get_action("boots",
+                                             "alpha_collection_stacked")
+    alpha_average_action = ctx.get_action('boots', 'alpha_average_stacked')
+    if convergence_tolerance is not None:
+        # iterations are run until the average converges, or n iterations
+        # have been run
+        _validate_alpha_metric(metric, phylogeny)
+        monitor = ConvergenceMonitor(convergence_tolerance,
+                                     {metric: average_method})
+        vectors = []
+        for i, vector in enumerate(
+                _alpha_series(ctx, table, sampling_depth, metric, n,
+                              replacement, phylogeny, random_seed,
+                              precision),
+                start=1):
+            vectors.append(vector)
+            monitor.update(metric, vector.to_numpy())
+            if i % convergence_batch_size == 0 and monitor.converged():
+                break
+        sample_data = ctx.make_artifact(
+            'SampleData[AlphaDiversityStack]',
+            StackedAlphaDiversities.from_vectors(vectors, precision))
+        # the number of iterations that were run is passed explicitly, so
+        # that it is recorded in provenance
+        result, = alpha_average_action(sample_data, average_method,
+                                       n=len(vectors))
+        return result
+
     sample_data, = alpha_collection_action(table=table,
                                            sampling_depth=sampling_depth,
                                            phylogeny=phylogeny,
                                            metric=metric,
                                            n=n,
-                                           replacement=replacement)
+                                           replacement=replacement,
+                                           random_seed=random_seed,
+                                           precision=precision)
 
     result, = alpha_average_action(sample_data, average_method)
     return result
 
 
+def _validate_average_method(average_method):
+    if average_method not in ('median', 'mean'):
+        raise KeyError(f"Invalid average method: '{average_method}'. "
+                       "Valid choices are 'median' and 'mean'.")
+
+
 def _validate_alpha_metric(metric, phylogeny):
     if _is_phylogenetic_alpha_metric(metric) and phylogeny is None:
         raise ValueError(f'Metric {metric} requires a phylogenetic tree.')
@@ -82,6 +178,70 @@ def _is_phylogenetic_alpha_metric(metric):
 
 def _alpha_collection_from_tables(tables, alpha_metric_action):
     results = []
-    for table in tables.values():
+    for table in tables:
         results.append(alpha_metric_action(table=table)[0])
     return results
+
+
+def _alpha_series(ctx, table, sampling_depth, metric, n, replacement,
+                  phylogeny=None, random_seed=None, dtype=np.float64):
+    # yields each alpha diversity vector as a pd.Series, drawing resampled
+    # tables only as they are needed. Native metrics are computed directly
+    # from the resampled tables (as `dtype`), so no artifact is created per
+    # vector.
+    if metric in NATIVE_ALPHA_METRICS:
+        yield from _native_alpha_series(table, sampling_depth, metric, n,
+                                        replacement, phylogeny, random_seed,
+                                        dtype=dtype)
+        return
+
+    alpha_metric_action = _get_alpha_metric_action(ctx, metric, phylogeny)
+    for resampled_table in _resampled_table_artifacts(
+            ctx, table, sampling_depth, n, replacement, random_seed):
+        alpha_vector, = alpha_metric_action(table=resampled_table)
+        yield alpha_vector.view(pd.Series)
+
+
+def _native_alpha_collection(ctx, table, sampling_depth, metric, n,
+                             replacement, phylogeny=None, random_seed=None,
+                             start=0, dtype=np.float64):
+    return [alpha_vector for alpha_vector, _ in _native_alpha_results(
+        ctx, table, sampling_depth, metric, n, replacement, phylogeny,
+        random_seed, start, dtype)]
+
+
+def _native_alpha_results(ctx, table, sampling_depth, metric, n,
+                          replacement, phylogeny=None, random_seed=None,
+                          start=0, dtype=np.float64):
+    for vector in _native_alpha_series(table, sampling_depth, metric, n,
+                                       replacement, phylogeny, random_seed,
+                                       start, dtype):
+        yield ctx.make_artifact('SampleData[AlphaDiversity]', vector), vector
+
+
+def _native_alpha_series(table, sampling_depth, metric, n, replacement,
+                         phylogeny=None, random_seed=None, start=0,
+                         dtype=np.float64):
+    phylogeny_index = None
+    if _is_phylogenetic_alpha_metric(metric):
+        phylogeny_index = PhylogenyIndex(phylogeny.view(skbio.TreeNode))
+    for stack in _table_stacks(table, sampling_depth, n, replacement,
+                               random_seed, start, dtype=dtype):
+        for vectors in _native_alpha_vectors(stack, [metric],
+                                             phylogeny_index, dtype):
+            yield vectors[metric]
+
+
+def _native_alpha_vectors(stack, metrics, phylogeny_index=None,
+                          dtype=np.float64):
+    # yields a dict mapping each metric to its alpha diversity vector, for
+    # each resampled table in the stack
+    results = alpha_diversities(stack.data, stack.indptr, metrics, dtype)
+    if 'faith_pd' in metrics:
+        results['faith_pd'] = phylogeny_index.faith_pd(
+            stack.data, stack.indices, stack.indptr,
+            stack.feature_ids).astype(dtype, copy=False)
+    for i in range(len(stack)):
+        yield {metric: pd.Series(values[i], index=stack.sample_ids,
+                                 name=NATIVE_ALPHA_METRICS[metric])
+               for metric, values in results.items()}
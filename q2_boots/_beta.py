@@ -7,14 +7,22 @@
 # ----------------------------------------------------------------------------
 
 import functools
-import warnings
 
 import numpy as np
 import skbio
-from hdmedians import medoid
 
 from q2_diversity_lib.beta import METRICS
 
+from q2_boots._aggregate import (RunningMoments, PartialAggregate,
+                                 ConvergenceMonitor,
+                                 merge_partial_aggregates)
+from q2_boots._collection import StackedDistanceMatrices
+from q2_boots._metrics import (NATIVE_BETA_METRICS, beta_diversities,
+                               PhylogenyIndex)
+from q2_boots._resample import (_resampled_table_artifacts,
+                                _table_stacks, _ResampledStack,
+                                _existing_results)
+
 _METRIC_MOD_DEFAULTS = {
     'bypass_tips': False,
     'pseudocount': 1,
@@ -22,27 +30,106 @@ _METRIC_MOD_DEFAULTS = {
     'variance_adjusted': False
 }
 
+# Upper bound on the size of the temporary arrays used when averaging
+# distance matrices, which are built from blocks of their condensed forms.
+_BLOCK_BYTES = 2 ** 27
+# Number of dimensions that condensed distance matrices are randomly
+# projected onto, and number of candidates whose sum of distances is then
+# computed exactly, when computing the approximate medoid.
+_APPROX_MEDOID_DIMENSIONS = 256
+_APPROX_MEDOID_CANDIDATES = 16
+
 
 def beta_average(data: skbio.DistanceMatrix,
-                 average_method: str) -> skbio.DistanceMatrix:
+                 average_method: str,
+                 partial_aggregate: PartialAggregate = None,
+                 precision: str = 'float64') -> skbio.DistanceMatrix:
+    if partial_aggregate is not None:
+        # only the new distance matrices are aggregated, and then merged
+        # with the summary of the earlier ones
+        return beta_merge_aggregates(
+            {'existing': partial_aggregate,
+             'new': beta_partial_aggregate(
+                 data, partial_aggregate.sketch.capacity)},
+            average_method)
+
+    if average_method == 'non-metric-mean':
+        # the mean is accumulated one distance matrix at a time, so the
+        # distance matrices are never stacked
+        ids, moments = _condensed_moments(data.values())
+        return skbio.DistanceMatrix(moments.mean, ids=ids)
+
     # I need to be able to index into data.values(). Come up with a more
     # efficient way to do this.
     data = list(data.values())
     if average_method == 'medoid':
-        warnings.warn('The current implementation of medoid may require '
-                      'prohibitively large amounts of memory for large data '
-                      'sets or large values of `n`. You can track progress '
-                      'on this issue here: '
-                      'https://github.com/caporaso-lab/q2-boots/issues/10')
-        return _medoid(data)
-    elif average_method == 'non-metric-mean':
-        return _per_cell_average(data, 'mean')
+        return _medoid(data, dtype=precision)
+    elif average_method == 'approx-medoid':
+        return _approx_medoid(data, dtype=precision)
     elif average_method == 'non-metric-median':
-        return _per_cell_average(data, 'median')
+        return _per_cell_average(data, 'median', dtype=precision)
+    else:
+        raise ValueError(f"Unknown average method {average_method}. "
+                         "Available options are non-metric-median, non-metric-"
+                         "mean, medoid, and approx-medoid.")
+
+
+def beta_average_stacked(data: StackedDistanceMatrices,
+                         average_method: str,
+                         precision: str = 'float64',
+                         n: int = None) -> skbio.DistanceMatrix:
+    if n is not None:
+        data = data.head(n)
+    # the stack is read in blocks of columns, so it is never all loaded
+    if average_method in ('non-metric-mean', 'non-metric-median'):
+        average_condensed_dm = _per_cell_average_condensed(
+            data.column_blocks, len(data), average_method[len('non-metric-'):],
+            dtype=precision)
+        return skbio.DistanceMatrix(average_condensed_dm, ids=data.ids)
+    elif average_method == 'medoid':
+        return data.distance_matrix(
+            _medoid_index(data.column_blocks, len(data), dtype=precision))
+    elif average_method == 'approx-medoid':
+        return data.distance_matrix(
+            _approx_medoid_index(data.column_blocks, len(data),
+                                 dtype=precision))
     else:
         raise ValueError(f"Unknown average method {average_method}. "
                          "Available options are non-metric-median, non-metric-"
-                         "mean, and medoid.")
+                         "mean, medoid, and approx-medoid.")
+
+
+def beta_variance(data: skbio.DistanceMatrix) -> skbio.DistanceMatrix:
+    ids, moments = _condensed_moments(data.values())
+    return skbio.DistanceMatrix(moments.variance, ids=ids)
+
+
+def beta_partial_aggregate(data: skbio.DistanceMatrix,
+                           sketch_capacity: int = 32) -> PartialAggregate:
+    # distance matrices have many more elements than alpha diversity
+    # vectors, so a smaller sketch than for alpha diversity is the default
+    aggregate = None
+    for dm in data.values():
+        if aggregate is None:
+            aggregate = PartialAggregate(dm.ids,
+                                         sketch_capacity=sketch_capacity)
+        aggregate.update(dm.condensed_form())
+    return aggregate
+
+
+def beta_merge_aggregates(aggregates: PartialAggregate,
+                          average_method: str) -> skbio.DistanceMatrix:
+    if average_method == 'non-metric-mean':
+        average_method = 'mean'
+    elif average_method == 'non-metric-median':
+        average_method = 'median'
+    else:
+        raise ValueError(f"Unknown average method {average_method}. "
+                         "Available options are non-metric-median and "
+                         "non-metric-mean.")
+    aggregate = merge_partial_aggregates(aggregates.values())
+    return skbio.DistanceMatrix(aggregate.average(average_method),
+                                ids=aggregate.ids)
 
 
 def beta_collection(
@@ -51,21 +138,45 @@ def beta_collection(
         bypass_tips=_METRIC_MOD_DEFAULTS['bypass_tips'],
         pseudocount=_METRIC_MOD_DEFAULTS['pseudocount'],
         alpha=_METRIC_MOD_DEFAULTS['alpha'],
-        variance_adjusted=_METRIC_MOD_DEFAULTS['variance_adjusted']):
+        variance_adjusted=_METRIC_MOD_DEFAULTS['variance_adjusted'],
+        random_seed=None, existing_distance_matrices=None,
+        precision='float64'):
     _validate_beta_metric(metric, phylogeny)
+    existing = list(_existing_results(existing_distance_matrices,
+                                      n).values())
+
+    if _is_native_beta_metric(metric, bypass_tips, variance_adjusted):
+        return existing + _native_beta_collection(
+            ctx, table, sampling_depth, metric, n, replacement, phylogeny,
+            random_seed, start=len(existing), dtype=precision)
 
-    resample_action = ctx.get_action("boots", "resample")
     beta_metric_action = _get_beta_metric_action(
         ctx, metric, phylogeny, bypass_tips, pseudocount, alpha,
         variance_adjusted)
 
-    tables, = resample_action(table=table,
-                              sampling_depth=sampling_depth,
-                              n=n,
-                              replacement=replacement)
+    tables = _resampled_table_artifacts(ctx, table, sampling_depth, n,
+                                        replacement, random_seed,
+                                        start=len(existing))
     results = _beta_collection_from_tables(tables, beta_metric_action)
 
-    return results
+    return existing + results
+
+
+def beta_collection_stacked(
+        ctx, table, metric, sampling_depth, n, replacement,
+        phylogeny=None,
+        bypass_tips=_METRIC_MOD_DEFAULTS['bypass_tips'],
+        pseudocount=_METRIC_MOD_DEFAULTS['pseudocount'],
+        alpha=_METRIC_MOD_DEFAULTS['alpha'],
+        variance_adjusted=_METRIC_MOD_DEFAULTS['variance_adjusted'],
+        random_seed=None, precision='float64'):
+    _validate_beta_metric(metric, phylogeny)
+    dms = _beta_matrices(ctx, table, metric, sampling_depth, n, replacement,
+                         phylogeny, bypass_tips, pseudocount, alpha,
+                         variance_adjusted, random_seed, precision)
+    return ctx.make_artifact(
+        'DistanceMatrixStack',
+        StackedDistanceMatrices.from_distance_matrices(dms, n, precision))
 
 
 def beta(ctx, table, metric, sampling_depth, n, replacement,
@@ -73,9 +184,34 @@ def beta(ctx, table, metric, sampling_depth, n, replacement,
          bypass_tips=_METRIC_MOD_DEFAULTS['bypass_tips'],
          pseudocount=_METRIC_MOD_DEFAULTS['pseudocount'],
          alpha=_METRIC_MOD_DEFAULTS['alpha'],
-         variance_adjusted=_METRIC_MOD_DEFAULTS['variance_adjusted']):
-    beta_collection_action = ctx.get_action('boots', 'beta_collection')
-    beta_average_action = ctx.get_action('boots', 'beta_average')
+         variance_adjusted=_METRIC_MOD_DEFAULTS['variance_adjusted'],
+         random_seed=None, convergence_tolerance=None,
+         convergence_batch_size=10, precision='float64'):
+    beta_collection_action = ctx.get_action('boots',
+                                            'beta_collection_stacked')
+    beta_average_action = ctx.get_action('boots', 'beta_average_stacked')
+    if convergence_tolerance is not None:
+        # iterations are run until the average converges, or n iterations
+        # have been run
+        _validate_beta_metric(metric, phylogeny)
+        monitor = ConvergenceMonitor(
+            convergence_tolerance,
+            {metric: _convergence_average_method(average_method)})
+        dms = _beta_matrices(ctx, table, metric, sampling_depth, n,
+                             replacement, phylogeny, bypass_tips,
+                             pseudocount, alpha, variance_adjusted,
+                             random_seed, precision)
+        dms = StackedDistanceMatrices.from_distance_matrices(
+            _until_converged(monitor, metric, dms, convergence_batch_size),
+            n, precision)
+        # the number of iterations that were run is passed explicitly, so
+        # that it is recorded in provenance
+        num_iterations = len(dms)
+        dms = ctx.make_artifact('DistanceMatrixStack', dms)
+        result, = beta_average_action(dms, average_method,
+                                      precision=precision, n=num_iterations)
+        return result
+
     dms, = beta_collection_action(table=table,
                                   phylogeny=phylogeny,
                                   metric=metric,
@@ -85,37 +221,159 @@ def beta(ctx, table, metric, sampling_depth, n, replacement,
                                   replacement=replacement,
                                   variance_adjusted=variance_adjusted,
                                   alpha=alpha,
-                                  bypass_tips=bypass_tips)
+                                  bypass_tips=bypass_tips,
+                                  random_seed=random_seed,
+                                  precision=precision)
 
-    result, = beta_average_action(dms, average_method)
+    result, = beta_average_action(dms, average_method,
+                                  precision=precision)
     return result
 
 
-def _per_cell_average(a, average_method):
-    shape = a[0].shape
-    ids = a[0].ids
+def _per_cell_average(a, average_method, max_block_bytes=_BLOCK_BYTES,
+                      dtype=np.float64):
+    average_condensed_dm = _per_cell_average_condensed(
+        functools.partial(_condensed_blocks, a), len(a), average_method,
+        max_block_bytes, dtype)
+    return skbio.DistanceMatrix(average_condensed_dm, ids=a[0].ids)
+
+
+def _per_cell_average_condensed(read_blocks, n, average_method,
+                                max_block_bytes=_BLOCK_BYTES,
+                                dtype=np.float64):
+    # `read_blocks(block_size, dtype)` yields copies of consecutive column
+    # blocks of the n condensed forms, as _condensed_blocks does. The
+    # average is returned as float64 whatever `dtype` it was computed in.
     if average_method == 'median':
-        average_fn = np.median
+        # each block is a temporary copy, so np.median can partition it in
+        # place rather than making another copy
+        average_fn = functools.partial(np.median, overwrite_input=True)
     elif average_method == 'mean':
         average_fn = np.mean
     else:
         raise ValueError(f"Unknown average method {average_method}. "
                          "Available options are median and mean.")
-    condensed_dms = np.asarray([dm.condensed_form() for dm in a])
-    average_condensed_dm = average_fn(condensed_dms, axis=0)
 
-    result = np.zeros(shape)
-    dm_indices = np.triu_indices(shape[0], 1)
-    result[(dm_indices[0], dm_indices[1])] = average_condensed_dm
-    result[(dm_indices[1], dm_indices[0])] = average_condensed_dm
+    block_size = max(1, max_block_bytes // (np.dtype(dtype).itemsize * n))
+    average_condensed_dm = [average_fn(block, axis=0)
+                            for block in read_blocks(block_size, dtype)]
+    return np.concatenate([np.zeros(0)] + average_condensed_dm)
+
+
+def _condensed_moments(dms):
+    moments = RunningMoments()
+    for dm in dms:
+        moments.update(dm.condensed_form())
+        ids = dm.ids
+    return ids, moments
+
+
+def _medoid(a, max_block_bytes=_BLOCK_BYTES, dtype=np.float64):
+    """Return the distance matrix in `a` closest to all others.
 
-    return skbio.DistanceMatrix(result, ids=ids)
+    Each distance matrix is treated as its condensed form, and the medoid is
+    the one with the smallest sum of Euclidean distances to all others.
+    """
+    return a[_medoid_index(functools.partial(_condensed_blocks, a), len(a),
+                           max_block_bytes, dtype)]
 
 
-def _medoid(a):
-    condensed_dms = np.asarray([dm.condensed_form() for dm in a])
-    medoid_dm_index = medoid(condensed_dms, axis=0, indexonly=True)
-    return a[medoid_dm_index]
+def _medoid_index(read_blocks, n, max_block_bytes=_BLOCK_BYTES,
+                  dtype=np.float64):
+    """Return the index of the medoid of n condensed distance matrices.
+
+    `read_blocks(block_size, dtype)` yields copies of consecutive column
+    blocks of the condensed forms. The n x n matrix of squared distances is
+    accumulated from the blocks as ||x||^2 + ||y||^2 - 2xy^T, so the
+    condensed forms are never all held in memory and each block is a single
+    matrix product. Blocks and squared distances are held as `dtype`.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    block_size = max(1, max_block_bytes // (itemsize * n))
+    sq_distances = np.zeros((n, n), dtype=dtype)
+    for block in read_blocks(block_size, dtype):
+        # centering doesn't change the distances, but reduces the
+        # cancellation error of the norm-based expansion
+        block -= block.mean(axis=0)
+        sq_distances += _sq_distances(block, block)
+
+    distance_sums = np.sqrt(np.maximum(sq_distances, 0)).sum(axis=1)
+    return np.argmin(distance_sums)
+
+
+def _approx_medoid(a, dimensions=_APPROX_MEDOID_DIMENSIONS,
+                   num_candidates=_APPROX_MEDOID_CANDIDATES,
+                   max_block_bytes=_BLOCK_BYTES, dtype=np.float64):
+    """Return the approximate medoid of the distance matrices in `a`."""
+    return a[_approx_medoid_index(functools.partial(_condensed_blocks, a),
+                                  len(a), dimensions, num_candidates,
+                                  max_block_bytes, dtype)]
+
+
+def _approx_medoid_index(read_blocks, n, dimensions=_APPROX_MEDOID_DIMENSIONS,
+                         num_candidates=_APPROX_MEDOID_CANDIDATES,
+                         max_block_bytes=_BLOCK_BYTES, dtype=np.float64):
+    """Return the index of the approximate medoid of n distance matrices.
+
+    The condensed forms, read as column blocks with `read_blocks` (see
+    `_medoid_index`), are projected onto `dimensions` random Gaussian
+    directions (a Johnson-Lindenstrauss projection), which approximately
+    preserves the Euclidean distances between them. The `num_candidates`
+    distance matrices with the smallest sums of projected distances are then
+    compared exactly against all others, and the best of those is returned.
+    The projection is seeded and drawn column by column, so the result is
+    deterministic and does not depend on how the columns are blocked (or on
+    `dtype`, which blocks and projections are held as).
+    """
+    num_candidates = min(n, num_candidates)
+    block_size = max(1, max_block_bytes // (np.dtype(dtype).itemsize *
+                                            max(n, dimensions)))
+    rng = np.random.default_rng(0)
+
+    projected = np.zeros((n, dimensions), dtype=dtype)
+    for block in read_blocks(block_size, dtype):
+        projection = rng.standard_normal((block.shape[1], dimensions))
+        projected += block @ projection.astype(dtype, copy=False)
+    projected /= np.sqrt(dimensions)
+    approx_sq_distances = _sq_distances(projected, projected)
+    approx_sums = np.sqrt(approx_sq_distances).sum(axis=1)
+    candidates = np.argsort(approx_sums, kind='stable')[:num_candidates]
+
+    sq_distances = np.zeros((num_candidates, n), dtype=dtype)
+    for block in read_blocks(block_size, dtype):
+        block -= block.mean(axis=0)
+        sq_distances += _sq_distances(block[candidates], block)
+    distance_sums = np.sqrt(sq_distances).sum(axis=1)
+    return candidates[np.argmin(distance_sums)]
+
+
+def _sq_distances(x, y):
+    sq_distances = (np.einsum('ij,ij->i', x, x)[:, np.newaxis] +
+                    np.einsum('ij,ij->i', y, y)[np.newaxis, :] -
+                    2 * (x @ y.T))
+    return np.clip(sq_distances, 0, None, out=sq_distances)
+
+
+def _condensed_blocks(a, block_size, dtype=np.float64):
+    """Yield consecutive blocks of the condensed forms of `a`, as `dtype`.
+
+    Each block is an array of shape (len(a), m) holding the condensed-form
+    entries of the next rows of the upper triangle, with m close to
+    `block_size`. Rows are read directly from the square form of each
+    distance matrix, so the full condensed forms are never built.
+    """
+    num_ids = a[0].shape[0]
+    start = 0
+    while start < num_ids - 1:
+        stop, num_entries = start, 0
+        while stop < num_ids - 1 and num_entries < block_size:
+            num_entries += num_ids - 1 - stop
+            stop += 1
+        rows = np.arange(start, stop)[:, np.newaxis]
+        upper = np.arange(num_ids)[np.newaxis, :] > rows
+        yield np.asarray([dm.data[start:stop][upper] for dm in a],
+                         dtype=dtype)
+        start = stop
 
 
 def _validate_beta_metric(metric, phylogeny):
@@ -152,6 +410,99 @@ def _is_phylogenetic_beta_metric(metric):
 
 def _beta_collection_from_tables(tables, beta_metric_action):
     results = []
-    for table in tables.values():
+    for table in tables:
         results.append(beta_metric_action(table=table)[0])
     return results
+
+
+def _is_native_beta_metric(
+        metric, bypass_tips=_METRIC_MOD_DEFAULTS['bypass_tips'],
+        variance_adjusted=_METRIC_MOD_DEFAULTS['variance_adjusted']):
+    # bypassing tips and variance adjustment are only implemented in
+    # q2-diversity
+    return (metric in NATIVE_BETA_METRICS and not bypass_tips and
+            not variance_adjusted)
+
+
+def _convergence_average_method(average_method):
+    # The medoid is one of the distance matrices, so it changes in jumps
+    # rather than converging, and the per-cell mean is monitored instead.
+    if average_method == 'non-metric-median':
+        return 'median'
+    return 'mean'
+
+
+def _until_converged(monitor, metric, dms, batch_size):
+    # yields distance matrices from `dms` until the running average of
+    # every `batch_size` of them has converged
+    for i, dm in enumerate(dms, start=1):
+        yield dm
+        monitor.update(metric, dm.condensed_form())
+        if i % batch_size == 0 and monitor.converged():
+            return
+
+
+def _beta_matrices(ctx, table, metric, sampling_depth, n, replacement,
+                   phylogeny=None,
+                   bypass_tips=_METRIC_MOD_DEFAULTS['bypass_tips'],
+                   pseudocount=_METRIC_MOD_DEFAULTS['pseudocount'],
+                   alpha=_METRIC_MOD_DEFAULTS['alpha'],
+                   variance_adjusted=_METRIC_MOD_DEFAULTS['variance_adjusted'],
+                   random_seed=None, dtype=np.float64):
+    # yields each distance matrix as an skbio.DistanceMatrix, drawing
+    # resampled tables only as they are needed. Only native metrics are
+    # computed as `dtype`.
+    if _is_native_beta_metric(metric, bypass_tips, variance_adjusted):
+        yield from _native_beta_matrices(table, sampling_depth, metric, n,
+                                         replacement, phylogeny,
+                                         random_seed, dtype=dtype)
+        return
+
+    beta_metric_action = _get_beta_metric_action(
+        ctx, metric, phylogeny, bypass_tips, pseudocount, alpha,
+        variance_adjusted)
+    for resampled_table in _resampled_table_artifacts(
+            ctx, table, sampling_depth, n, replacement, random_seed):
+        dm, = beta_metric_action(table=resampled_table)
+        yield dm.view(skbio.DistanceMatrix)
+
+
+def _native_beta_collection(ctx, table, sampling_depth, metric, n,
+                            replacement, phylogeny=None, random_seed=None,
+                            start=0, dtype=np.float64):
+    return [ctx.make_artifact('DistanceMatrix', dm)
+            for dm in _native_beta_matrices(table, sampling_depth, metric, n,
+                                            replacement, phylogeny,
+                                            random_seed, start, dtype)]
+
+
+def _native_beta_matrices(table, sampling_depth, metric, n, replacement,
+                          phylogeny=None, random_seed=None, start=0,
+                          dtype=np.float64):
+    phylogeny_index = None
+    if _is_phylogenetic_beta_metric(metric):
+        phylogeny_index = PhylogenyIndex(phylogeny.view(skbio.TreeNode))
+    for stack in _table_stacks(table, sampling_depth, n, replacement,
+                               random_seed, start, dtype=dtype):
+        for dms in _native_distance_matrices(stack, [metric],
+                                             phylogeny_index, dtype):
+            yield dms[metric]
+
+
+def _native_distance_matrices(stack, metrics, phylogeny_index=None,
+                              dtype=np.float64):
+    # yields a dict mapping each metric to its distance matrix, for each
+    # resampled table in the stack
+    results = beta_diversities(stack.data, stack.indices, stack.indptr,
+                               stack.feature_ids, metrics, phylogeny_index,
+                               dtype)
+    for i in range(len(stack)):
+        yield {metric: skbio.DistanceMatrix(values[i], ids=stack.sample_ids)
+               for metric, values in results.items()}
+
+
+def _native_table_distance_matrices(table, metrics, dtype=np.float64):
+    # the distance matrices of a single biom.Table
+    dms, = _native_distance_matrices(_ResampledStack.from_table(table),
+                                     metrics, dtype=dtype)
+    return dms
@@ -0,0 +1,128 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, Caporaso Lab (https://cap-lab.bio).
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import contextlib
+import hashlib
+import os
+import pathlib
+import re
+import tempfile
+
+# The on-disk cache is disabled unless CACHE_DIR_ENV_VAR is set to the
+# directory it should be kept in. Its total size is capped at
+# CACHE_MAX_BYTES_ENV_VAR bytes, or at DEFAULT_CACHE_MAX_BYTES if that is
+# not set. Caches are kept in the CACHE_NAMESPACE subdirectory of that
+# directory, so other files in it are never evicted.
+CACHE_DIR_ENV_VAR = 'Q2_BOOTS_CACHE_DIR'
+CACHE_MAX_BYTES_ENV_VAR = 'Q2_BOOTS_CACHE_MAX_BYTES'
+DEFAULT_CACHE_MAX_BYTES = 2 ** 32
+CACHE_NAMESPACE = 'q2-boots'
+
+# entries are named by their key (see `cache_key`)
+_ENTRY_NAME = re.compile(r'[0-9a-f]{64}')
+
+
+class DiskCache:
+    """Content-addressed cache of files, with least recently used eviction.
+
+    Each entry is a single file in `directory`, named by its key, which
+    must be a digest of everything the file's contents depend on (see
+    `cache_key`). Reading an entry updates its modification time, and when
+    the total size of all entries of the caches in the cache's parent
+    directory exceeds `max_bytes`, the entries with the oldest modification
+    times are removed. Entries larger than `max_bytes` are never added.
+    Files that are not named like keys are never counted or removed.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.directory = pathlib.Path(directory)
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def from_environment(cls, name):
+        """Return the cache called `name`, or None if caching is disabled."""
+        root = os.environ.get(CACHE_DIR_ENV_VAR)
+        if not root:
+            return None
+        max_bytes = int(os.environ.get(CACHE_MAX_BYTES_ENV_VAR,
+                                       DEFAULT_CACHE_MAX_BYTES))
+        return cls(pathlib.Path(root) / CACHE_NAMESPACE / name, max_bytes)
+
+    def get(self, key):
+        """Return the path of the entry for `key`, or None if there is none.
+        """
+        path = self.directory / key
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, write):
+        """Add an entry for `key`, by calling `write` with an open file."""
+        with self.open_entry(key) as fh:
+            write(fh)
+
+    @contextlib.contextmanager
+    def open_entry(self, key):
+        """Add an entry for `key`, by writing to the yielded file.
+
+        The entry is written to a temporary file first, and only added if
+        the block exits without an exception, so readers never see a
+        partially written entry. An entry larger than `max_bytes` is not
+        added, since it would have to be evicted right away.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                yield fh
+            if os.path.getsize(temp_path) > self.max_bytes:
+                os.unlink(temp_path)
+                return
+            os.replace(temp_path, self.directory / key)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        self._evict(keep=self.directory / key)
+
+    def _evict(self, keep):
+        # all caches that share a parent directory share its size cap. The
+        # entry that was just added (`keep`) is never evicted, even if other
+        # entries have the same modification time.
+        entries = []
+        for path in self.directory.parent.glob('*/*'):
+            if not _ENTRY_NAME.fullmatch(path.name):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_bytes = sum(size for _, size, _ in entries)
+        entries.sort(key=lambda entry: (entry[2] == keep, entry[0]))
+        for _, size, path in entries:
+            if total_bytes <= self.max_bytes or path == keep:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+
+def cache_key(*parts):
+    """Return a hex digest of `parts`, which are strings or bytes."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        # length-prefixing keeps different splits of the same bytes apart
+        digest.update(len(part).to_bytes(8, 'little'))
+        digest.update(part)
+    return digest.hexdigest()
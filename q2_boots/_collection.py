@@ -0,0 +1,167 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, Caporaso Lab (https://cap-lab.bio).
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import json
+import pathlib
+import tempfile
+
+import numpy as np
+import pandas as pd
+import skbio
+
+
+class StackedAlphaDiversities:
+    """A collection of alpha diversity vectors, stored as a single array.
+
+    `values` has shape (number of samples, number of vectors), with one row
+    per sample in `ids` and one column per vector. Saved stacks are loaded
+    as memory-mapped arrays, so loading does not copy the values.
+    """
+
+    values_filename = 'alpha-diversities.npy'
+    metadata_filename = 'metadata.json'
+
+    def __init__(self, values, ids, name=None):
+        self.values = values
+        self.ids = pd.Index(ids)
+        self.name = name
+
+    @classmethod
+    def from_vectors(cls, vectors, dtype=np.float64):
+        """Create a stack from pd.Series computed on the same samples."""
+        vectors = iter(vectors)
+        first = next(vectors)
+        columns = [first.to_numpy(dtype=dtype)]
+        for vector in vectors:
+            columns.append(vector.reindex(first.index).to_numpy(dtype=dtype))
+        return cls(np.column_stack(columns), first.index, first.name)
+
+    def __len__(self):
+        return self.values.shape[1]
+
+    def head(self, n):
+        """Return a stack of the first `n` vectors."""
+        _validate_head(len(self), n, 'alpha diversity vectors')
+        return StackedAlphaDiversities(self.values[:, :n], self.ids,
+                                       self.name)
+
+    def average(self, average_method):
+        # missing values are skipped, as in alpha_average
+        values = pd.DataFrame(self.values, index=self.ids)
+        if average_method == 'median':
+            result = values.median(axis=1)
+        elif average_method == 'mean':
+            result = values.mean(axis=1)
+        else:
+            raise KeyError(f"Invalid average method: '{average_method}'. "
+                           "Valid choices are 'median' and 'mean'.")
+        # stacks may be stored as float32, but averages are always float64
+        result = result.astype(np.float64)
+        result.name = self.name
+        return result
+
+    def save(self, directory):
+        directory = pathlib.Path(directory)
+        np.save(directory / self.values_filename, self.values)
+        with open(directory / self.metadata_filename, 'w') as fh:
+            json.dump({'ids': list(self.ids), 'name': self.name}, fh)
+
+    @classmethod
+    def load(cls, directory):
+        directory = pathlib.Path(directory)
+        values = np.load(directory / cls.values_filename, mmap_mode='r',
+                         allow_pickle=False)
+        with open(directory / cls.metadata_filename) as fh:
+            metadata = json.load(fh)
+        return cls(values, metadata['ids'], metadata['name'])
+
+
+class StackedDistanceMatrices:
+    """A collection of distance matrices, stored as a single array.
+
+    `values` has shape (number of distance matrices, number of pairs of
+    ids), with the condensed form of one distance matrix on `ids` per row.
+    Rows are stored as float64 or float32. Saved stacks are loaded as
+    memory-mapped arrays, so they can be read in blocks of columns without
+    loading the whole collection.
+    """
+
+    values_filename = 'distance-matrices.npy'
+    metadata_filename = 'metadata.json'
+
+    def __init__(self, values, ids):
+        self.values = values
+        self.ids = tuple(ids)
+
+    @classmethod
+    def from_distance_matrices(cls, dms, max_num_dms, dtype=np.float64):
+        """Create a stack from at most `max_num_dms` skbio.DistanceMatrix.
+
+        The condensed forms are written to an unnamed temporary file as the
+        distance matrices are consumed, so they are never all held in
+        memory.
+        """
+        values = None
+        num_dms = 0
+        for dm in dms:
+            if values is None:
+                ids = dm.ids
+                shape = (max_num_dms, len(ids) * (len(ids) - 1) // 2)
+                if shape[1] == 0:
+                    # empty files can't be memory-mapped
+                    values = np.empty(shape, dtype=dtype)
+                else:
+                    # the mapping stays valid after the file is closed
+                    with tempfile.TemporaryFile() as fh:
+                        values = np.memmap(fh, dtype=dtype, mode='w+',
+                                           shape=shape)
+            values[num_dms] = dm.condensed_form()
+            num_dms += 1
+        if values is None:
+            raise ValueError('At least one distance matrix is required.')
+        return cls(values[:num_dms], ids)
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    def head(self, n):
+        """Return a stack of the first `n` distance matrices."""
+        _validate_head(len(self), n, 'distance matrices')
+        return StackedDistanceMatrices(self.values[:n], self.ids)
+
+    def distance_matrix(self, index):
+        """Return the distance matrix in row `index` as float64."""
+        return skbio.DistanceMatrix(
+            np.asarray(self.values[index], dtype=np.float64), ids=self.ids)
+
+    def column_blocks(self, block_size, dtype=np.float64):
+        """Yield copies of consecutive blocks of `block_size` columns."""
+        for start in range(0, self.values.shape[1], block_size):
+            yield np.array(self.values[:, start:start + block_size],
+                           dtype=dtype)
+
+    def save(self, directory):
+        directory = pathlib.Path(directory)
+        np.save(directory / self.values_filename, self.values)
+        with open(directory / self.metadata_filename, 'w') as fh:
+            json.dump({'ids': list(self.ids)}, fh)
+
+    @classmethod
+    def load(cls, directory):
+        directory = pathlib.Path(directory)
+        values = np.load(directory / cls.values_filename, mmap_mode='r',
+                         allow_pickle=False)
+        with open(directory / cls.metadata_filename) as fh:
+            metadata = json.load(fh)
+        return cls(values, metadata['ids'])
+
+
+def _validate_head(length, n, description):
+    if n > length:
+        raise ValueError(f'{n} {description} were requested, but only '
+                         f'{length} are stored.')
@@ -6,21 +6,28 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import biom
+import pandas as pd
+import skbio
 from skbio import OrdinationResults
 from qiime2 import Metadata
 import numpy as np
 from q2_boots._alpha import (_validate_alpha_metric, _get_alpha_metric_action,
-                             _alpha_collection_from_tables)
+                             _native_alpha_vectors)
 from q2_boots._beta import (_validate_beta_metric, _get_beta_metric_action,
-                            _beta_collection_from_tables)
+                            _is_native_beta_metric, _native_distance_matrices,
+                            _convergence_average_method)
+from q2_boots._aggregate import ConvergenceMonitor
+from q2_boots._metrics import NATIVE_ALPHA_METRICS, PhylogenyIndex
+from q2_boots._resample import _resampled_stacks, _iteration_seeds
 
 
 def core_metrics(ctx, table, sampling_depth, metadata, n, replacement,
                  phylogeny=None, alpha_average_method='median',
                  beta_average_method='non-metric-median', pc_dimensions=3,
-                 color_by=None):
+                 color_by=None, random_seed=None, convergence_tolerance=None,
+                 convergence_batch_size=10, precision='float64'):
 
-    resample_action = ctx.get_action('boots', 'resample')
     alpha_average_action = ctx.get_action('boots', 'alpha_average')
     beta_average_action = ctx.get_action('boots', 'beta_average')
     pcoa_action = ctx.get_action('diversity', 'pcoa')
@@ -39,30 +46,107 @@ def core_metrics(ctx, table, sampling_depth, metadata, n, replacement,
     for beta_metric in beta_metrics:
         _validate_beta_metric(beta_metric, phylogeny)
 
-    resampled_tables, = resample_action(table=table,
-                                        sampling_depth=sampling_depth,
-                                        n=n,
-                                        replacement=replacement)
+    native_alpha_metrics = [alpha_metric for alpha_metric in alpha_metrics
+                            if alpha_metric in NATIVE_ALPHA_METRICS]
+    alpha_metric_actions = {
+        alpha_metric: _get_alpha_metric_action(ctx, alpha_metric, phylogeny)
+        for alpha_metric in alpha_metrics
+        if alpha_metric not in NATIVE_ALPHA_METRICS}
+    # the phylogeny is indexed once, and the index is shared by all
+    # phylogenetic metrics
+    phylogeny_index = None
+    if phylogeny is not None:
+        phylogeny_index = PhylogenyIndex(phylogeny.view(skbio.TreeNode))
+    native_beta_metrics = [beta_metric for beta_metric in beta_metrics
+                           if _is_native_beta_metric(beta_metric)]
+    beta_metric_actions = {
+        beta_metric: _get_beta_metric_action(ctx, beta_metric, phylogeny)
+        for beta_metric in beta_metrics
+        if not _is_native_beta_metric(beta_metric)}
+
+    # Resampled tables are drawn in stacks, and every metric is computed on
+    # a stack before the next one is drawn, so only the per-metric results
+    # (and not the resampled tables themselves) need to be kept around.
+    # Native alpha and beta diversity metrics are computed for all tables of
+    # a stack at once.
+    # If convergence_tolerance is provided, n is the largest number of
+    # iterations, and iterations stop once every average has converged.
+    monitor = None
+    if convergence_tolerance is not None:
+        average_methods = {alpha_metric: alpha_average_method
+                           for alpha_metric in alpha_metrics}
+        average_methods.update(
+            {beta_metric: _convergence_average_method(beta_average_method)
+             for beta_metric in beta_metrics})
+        monitor = ConvergenceMonitor(convergence_tolerance, average_methods)
+    resampled_tables = {}
+    alpha_collections = {alpha_metric: [] for alpha_metric in alpha_metrics}
+    beta_collections = {beta_metric: [] for beta_metric in beta_metrics}
+    seeds = _iteration_seeds(random_seed, n)
+    for stack in _resampled_stacks(table.view(biom.Table), sampling_depth,
+                                   replacement, seeds,
+                                   cache=random_seed is not None,
+                                   dtype=precision):
+        stack_results = [{} for _ in range(len(stack))]
+        native_alpha_vectors = _native_alpha_vectors(
+            stack, native_alpha_metrics, phylogeny_index, precision)
+        for vectors, results in zip(native_alpha_vectors, stack_results):
+            for alpha_metric, vector in vectors.items():
+                alpha_collections[alpha_metric].append(ctx.make_artifact(
+                    'SampleData[AlphaDiversity]', vector))
+                results[alpha_metric] = vector.to_numpy()
+        native_dms = _native_distance_matrices(stack, native_beta_metrics,
+                                               phylogeny_index, precision)
+        for dms, results in zip(native_dms, stack_results):
+            for beta_metric, dm in dms.items():
+                beta_collections[beta_metric].append(ctx.make_artifact(
+                    'DistanceMatrix', dm))
+                results[beta_metric] = dm.condensed_form()
+
+        for i in range(len(stack)):
+            resampled_table = ctx.make_artifact('FeatureTable[Frequency]',
+                                                stack.table(i))
+            resampled_tables[f'resampled-table-{len(resampled_tables)}'] = \
+                resampled_table
+            for alpha_metric, alpha_metric_action in \
+                    alpha_metric_actions.items():
+                alpha_vector, = alpha_metric_action(table=resampled_table)
+                alpha_collections[alpha_metric].append(alpha_vector)
+                if monitor is not None:
+                    stack_results[i][alpha_metric] = \
+                        alpha_vector.view(pd.Series).to_numpy()
+            for beta_metric, beta_metric_action in \
+                    beta_metric_actions.items():
+                beta_dm, = beta_metric_action(table=resampled_table)
+                beta_collections[beta_metric].append(beta_dm)
+                if monitor is not None:
+                    stack_results[i][beta_metric] = \
+                        beta_dm.view(skbio.DistanceMatrix).condensed_form()
+
+        if monitor is None:
+            continue
+        num_iterations = _num_iterations_until_converged(
+            monitor, stack_results, len(resampled_tables) - len(stack),
+            convergence_batch_size)
+        if num_iterations is not None:
+            resampled_tables = dict(
+                list(resampled_tables.items())[:num_iterations])
+            for collection in (*alpha_collections.values(),
+                               *beta_collections.values()):
+                del collection[num_iterations:]
+            break
 
     alpha_vectors = {}
-    for alpha_metric in alpha_metrics:
-        alpha_metric_action = _get_alpha_metric_action(
-            ctx, alpha_metric, phylogeny)
-        alpha_collection = _alpha_collection_from_tables(
-            resampled_tables, alpha_metric_action)
+    for alpha_metric, alpha_collection in alpha_collections.items():
         avg_alpha_vector, = alpha_average_action(
             alpha_collection, alpha_average_method)
         alpha_vectors[alpha_metric] = avg_alpha_vector
         metadata = avg_alpha_vector.view(Metadata).merge(metadata)
 
     beta_dms = {}
-    for beta_metric in beta_metrics:
-        beta_metric_action = _get_beta_metric_action(
-            ctx, beta_metric, phylogeny)
-        beta_collection = _beta_collection_from_tables(
-            resampled_tables, beta_metric_action)
+    for beta_metric, beta_collection in beta_collections.items():
         avg_beta_dm, = beta_average_action(
-            beta_collection, beta_average_method)
+            beta_collection, beta_average_method, precision=precision)
         beta_dms[beta_metric] = avg_beta_dm
 
     pcoas = {}
@@ -91,3 +175,18 @@ def core_metrics(ctx, table, sampling_depth, metadata, n, replacement,
 
     return (resampled_tables, alpha_vectors, beta_dms, pcoas, emperor_plots,
             scatter_plot)
+
+
+def _num_iterations_until_converged(monitor, stack_results, num_iterations,
+                                    batch_size):
+    # Adds the results of a stack's iterations to monitor, one iteration at
+    # a time, and returns the total number of iterations once the averages
+    # converge at the end of a batch, or None if they do not converge
+    # within the stack.
+    for results in stack_results:
+        for key, values in results.items():
+            monitor.update(key, values)
+        num_iterations += 1
+        if num_iterations % batch_size == 0 and monitor.converged():
+            return num_iterations
+    return None
@@ -0,0 +1,120 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, Caporaso Lab (https://cap-lab.bio).
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import json
+import zipfile
+
+import h5py
+import numpy as np
+
+from qiime2.plugin import model, ValidationError
+
+
+class PartialAggregateFormat(model.BinaryFileFormat):
+    _fields = {'ids', 'name', 'count', 'mean', 'm2', 'sketch_capacity',
+               'sketch_num_compactions', 'sketch_values', 'sketch_levels'}
+
+    def _validate_(self, level):
+        try:
+            with np.load(str(self), allow_pickle=False) as data:
+                fields = set(data.files)
+        except (OSError, ValueError, zipfile.BadZipFile) as e:
+            raise ValidationError(
+                'File is not a valid partial aggregate.') from e
+
+        missing = self._fields - fields
+        if missing:
+            raise ValidationError(
+                'Partial aggregate is missing the following fields: %s'
+                % ', '.join(sorted(missing)))
+
+
+PartialAggregateDirectoryFormat = model.SingleFileDirectoryFormat(
+    'PartialAggregateDirectoryFormat', 'partial-aggregate.npz',
+    PartialAggregateFormat)
+
+
+class ResampledTablesFormat(model.BinaryFileFormat):
+    _datasets = {'data', 'indices', 'indptr', 'feature_ids', 'sample_ids'}
+    _attrs = {'sampling_depth', 'replacement'}
+
+    def _validate_(self, level):
+        try:
+            with h5py.File(str(self), 'r') as fh:
+                datasets = set(fh.keys())
+                attrs = set(fh.attrs.keys())
+        except OSError as e:
+            raise ValidationError(
+                'File is not a valid HDF5 file of resampled tables.') from e
+
+        missing = (self._datasets - datasets) | (self._attrs - attrs)
+        if missing:
+            raise ValidationError(
+                'Resampled tables are missing the following fields: %s'
+                % ', '.join(sorted(missing)))
+
+
+ResampledTablesDirectoryFormat = model.SingleFileDirectoryFormat(
+    'ResampledTablesDirectoryFormat', 'resampled-tables.h5',
+    ResampledTablesFormat)
+
+
+class NumpyArrayFormat(model.BinaryFileFormat):
+    def _validate_(self, level):
+        try:
+            np.load(str(self), mmap_mode='r', allow_pickle=False)
+        except (OSError, ValueError) as e:
+            raise ValidationError('File is not a valid .npy file.') from e
+
+
+class StackMetadataFormat(model.TextFileFormat):
+    def _validate_(self, level):
+        try:
+            with self.open() as fh:
+                metadata = json.load(fh)
+        except ValueError as e:
+            raise ValidationError('File is not valid JSON.') from e
+        if not isinstance(metadata, dict) or \
+                not isinstance(metadata.get('ids'), list):
+            raise ValidationError('Stack metadata must be a JSON object '
+                                  'with a list of ids.')
+
+
+class AlphaDiversityStackDirectoryFormat(model.DirectoryFormat):
+    values = model.File('alpha-diversities.npy', format=NumpyArrayFormat)
+    metadata = model.File('metadata.json', format=StackMetadataFormat)
+
+    def _validate_(self, level):
+        values = np.load(str(self.path / 'alpha-diversities.npy'),
+                         mmap_mode='r', allow_pickle=False)
+        with open(self.path / 'metadata.json') as fh:
+            ids = json.load(fh)['ids']
+        if values.ndim != 2 or values.shape[0] != len(ids):
+            raise ValidationError(
+                'Alpha diversities must be a two-dimensional array with one '
+                'row per sample id.')
+
+
+class DistanceMatrixStackDirectoryFormat(model.DirectoryFormat):
+    values = model.File('distance-matrices.npy', format=NumpyArrayFormat)
+    metadata = model.File('metadata.json', format=StackMetadataFormat)
+
+    def _validate_(self, level):
+        values = np.load(str(self.path / 'distance-matrices.npy'),
+                         mmap_mode='r', allow_pickle=False)
+        with open(self.path / 'metadata.json') as fh:
+            ids = json.load(fh)['ids']
+        num_pairs = len(ids) * (len(ids) - 1) // 2
+        if values.ndim != 2 or values.shape[1] != num_pairs:
+            raise ValidationError(
+                'Distance matrices must be a two-dimensional array with one '
+                'column per pair of ids.')
+        if values.dtype not in (np.float32, np.float64):
+            raise ValidationError(
+                'Distance matrices must be stored as float32 or float64, '
+                'not %s.' % values.dtype)
@@ -6,13 +6,21 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import zipfile
+
+import biom
 import numpy as np
+import pandas as pd
+import scipy.sparse
 from skbio import OrdinationResults
 from qiime2 import Metadata
 from q2_boots._alpha import (_validate_alpha_metric, _get_alpha_metric_action,
                              _alpha_collection_from_tables)
 from q2_boots._beta import (_validate_beta_metric, _get_beta_metric_action,
-                            _beta_collection_from_tables)
+                            _beta_collection_from_tables,
+                            _is_native_beta_metric,
+                            _native_table_distance_matrices)
+from q2_boots._cache import DiskCache, cache_key
 
 
 def kmer_diversity(ctx, table, sequences, sampling_depth, metadata, n,
@@ -22,7 +30,9 @@ def kmer_diversity(ctx, table, sequences, sampling_depth, metadata, n,
                    beta_average_method='non-metric-median', pc_dimensions=3,
                    color_by=None, norm='None',
                    alpha_metrics=['pielou_e', 'observed_features', 'shannon'],
-                   beta_metrics=['braycurtis', 'jaccard']):
+                   beta_metrics=['braycurtis', 'jaccard'],
+                   random_seed=None, kmer_buckets=None,
+                   precision='float64'):
 
     resample_action = ctx.get_action('boots', 'resample')
     kmerize_action = ctx.get_action('kmerizer', 'seqs_to_kmers')
@@ -35,37 +45,73 @@ def kmer_diversity(ctx, table, sequences, sampling_depth, metadata, n,
         _validate_alpha_metric(alpha_metric, phylogeny=None)
     for beta_metric in beta_metrics:
         _validate_beta_metric(beta_metric, phylogeny=None)
+    native_kmerization = _is_native_kmerization(tfidf, max_df, min_df,
+                                                max_features)
+    if kmer_buckets is not None and not native_kmerization:
+        raise ValueError('kmer_buckets can only be used if tfidf is False '
+                         'and max_df, min_df and max_features are left at '
+                         'their defaults.')
 
     resampled_tables, = resample_action(table=table,
                                         sampling_depth=sampling_depth,
                                         n=n,
-                                        replacement=replacement)
+                                        replacement=replacement,
+                                        random_seed=random_seed)
     kmer_tables = {}
-    for key, resampled_table in resampled_tables.items():
-        kmer_table, = kmerize_action(
-            sequences, resampled_table, kmer_size, tfidf, max_df, min_df,
-            max_features, norm)
-        kmer_tables[key] = kmer_table
+    if native_kmerization:
+        # the sequences are kmerized once, and each kmer table is then a
+        # projection of a resampled table
+        kmer_profiles = _get_kmer_profiles(
+            sequences.view(pd.Series).reindex(
+                table.view(biom.Table).ids(axis='observation')),
+            kmer_size, kmer_buckets)
+        for key, resampled_table in resampled_tables.items():
+            kmer_tables[key] = ctx.make_artifact(
+                'FeatureTable[Frequency]',
+                kmer_profiles.kmer_table(resampled_table.view(biom.Table)))
+    else:
+        for key, resampled_table in resampled_tables.items():
+            kmer_table, = kmerize_action(
+                sequences, resampled_table, kmer_size, tfidf, max_df, min_df,
+                max_features, norm)
+            kmer_tables[key] = kmer_table
 
     alpha_vectors = {}
     for alpha_metric in alpha_metrics:
         alpha_metric_action = _get_alpha_metric_action(
             ctx, alpha_metric, phylogeny=None)
         alpha_collection = _alpha_collection_from_tables(
-            kmer_tables, alpha_metric_action)
+            kmer_tables.values(), alpha_metric_action)
         avg_alpha_vector, = alpha_average_action(
             alpha_collection, alpha_average_method)
         alpha_vectors[alpha_metric] = avg_alpha_vector
         metadata = avg_alpha_vector.view(Metadata).merge(metadata)
 
+    # native beta diversity metrics are all computed from a single pass
+    # over each kmer table
+    native_beta_metrics = [beta_metric for beta_metric in beta_metrics
+                           if _is_native_beta_metric(beta_metric)]
+    native_beta_collections = {beta_metric: []
+                               for beta_metric in native_beta_metrics}
+    if native_beta_metrics:
+        for kmer_table in kmer_tables.values():
+            dms = _native_table_distance_matrices(
+                kmer_table.view(biom.Table), native_beta_metrics, precision)
+            for beta_metric, dm in dms.items():
+                native_beta_collections[beta_metric].append(
+                    ctx.make_artifact('DistanceMatrix', dm))
+
     beta_dms = {}
     for beta_metric in beta_metrics:
-        beta_metric_action = _get_beta_metric_action(
-            ctx, beta_metric, phylogeny=None)
-        beta_collection = _beta_collection_from_tables(
-            kmer_tables, beta_metric_action)
+        if beta_metric in native_beta_collections:
+            beta_collection = native_beta_collections[beta_metric]
+        else:
+            beta_metric_action = _get_beta_metric_action(
+                ctx, beta_metric, phylogeny=None)
+            beta_collection = _beta_collection_from_tables(
+                kmer_tables.values(), beta_metric_action)
         avg_beta_dm, = beta_average_action(
-            beta_collection, beta_average_method)
+            beta_collection, beta_average_method, precision=precision)
         beta_dms[beta_metric] = avg_beta_dm
 
     pcoas = {}
@@ -90,3 +136,139 @@ def kmer_diversity(ctx, table, sequences, sampling_depth, metadata, n,
 
     return (resampled_tables, kmer_tables, alpha_vectors,
             beta_dms, pcoas, scatter_plot)
+
+
+def _is_native_kmerization(tfidf, max_df, min_df, max_features):
+    # TF-IDF scores and document frequency filters depend on which features
+    # are in each resampled table, so those are left to q2-kmerizer
+    return (not tfidf and max_df == 1.0 and min_df == 1 and
+            max_features is None)
+
+
+def _get_kmer_profiles(sequences, kmer_size, buckets=None):
+    # Kmer profiles are read from (and added to) the on-disk cache, if it is
+    # enabled. Entries are keyed by the feature ids, their sequences,
+    # kmer_size and the number of buckets.
+    cache = DiskCache.from_environment('kmer-profiles')
+    if cache is None:
+        return _KmerProfiles.from_sequences(sequences, kmer_size, buckets)
+
+    key = cache_key(_KmerProfiles.version, str(kmer_size), str(buckets),
+                    *(part for feature_id, sequence in sequences.items()
+                      for part in (str(feature_id), str(sequence))))
+    path = cache.get(key)
+    if path is not None:
+        try:
+            return _KmerProfiles.load(path)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            # the entry is unreadable (e.g., it was truncated), so it is
+            # recomputed and replaced
+            pass
+    kmer_profiles = _KmerProfiles.from_sequences(sequences, kmer_size,
+                                                 buckets)
+    cache.put(key, kmer_profiles.save)
+    return kmer_profiles
+
+
+class _KmerProfiles:
+    """The number of times each kmer occurs in the sequence of each feature.
+
+    Kmers are the overlapping subsequences of length `kmer_size` of each
+    sequence, as in q2-kmerizer with `tfidf=False`. `matrix` is a sparse
+    matrix of shape (number of features, number of kmers).
+
+    If `buckets` is provided, kmers are instead mapped to that many buckets
+    using a hash of their sequence (i.e., the hashing trick), and `matrix`
+    holds the number of kmers in each bucket. Buckets are named
+    `kmer-bucket-<i>`.
+    """
+
+    # this should be incremented whenever the kmerization or the file
+    # format change, so that cached profiles are not reused
+    version = '1'
+
+    def __init__(self, matrix, feature_ids, kmer_ids):
+        self.matrix = matrix
+        self.feature_ids = pd.Index(feature_ids)
+        self.kmer_ids = np.asarray(kmer_ids)
+
+    @classmethod
+    def from_sequences(cls, sequences, kmer_size, buckets=None):
+        if sequences.isna().any():
+            missing = ', '.join(sequences.index[sequences.isna()][:5])
+            raise ValueError('All features in the table must have a '
+                             'sequence, but the following (and possibly '
+                             f'other) features do not: {missing}')
+
+        # Kmers are compared as raw bytes, using a (copy-free) sliding
+        # window over each sequence.
+        windows = [np.lib.stride_tricks.sliding_window_view(
+                       np.frombuffer(str(sequence).encode('ascii'),
+                                     dtype=np.uint8), kmer_size)
+                   if len(sequence) >= kmer_size
+                   else np.empty((0, kmer_size), dtype=np.uint8)
+                   for sequence in sequences]
+        rows = np.repeat(np.arange(len(windows)),
+                         [len(window) for window in windows])
+        kmers = np.ascontiguousarray(
+            np.concatenate(windows + [np.empty((0, kmer_size),
+                                               dtype=np.uint8)]))
+        kmers = kmers.view(np.dtype((np.void, kmer_size))).ravel()
+        unique_kmers, columns = np.unique(kmers, return_inverse=True)
+
+        if buckets is None:
+            num_columns = len(unique_kmers)
+            kmer_ids = [kmer.tobytes().decode('ascii')
+                        for kmer in unique_kmers]
+        else:
+            num_columns = buckets
+            kmer_ids = [f'kmer-bucket-{i}' for i in range(buckets)]
+            unique_kmers = unique_kmers.view(np.uint8).reshape(-1, kmer_size)
+            columns = (_fnv1a(unique_kmers) % np.uint64(buckets)).astype(
+                np.int64)[columns]
+
+        # duplicate (row, column) pairs are summed
+        matrix = scipy.sparse.csr_matrix(
+            (np.ones(len(columns), dtype=np.int64), (rows, columns)),
+            shape=(len(windows), num_columns))
+        return cls(matrix, sequences.index, kmer_ids)
+
+    def save(self, fh):
+        matrix = self.matrix.tocsr()
+        np.savez(fh, data=matrix.data, indices=matrix.indices,
+                 indptr=matrix.indptr, shape=matrix.shape,
+                 feature_ids=np.asarray(self.feature_ids, dtype=str),
+                 kmer_ids=np.asarray(self.kmer_ids, dtype=str))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            matrix = scipy.sparse.csr_matrix(
+                (data['data'], data['indices'], data['indptr']),
+                shape=tuple(data['shape']))
+            return cls(matrix, data['feature_ids'], data['kmer_ids'])
+
+    def kmer_table(self, table):
+        """Project `table` onto kmers, returning a kmer table.
+
+        Kmers that are not observed in `table` are not included.
+        """
+        rows = self.feature_ids.get_indexer(table.ids(axis='observation'))
+        kmer_counts = (self.matrix[rows].T @ table.matrix_data).tocsr()
+        kmer_counts.eliminate_zeros()
+        observed = kmer_counts.getnnz(axis=1) > 0
+        return biom.Table(kmer_counts[observed], self.kmer_ids[observed],
+                          table.ids(axis='sample'))
+
+
+def _fnv1a(data):
+    # 64-bit FNV-1a hash of each row of a uint8 array. Unlike Python's
+    # hash(), this is the same across processes and platforms, so buckets
+    # are stable.
+    hashes = np.full(len(data), 0xcbf29ce484222325, dtype=np.uint64)
+    prime = np.uint64(0x100000001b3)
+    with np.errstate(over='ignore'):
+        for column in data.T:
+            hashes ^= column.astype(np.uint64)
+            hashes *= prime
+    return hashes
@@ -0,0 +1,373 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, Caporaso Lab (https://cap-lab.bio).
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import functools
+import warnings
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import scipy.spatial.distance
+import skbio
+
+
+# Alpha diversity metrics that can be computed directly on a stack of
+# resampled tables, mapped to the names that q2-diversity-lib gives their
+# result vectors.
+NATIVE_ALPHA_METRICS = {'observed_features': 'observed_features',
+                        'shannon': 'shannon_entropy',
+                        'pielou_e': 'pielou_evenness',
+                        'faith_pd': 'faith_pd'}
+
+# Beta diversity metrics that can be computed directly on a stack of
+# resampled tables. weighted_unifrac is the unnormalized variant, as in
+# q2-diversity.
+NATIVE_BETA_METRICS = {'braycurtis', 'jaccard', 'unweighted_unifrac',
+                       'weighted_unifrac'}
+
+
+def alpha_diversities(counts, indptr, metrics, dtype=np.float64):
+    """Compute alpha diversity metrics for a stack of resampled tables.
+
+    `counts` is an array of shape (number of tables, number of non-zero
+    counts), and each of its rows holds the non-zero entries of a table in
+    CSC format (i.e., one column per sample), delimited by `indptr`. Every
+    sample must have at least one non-zero entry in the structure, but
+    individual counts may be zero.
+
+    All requested metrics are computed in a single pass, so the log terms
+    shared by shannon and pielou_e are only computed once.
+
+    Phylogenetic metrics are computed with `PhylogenyIndex` instead.
+
+    Proportions and entropies are computed as `dtype` (float64 or
+    float32).
+
+    Returns a dict mapping each metric in `metrics` to an array of shape
+    (number of tables, number of samples).
+    """
+    counts = np.asarray(counts, dtype=dtype)
+    starts = np.asarray(indptr[:-1])
+    present = counts > 0
+    observed = np.add.reduceat(present, starts, axis=1, dtype=np.int64)
+
+    results = {}
+    if 'observed_features' in metrics:
+        results['observed_features'] = observed
+    if 'shannon' in metrics or 'pielou_e' in metrics:
+        totals = np.add.reduceat(counts, starts, axis=1)
+        p = counts / np.repeat(totals, np.diff(indptr), axis=1)
+        log_p = np.log(p, out=np.zeros_like(p), where=present)
+        # subtracting from 0.0 avoids reporting -0.0 for single-feature
+        # samples
+        entropy = 0.0 - np.add.reduceat(p * log_p, starts, axis=1)
+        if 'shannon' in metrics:
+            results['shannon'] = entropy / counts.dtype.type(
+                _shannon_log_base())
+        if 'pielou_e' in metrics:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                evenness = entropy / np.log(observed, dtype=counts.dtype)
+            evenness[observed == 1] = _single_feature_pielou_e()
+            results['pielou_e'] = evenness
+    return results
+
+
+def beta_diversities(counts, indices, indptr, feature_ids, metrics,
+                     phylogeny=None, dtype=np.float64):
+    """Compute beta diversity metrics for a stack of resampled tables.
+
+    `counts`, `indices` and `indptr` describe the stack as in
+    `alpha_diversities`, and `feature_ids` are the IDs of the rows of the
+    tables. `phylogeny` is a `PhylogenyIndex`, and is required for
+    phylogenetic metrics. Distances are computed as `dtype` (float64 or
+    float32).
+
+    Returns a dict mapping each metric in `metrics` to an array of shape
+    (number of tables, number of pairs of samples), where each row is the
+    condensed form of a distance matrix.
+    """
+    results = {}
+    nonphylogenetic_metrics = [metric for metric in metrics
+                               if metric in ('braycurtis', 'jaccard')]
+    if nonphylogenetic_metrics:
+        results.update(_nonphylogenetic_beta_diversities(
+            counts, indices, indptr, nonphylogenetic_metrics, dtype))
+    unifrac_metrics = [metric for metric in metrics
+                       if metric in ('unweighted_unifrac', 'weighted_unifrac')]
+    if unifrac_metrics:
+        results.update(phylogeny.unifrac(counts, indices, indptr,
+                                         feature_ids, unifrac_metrics,
+                                         dtype))
+    return results
+
+
+def _nonphylogenetic_beta_diversities(counts, indices, indptr, metrics,
+                                      dtype=np.float64):
+    # Each table is converted to a sparse matrix (with one row per sample)
+    # once, and all metrics are computed from it.
+    counts = np.asarray(counts, dtype=dtype)
+    num_samples = len(indptr) - 1
+    features, rows = np.unique(indices, return_inverse=True)
+    columns = np.repeat(np.arange(num_samples), np.diff(indptr))
+
+    results = {metric: [] for metric in metrics}
+    for data in counts:
+        table = scipy.sparse.csr_matrix(
+            (data, (columns, rows)), shape=(num_samples, len(features)))
+        table.eliminate_zeros()
+        if 'jaccard' in metrics:
+            results['jaccard'].append(_jaccard(table))
+        if 'braycurtis' in metrics:
+            results['braycurtis'].append(_braycurtis(table))
+    return {metric: np.array(values, dtype=dtype).reshape(len(counts), -1)
+            for metric, values in results.items()}
+
+
+def _jaccard(table):
+    # Jaccard distances are computed from presence/absence, as in
+    # q2-diversity, so the sizes of all intersections of pairs of samples
+    # are the product of the binary table with its transpose.
+    present = (table > 0).astype(table.dtype)
+    intersections = (present @ present.T).toarray()
+    sizes = np.diag(intersections)
+    unions = sizes[:, np.newaxis] + sizes[np.newaxis, :] - intersections
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distances = np.where(unions > 0, 1.0 - intersections / unions,
+                             0.0).astype(table.dtype, copy=False)
+    np.fill_diagonal(distances, 0.0)
+    return scipy.spatial.distance.squareform(distances, checks=False)
+
+
+def _braycurtis(table):
+    sums, distances = _l1_distances(table)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return distances / sums
+
+
+def _l1_distances(table):
+    # Returns sum(u) + sum(v) and sum(|u - v|) for each pair of rows u and v
+    # of a sparse (CSR) table, in condensed order. Each row u is compared
+    # with all of the following rows at once, using only the non-zero
+    # values of the table: the non-zero values of v contribute |v - u|, and
+    # the columns where only u is non-zero contribute u, which is sum(u)
+    # less u summed over the non-zero columns of v. Both sums of u are
+    # accumulated in the same (column) order, so the distance of identical
+    # rows is exactly zero.
+    num_rows = table.shape[0]
+    totals = np.asarray(table.sum(axis=1)).ravel()
+    rows = np.repeat(np.arange(num_rows), np.diff(table.indptr))
+    row = np.zeros(table.shape[1], dtype=table.dtype)
+    sums = [np.zeros(0, dtype=totals.dtype)]
+    distances = [np.zeros(0)]
+    for i in range(num_rows - 1):
+        start, stop = table.indptr[i], table.indptr[i + 1]
+        row[table.indices[start:stop]] = table.data[start:stop]
+        others = rows[stop:] - (i + 1)
+        u = row[table.indices[stop:]]
+        u_total = np.bincount(np.zeros(stop - start, dtype=np.int64),
+                              weights=table.data[start:stop], minlength=1)
+        differences = np.bincount(
+            others, weights=np.abs(table.data[stop:] - u),
+            minlength=num_rows - i - 1)
+        shared_u = np.bincount(others, weights=u, minlength=num_rows - i - 1)
+        # rounding can leave u_total slightly below shared_u
+        distances.append(differences + np.maximum(u_total - shared_u, 0.0))
+        sums.append(totals[i] + totals[i + 1:])
+        row[table.indices[start:stop]] = 0
+    return np.concatenate(sums), np.concatenate(distances)
+
+
+class PhylogenyIndex:
+    """Index of a phylogeny for computing phylogenetic diversity in batches.
+
+    The index is built with a single preorder traversal of the tree, so it
+    only needs to be built once for all of the resampled tables (and all
+    phylogenetic metrics) of an analysis. It holds the branch length of each
+    node, the range of tips (in preorder) below each node, the distance from
+    the root to each tip, and a sparse table for range minimum queries over
+    the depths of the lowest common ancestors (LCAs) of consecutive tips in
+    preorder. The length of the root branch is not included in any distance.
+    """
+
+    def __init__(self, tree):
+        nodes = list(tree.preorder(include_self=True))
+        node_indices = {id(node): i for i, node in enumerate(nodes)}
+        parents = np.zeros(len(nodes), dtype=np.int64)
+        lengths = np.zeros(len(nodes))
+        depths = np.zeros(len(nodes))
+        for i, node in enumerate(nodes[1:], start=1):
+            parents[i] = node_indices[id(node.parent)]
+            lengths[i] = node.length or 0.0
+            depths[i] = depths[parents[i]] + lengths[i]
+
+        is_tip = np.array([node.is_tip() for node in nodes])
+        tips = np.flatnonzero(is_tip)
+        self.tip_names = pd.Index([nodes[i].name for i in tips])
+        self.tip_depths = depths[tips]
+
+        # The subtree of a node is contiguous in preorder, and so are the
+        # tips below it.
+        num_tips = is_tip.astype(np.int64)
+        for i in range(len(nodes) - 1, 0, -1):
+            num_tips[parents[i]] += num_tips[i]
+        self._first_tips = np.cumsum(is_tip) - is_tip
+        self._stop_tips = self._first_tips + num_tips
+        self._lengths = lengths
+
+        # The node that follows a tip in preorder is the root of the
+        # subtree holding the next tip, so its parent is the LCA of both.
+        lca_depths = depths[parents[tips[:-1] + 1]]
+        levels = [lca_depths]
+        while 2 ** len(levels) <= len(lca_depths):
+            half = 2 ** (len(levels) - 1)
+            levels.append(np.minimum(levels[-1][:-half], levels[-1][half:]))
+        self._lca_depths = np.full((len(levels), len(lca_depths)), np.inf)
+        for level, values in enumerate(levels):
+            self._lca_depths[level, :len(values)] = values
+
+    def faith_pd(self, counts, indices, indptr, feature_ids):
+        """Compute Faith's PD for a stack of resampled tables.
+
+        `counts`, `indices` and `indptr` describe the stack as in
+        `alpha_diversities`, and `feature_ids` are the IDs of the rows of
+        the tables. The branch length spanned by a set of tips sorted in
+        preorder is the sum of their depths, minus the depth of the LCA of
+        each pair of consecutive tips.
+
+        Returns an array of shape (number of tables, number of samples).
+        """
+        counts = np.asarray(counts)
+        num_samples = len(indptr) - 1
+        positions = self._tip_positions(feature_ids, indices)
+        columns = np.repeat(np.arange(num_samples), np.diff(indptr))
+        order = np.lexsort((positions, columns))
+        positions, columns = positions[order], columns[order]
+
+        tables, entries = np.nonzero(counts[:, order] > 0)
+        positions = positions[entries]
+        groups = tables * num_samples + columns[entries]
+        branch_lengths = self.tip_depths[positions]
+        same_sample = groups[1:] == groups[:-1]
+        branch_lengths[1:][same_sample] -= self._lca_depth(
+            positions[:-1][same_sample], positions[1:][same_sample])
+        return np.bincount(
+            groups, weights=branch_lengths,
+            minlength=len(counts) * num_samples).reshape(len(counts), -1)
+
+    def unifrac(self, counts, indices, indptr, feature_ids, metrics,
+                dtype=np.float64):
+        """Compute UniFrac distances for a stack of resampled tables.
+
+        `counts`, `indices`, `indptr` and `feature_ids` are as in
+        `faith_pd`. The counts below each node of the tree are computed once
+        per table, as the product of a sparse matrix of the features below
+        each node with the sparse table, and are shared by
+        unweighted_unifrac and (unnormalized) weighted_unifrac. Distances
+        are computed as `dtype`.
+
+        Returns a dict as `beta_diversities` does.
+        """
+        counts = np.asarray(counts, dtype=dtype)
+        num_samples = len(indptr) - 1
+        positions = self._tip_positions(feature_ids, indices)
+        # the rows of the tables are the features in the stack, sorted in
+        # preorder
+        tip_positions, rows = np.unique(positions, return_inverse=True)
+        columns = np.repeat(np.arange(num_samples), np.diff(indptr))
+
+        # only the branches (excluding the root) above at least one of the
+        # features are relevant, and the features below each of them are a
+        # contiguous range of rows
+        starts = np.searchsorted(tip_positions, self._first_tips)
+        stops = np.searchsorted(tip_positions, self._stop_tips)
+        nodes = np.flatnonzero(stops > starts)
+        nodes = nodes[nodes != 0]
+        starts, stops, lengths = starts[nodes], stops[nodes], \
+            self._lengths[nodes].astype(dtype)
+        sizes = stops - starts
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        below = scipy.sparse.csr_matrix(
+            (np.ones(offsets[-1], dtype=dtype),
+             np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], sizes),
+             offsets),
+            shape=(len(nodes), len(tip_positions)))
+
+        results = {metric: [] for metric in metrics}
+        for data in counts:
+            table = scipy.sparse.csc_matrix(
+                (data, (rows, columns)),
+                shape=(len(tip_positions), num_samples))
+            table.eliminate_zeros()
+            # a sparse matrix of shape (number of nodes, number of samples)
+            node_counts = below @ table
+            if 'unweighted_unifrac' in metrics:
+                results['unweighted_unifrac'].append(
+                    _unweighted_unifrac(node_counts, lengths))
+            if 'weighted_unifrac' in metrics:
+                totals = np.asarray(table.sum(axis=0)).ravel()
+                results['weighted_unifrac'].append(
+                    _weighted_unifrac(node_counts, totals, lengths))
+        return {metric: np.array(values, dtype=dtype).reshape(len(counts), -1)
+                for metric, values in results.items()}
+
+    def _tip_positions(self, feature_ids, indices):
+        positions = self.tip_names.get_indexer(feature_ids)[indices]
+        if (positions < 0).any():
+            raise ValueError('The table does not appear to be completely '
+                             'represented by the phylogeny.')
+        return positions
+
+    def _lca_depth(self, a, b):
+        # depth of the LCA of tips a < b, i.e., the minimum LCA depth of
+        # consecutive tips in a..b
+        level = np.log2(b - a).astype(np.int64)
+        return np.minimum(self._lca_depths[level, a],
+                          self._lca_depths[level, b - 2 ** level])
+
+
+def _unweighted_unifrac(node_counts, lengths):
+    # The branch length unique to one of two samples is the length of their
+    # union less the shared length, and shared lengths of all pairs of
+    # samples are a single (sparse) matrix product.
+    present = (node_counts > 0).astype(lengths.dtype)
+    totals = present.T @ lengths
+    shared = (present.T @ (scipy.sparse.diags(lengths) @ present)).toarray()
+    union = totals[:, np.newaxis] + totals[np.newaxis, :] - shared
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distances = np.where(union > 0, (union - shared) / union,
+                             0.0).astype(lengths.dtype, copy=False)
+    np.fill_diagonal(distances, 0.0)
+    return scipy.spatial.distance.squareform(distances, checks=False)
+
+
+def _weighted_unifrac(node_counts, totals, lengths):
+    # sum(l * |u - v|) over branches, where u and v are the proportions of
+    # two samples below each branch, is the L1 distance of l * u and l * v,
+    # computed from the sparse table with one row per sample.
+    weighted = (scipy.sparse.diags(lengths) @ node_counts @
+                scipy.sparse.diags(1 / totals)).T.tocsr()
+    weighted.eliminate_zeros()
+    _, distances = _l1_distances(weighted)
+    return distances
+
+
+@functools.cache
+def _shannon_log_base():
+    # The default base of skbio's shannon changed from 2 to e in
+    # scikit-bio 0.6, so the base is taken from the installed version to
+    # match the results of q2-diversity.
+    return np.log(2) / skbio.diversity.alpha.shannon(np.array([1, 1]))
+
+
+@functools.cache
+def _single_feature_pielou_e():
+    # Evenness is undefined for a sample with a single feature. Older
+    # versions of scikit-bio return nan, and newer versions return 1.0.
+    with warnings.catch_warnings(), np.errstate(all='ignore'):
+        warnings.simplefilter('ignore')
+        return skbio.diversity.alpha.pielou_e(np.array([1]))
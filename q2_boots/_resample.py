@@ -6,14 +6,521 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
-def resample(ctx, table, sampling_depth, n, replacement):
-    rarefy_action = ctx.get_action('feature_table', 'rarefy')
-    resampled_tables = []
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import io
+import itertools
+import math
 
-    for i in range(n):
-        resampled_table, = rarefy_action(table=table,
-                                         sampling_depth=sampling_depth,
-                                         with_replacement=replacement)
-        resampled_tables.append(resampled_table)
+import biom
+import h5py
+import numpy as np
+import scipy.sparse
 
-    return {f'resampled-table-{i}': t for i, t in enumerate(resampled_tables)}
+from q2_boots._cache import DiskCache, cache_key
+from q2_boots._type import ResampledTables
+
+# the largest number of bytes of resampled counts that are held in memory
+# at once when resampled tables are processed in stacks. Counts are stored
+# compactly, but stacks are sized by the dtype they are computed on (see
+# `_stack_size`), since that is what the metrics hold in memory.
+_STACK_BYTES = 2 ** 27
+
+# this should be incremented whenever the resampling or the format of cached
+# resampled counts change, so that cached draws are not reused
+_RESAMPLE_CACHE_VERSION = '2'
+
+# the largest number of resampled counts per chunk of a stored stack of
+# resampled tables
+_STORED_CHUNK_SIZE = 2 ** 18
+
+# the largest number of iterations drawn by a worker process per task when
+# resampling in parallel. At most two tasks per worker are in flight at once,
+# so this bounds the number of drawn iterations held in memory.
+_WORKER_CHUNK_SIZE = 16
+
+
+def resample(ctx, table, sampling_depth, n, replacement, n_jobs=1,
+             random_seed=None, existing_tables=None):
+    result = _existing_results(existing_tables, n)
+    resampled_tables = _resampled_table_artifacts(
+        ctx, table, sampling_depth, n, replacement, random_seed, n_jobs,
+        start=len(result))
+    result = dict(result)
+    for i, t in enumerate(resampled_tables, start=len(result)):
+        result[f'resampled-table-{i}'] = t
+    return result
+
+
+def _existing_results(existing, n):
+    # Results of a previous run are extended to n iterations by computing
+    # only iterations len(existing) to n - 1, whose seeds continue the
+    # random number streams of the previous run.
+    if existing is None:
+        return {}
+    if len(existing) > n:
+        raise ValueError(f'The existing collection already contains '
+                         f'{len(existing)} results, which is more than the '
+                         f'requested number of iterations (n={n}).')
+    return existing
+
+
+def _resampled_table_artifacts(ctx, table, sampling_depth, n, replacement,
+                               random_seed=None, n_jobs=1, start=0):
+    # Resampled tables are drawn lazily, so callers that consume them one at
+    # a time only ever hold a single resampled table in memory.
+    for stack in _table_stacks(table, sampling_depth, n, replacement,
+                               random_seed, start, n_jobs):
+        for i in range(len(stack)):
+            yield ctx.make_artifact('FeatureTable[Frequency]',
+                                    stack.table(i))
+
+
+def _table_stacks(table, sampling_depth, n, replacement, random_seed=None,
+                  start=0, n_jobs=1, dtype=np.float64):
+    # Stacks of the resampled tables of iterations start to n - 1 of the
+    # `table` artifact. That is either a feature table, which is resampled
+    # here, or ResampledTables, whose stored resampled tables are read.
+    # Stacks are sized for being computed on as `dtype`.
+    if table.type <= ResampledTables:
+        stacked_tables = table.view(StackedTables)
+        stacked_tables.validate(sampling_depth, n, replacement, random_seed)
+        return stacked_tables.stacks.select(start, n, dtype)
+    seeds = _iteration_seeds(random_seed, n, start)
+    return _resampled_stacks(table.view(biom.Table), sampling_depth,
+                             replacement, seeds, n_jobs,
+                             cache=random_seed is not None, dtype=dtype)
+
+
+class _ResampledStack:
+    """Resampled tables of consecutive iterations.
+
+    Every non-zero count of a resampled table is also non-zero in the input
+    table, so a stack of resampled tables is stored as a single array of
+    shape (number of tables, number of non-zero counts in the input table),
+    aligned with `indices` and `indptr` of the input table in CSC format
+    (i.e., with one column per sample). Resampled counts are stored as the
+    smallest unsigned integer type that can hold the sampling depth (see
+    `_count_dtype`).
+    """
+
+    def __init__(self, data, indices, indptr, feature_ids, sample_ids):
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.feature_ids = feature_ids
+        self.sample_ids = sample_ids
+
+    @classmethod
+    def from_table(cls, table):
+        """Create a stack holding only `table`."""
+        matrix = scipy.sparse.csc_matrix(table.matrix_data)
+        matrix.eliminate_zeros()
+        return cls(matrix.data[np.newaxis], matrix.indices, matrix.indptr,
+                   table.ids(axis='observation'), table.ids(axis='sample'))
+
+    def __len__(self):
+        return len(self.data)
+
+    def table(self, i):
+        shape = (len(self.feature_ids), len(self.sample_ids))
+        # counts are stored as compact integers, but biom.Table frequencies
+        # are float64
+        resampled = scipy.sparse.csc_matrix(
+            (self.data[i], self.indices, self.indptr), shape=shape,
+            dtype=np.float64, copy=True)
+        resampled.eliminate_zeros()
+        observed = np.asarray(resampled.sum(axis=1)).ravel() > 0
+        return biom.Table(resampled[observed], self.feature_ids[observed],
+                          self.sample_ids)
+
+
+class StackedTables:
+    """A collection of resampled tables, stored as a single stack.
+
+    The resampled tables are provided by `stacks`, an iterable of
+    `_ResampledStack` that share the structure of the input table, which is
+    drawn from lazily when the collection is saved. In an HDF5 file, the
+    resampled counts of all tables are a single chunked and compressed
+    dataset of shape (number of tables, number of non-zero counts in the
+    input table), and the sample and feature IDs are stored once.
+    """
+
+    def __init__(self, stacks, sampling_depth, replacement, random_seed=None):
+        self.stacks = stacks
+        self.sampling_depth = sampling_depth
+        self.replacement = replacement
+        self.random_seed = random_seed
+
+    def validate(self, sampling_depth, n, replacement, random_seed=None):
+        """Raise ValueError if these are not n of the stored tables."""
+        if sampling_depth != self.sampling_depth or \
+                replacement != self.replacement:
+            raise ValueError(
+                f'The resampled tables were drawn with a sampling depth of '
+                f'{self.sampling_depth} and replacement='
+                f'{self.replacement}, but a sampling depth of '
+                f'{sampling_depth} and replacement={replacement} were '
+                f'requested.')
+        if random_seed is not None and random_seed != self.random_seed:
+            raise ValueError(
+                f'The resampled tables were drawn with random seed '
+                f'{self.random_seed}, but random seed {random_seed} was '
+                f'requested.')
+        if n > len(self.stacks):
+            raise ValueError(
+                f'{n} resampled tables were requested, but only '
+                f'{len(self.stacks)} are stored.')
+
+    def save(self, path):
+        with h5py.File(path, 'w') as fh:
+            fh.attrs['sampling_depth'] = self.sampling_depth
+            fh.attrs['replacement'] = self.replacement
+            if self.random_seed is not None:
+                fh.attrs['random_seed'] = self.random_seed
+            data = None
+            for stack in self.stacks:
+                if data is None:
+                    num_counts = stack.data.shape[1]
+                    data = fh.create_dataset(
+                        'data', shape=(0, num_counts),
+                        maxshape=(None, num_counts), dtype=stack.data.dtype,
+                        chunks=(1, min(num_counts, _STORED_CHUNK_SIZE)),
+                        compression='gzip', shuffle=True)
+                    fh.create_dataset('indices', data=stack.indices)
+                    fh.create_dataset('indptr', data=stack.indptr)
+                    fh.create_dataset(
+                        'feature_ids', data=list(stack.feature_ids),
+                        dtype=h5py.string_dtype())
+                    fh.create_dataset(
+                        'sample_ids', data=list(stack.sample_ids),
+                        dtype=h5py.string_dtype())
+                data.resize(len(data) + len(stack), axis=0)
+                data[-len(stack):] = stack.data
+
+    @classmethod
+    def load(cls, path):
+        with h5py.File(path, 'r') as fh:
+            random_seed = fh.attrs.get('random_seed')
+            return cls(_StoredStacks(path), int(fh.attrs['sampling_depth']),
+                       bool(fh.attrs['replacement']),
+                       None if random_seed is None else int(random_seed))
+
+
+def resample_stacked(table: biom.Table, sampling_depth: int, n: int,
+                     replacement: bool, n_jobs: int = 1,
+                     random_seed: int = None) -> StackedTables:
+    seeds = _iteration_seeds(random_seed, n)
+    stacks = _resampled_stacks(table, sampling_depth, replacement, seeds,
+                               n_jobs, cache=random_seed is not None)
+    return StackedTables(stacks, sampling_depth, replacement, random_seed)
+
+
+class _StoredStacks:
+    """The stacks of resampled tables start to stop - 1 in an HDF5 file.
+
+    Stacks are read from the file as they are iterated over, so only a
+    single stack is held in memory at a time.
+    """
+
+    def __init__(self, path, start=0, stop=None,
+                 max_stack_bytes=_STACK_BYTES, dtype=np.float64):
+        self.path = path
+        self.start = start
+        if stop is None:
+            with h5py.File(path, 'r') as fh:
+                stop = len(fh['data'])
+        self.stop = stop
+        self.max_stack_bytes = max_stack_bytes
+        self.dtype = dtype
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def select(self, start, stop, dtype=np.float64):
+        return _StoredStacks(self.path, self.start + start,
+                             self.start + stop, self.max_stack_bytes, dtype)
+
+    def __iter__(self):
+        with h5py.File(self.path, 'r') as fh:
+            data = fh['data']
+            indices = fh['indices'][:]
+            indptr = fh['indptr'][:]
+            feature_ids = fh['feature_ids'].asstr()[:].astype(object)
+            sample_ids = fh['sample_ids'].asstr()[:].astype(object)
+            stack_size = _stack_size(data.shape[1], self.max_stack_bytes,
+                                     self.dtype)
+            for i in range(self.start, self.stop, stack_size):
+                yield _ResampledStack(data[i:min(i + stack_size, self.stop)],
+                                      indices, indptr, feature_ids,
+                                      sample_ids)
+
+
+def _resampled_stacks(table, sampling_depth, replacement, seeds, n_jobs=1,
+                      max_stack_bytes=_STACK_BYTES, cache=False,
+                      dtype=np.float64):
+    # This mirrors feature_table.rarefy: samples with fewer than
+    # sampling_depth observations are dropped, and features that are not
+    # observed in a resampled table are removed from that table.
+    # If cache is True, resampled counts are read from (and added to) the
+    # on-disk cache, if it is enabled. Callers should only pass cache=True if
+    # seeds were derived from a user-provided random seed, since unseeded
+    # draws are never repeated.
+    # Stacks are sized for being computed on as `dtype`.
+    sample_ids = table.ids(axis='sample')
+    feature_ids = table.ids(axis='observation')
+    matrix = scipy.sparse.csc_matrix(table.matrix_data)
+    matrix.eliminate_zeros()
+
+    keep = np.asarray(matrix.sum(axis=0)).ravel() >= sampling_depth
+    if not keep.any():
+        raise ValueError('The rarefied table contains no samples or '
+                         'features. Verify your table is valid and that you '
+                         'provided a shallow enough sampling depth.')
+    matrix = matrix[:, keep]
+    sample_ids = sample_ids[keep]
+
+    # Counts are resampled as integers, so e.g. relative frequencies would
+    # silently be truncated (or rounded up, when sampling with replacement).
+    if (matrix.data < 0).any() or (matrix.data % 1 != 0).any():
+        raise ValueError('The table must contain non-negative integer '
+                         'counts (i.e., a FeatureTable[Frequency]) to be '
+                         'resampled.')
+    counts = matrix.data.astype(np.int64)
+    indices, indptr = _compact_indices(matrix.indices, matrix.indptr)
+
+    if cache:
+        subsampled_counts = _cached_subsamples(
+            counts, indices, indptr, feature_ids, sample_ids,
+            sampling_depth, replacement, seeds, n_jobs)
+    else:
+        subsampled_counts = _draw_subsamples(
+            counts, indptr, sampling_depth, replacement, seeds, n_jobs)
+    stack_size = _stack_size(len(counts), max_stack_bytes, dtype)
+    while stack := list(itertools.islice(subsampled_counts, stack_size)):
+        yield _ResampledStack(np.stack(stack), indices, indptr, feature_ids,
+                              sample_ids)
+
+
+def _stack_size(num_counts, max_stack_bytes, dtype=np.float64):
+    # The number of resampled tables of num_counts counts per stack. Counts
+    # are stored compactly (see `_count_dtype`), but metrics convert stacks
+    # to `dtype` and build temporaries of that size, so stacks are sized by
+    # the itemsize of `dtype` rather than by their storage.
+    row_bytes = num_counts * np.dtype(dtype).itemsize
+    return max(1, max_stack_bytes // (row_bytes or 1))
+
+
+def _count_dtype(sampling_depth):
+    # no resampled count can exceed the sampling depth, so counts are stored
+    # as the smallest unsigned integer type that can hold it
+    return np.min_scalar_type(sampling_depth)
+
+
+def _compact_indices(indices, indptr):
+    # sparse indices are stored as int32 unless there are too many non-zero
+    # counts to index with it
+    if len(indices) <= np.iinfo(np.int32).max:
+        return indices.astype(np.int32), indptr.astype(np.int32)
+    return indices.astype(np.int64), indptr.astype(np.int64)
+
+
+def _iteration_seeds(random_seed, n, start=0):
+    # One child stream is derived per iteration, so the draws for an
+    # iteration depend only on random_seed and the iteration's index. The
+    # seeds of iterations start to n - 1 are returned.
+    return np.random.SeedSequence(random_seed).spawn(n)[start:]
+
+
+def _cached_subsamples(counts, indices, indptr, feature_ids, sample_ids,
+                       sampling_depth, replacement, seeds, n_jobs):
+    # A cache entry holds the resampled counts of iterations 0 to m - 1 of a
+    # table, sampling depth, replacement setting and random seed, as an
+    # (m, len(counts)) .npy file. Iterations that are in the entry are read
+    # from it, only the others are drawn, and the entry is extended if the
+    # requested iterations continue it. The entry is written as the
+    # iterations are yielded, so they are never all held in memory, and if
+    # the caller stops early (e.g., because results converged), the entry
+    # is truncated to the iterations that were yielded.
+    cache = DiskCache.from_environment('resampled-counts')
+    iterations = _spawn_indices(seeds)
+    if cache is None or iterations is None:
+        yield from _draw_subsamples(counts, indptr, sampling_depth,
+                                    replacement, seeds, n_jobs)
+        return
+
+    key = cache_key(_RESAMPLE_CACHE_VERSION, counts.tobytes(),
+                    indices.tobytes(), indptr.tobytes(),
+                    '\t'.join(map(str, feature_ids)),
+                    '\t'.join(map(str, sample_ids)), str(sampling_depth),
+                    str(replacement), str(seeds[0].entropy))
+    dtype = _count_dtype(sampling_depth)
+    cached = _load_cached_counts(cache.get(key), len(counts), dtype)
+    drawn = _draw_subsamples(
+        counts, indptr, sampling_depth, replacement,
+        [seed for seed, i in zip(seeds, iterations) if i >= len(cached)],
+        n_jobs)
+
+    first, stop = iterations[0], iterations[-1] + 1
+    if (first > len(cached) or stop <= len(cached) or
+            iterations != list(range(first, stop))):
+        for i in iterations:
+            yield cached[i] if i < len(cached) else next(drawn)
+        return
+
+    header = _npy_header((stop, len(counts)), dtype)
+    with cache.open_entry(key) as fh:
+        fh.write(header)
+        fh.write(np.ascontiguousarray(cached[:first]).tobytes())
+        num_written = first
+        for i in iterations:
+            subsampled = cached[i] if i < len(cached) else next(drawn)
+            fh.write(np.ascontiguousarray(subsampled).tobytes())
+            num_written += 1
+            try:
+                yield subsampled
+            except GeneratorExit:
+                truncated_header = _npy_header((num_written, len(counts)),
+                                               dtype)
+                # the header can only be replaced in place if it is the
+                # same size
+                if (num_written <= len(cached) or
+                        len(truncated_header) != len(header)):
+                    raise
+                fh.seek(0)
+                fh.write(truncated_header)
+                return
+
+
+def _npy_header(shape, dtype):
+    fh = io.BytesIO()
+    np.lib.format.write_array_header_1_0(fh, {
+        'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+        'fortran_order': False, 'shape': shape})
+    return fh.getvalue()
+
+
+def _spawn_indices(seeds):
+    # the iteration indices of seeds spawned from a single SeedSequence (as
+    # by _iteration_seeds), or None if they were not
+    if not seeds or any(seed.entropy != seeds[0].entropy or
+                        len(seed.spawn_key) != 1 for seed in seeds):
+        return None
+    return [seed.spawn_key[0] for seed in seeds]
+
+
+def _load_cached_counts(path, num_counts, dtype):
+    empty = np.empty((0, num_counts), dtype=dtype)
+    if path is None:
+        return empty
+    try:
+        cached = np.load(path, mmap_mode='r', allow_pickle=False)
+    except (OSError, ValueError):
+        # the entry is unreadable (e.g., it was truncated), so it is redrawn
+        # and replaced
+        return empty
+    if cached.dtype != dtype or cached.shape[1:] != (num_counts,):
+        return empty
+    return cached
+
+
+def _draw_subsamples(counts, indptr, sampling_depth, replacement, seeds,
+                     n_jobs):
+    # Iterations are independent and each has its own random number stream,
+    # so they can be drawn one at a time, or split across worker processes
+    # in chunks, without changing the result. Chunks are returned in
+    # iteration order.
+    if n_jobs == 1 or len(seeds) == 1:
+        for seed in seeds:
+            yield from _subsample_counts(
+                counts, indptr, sampling_depth, replacement, [seed])
+        return
+
+    chunk_size = min(math.ceil(len(seeds) / (4 * n_jobs)), _WORKER_CHUNK_SIZE)
+    chunks = (seeds[i:i + chunk_size]
+              for i in range(0, len(seeds), chunk_size))
+    with ProcessPoolExecutor(
+            max_workers=n_jobs, initializer=_init_subsample_worker,
+            initargs=(counts, indptr, sampling_depth, replacement)) as pool:
+        # unlike pool.map, which submits every chunk up front, only a window
+        # of chunks is submitted at a time, so results that the caller has
+        # not consumed yet do not accumulate
+        pending = collections.deque(
+            pool.submit(_subsample_worker, chunk)
+            for chunk in itertools.islice(chunks, 2 * n_jobs))
+        while pending:
+            result = pending.popleft().result()
+            for chunk in itertools.islice(chunks, 1):
+                pending.append(pool.submit(_subsample_worker, chunk))
+            yield from result
+
+
+_worker_state = {}
+
+
+def _init_subsample_worker(counts, indptr, sampling_depth, replacement):
+    _worker_state.update(counts=counts, indptr=indptr,
+                         sampling_depth=sampling_depth,
+                         replacement=replacement)
+
+
+def _subsample_worker(seeds):
+    return _subsample_counts(seeds=seeds, **_worker_state)
+
+
+def _subsample_counts(counts, indptr, sampling_depth, replacement, seeds):
+    """Draw one subsample of `sampling_depth` from each sample per seed.
+
+    `counts` and `indptr` describe the non-zero entries of each sample (i.e.,
+    column) of a CSC matrix. Each sample is split recursively into halves,
+    and the number of observations drawn from the left half is sampled from
+    a hypergeometric (without replacement) or binomial (with replacement)
+    distribution conditioned on the number drawn from the whole. This yields
+    exact multivariate hypergeometric or multinomial draws while only
+    requiring ~log2(features per sample) vectorized calls per iteration,
+    each covering all samples.
+
+    Each iteration draws only from the random number generator created from
+    its own entry in `seeds` (e.g., a `np.random.SeedSequence`), so the
+    result for an iteration does not depend on which other iterations are
+    drawn alongside it.
+
+    Returns an array of shape (len(seeds), len(counts)) where row `i` holds
+    the resampled counts of iteration `i`, aligned with `counts`, as the
+    dtype given by `_count_dtype`.
+    """
+    rngs = [np.random.default_rng(seed) for seed in seeds]
+    cumulative_counts = np.concatenate([[0], np.cumsum(counts)])
+    result = np.zeros((len(rngs), len(counts)),
+                      dtype=_count_dtype(sampling_depth))
+
+    starts = np.asarray(indptr[:-1], dtype=np.int64)
+    stops = np.asarray(indptr[1:], dtype=np.int64)
+    draws = np.full((len(rngs), len(starts)), sampling_depth,
+                    dtype=np.int64)
+
+    while True:
+        single = (stops - starts) == 1
+        result[:, starts[single]] = draws[:, single]
+        starts, stops, draws = starts[~single], stops[~single], \
+            draws[:, ~single]
+        if len(starts) == 0:
+            break
+
+        mids = (starts + stops) // 2
+        left = cumulative_counts[mids] - cumulative_counts[starts]
+        right = cumulative_counts[stops] - cumulative_counts[mids]
+        if replacement:
+            p = left / (left + right)
+            left_draws = [rng.binomial(d, p) for rng, d in zip(rngs, draws)]
+        else:
+            left_draws = [rng.hypergeometric(left, right, d)
+                          for rng, d in zip(rngs, draws)]
+        left_draws = np.asarray(left_draws, dtype=np.int64).reshape(
+            draws.shape)
+
+        starts = np.concatenate([starts, mids])
+        stops = np.concatenate([mids, stops])
+        draws = np.hstack([left_draws, draws - left_draws])
+
+    return result
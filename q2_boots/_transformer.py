@@ -0,0 +1,66 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, Caporaso Lab (https://cap-lab.bio).
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from .plugin_setup import plugin
+from ._aggregate import PartialAggregate
+from ._collection import StackedAlphaDiversities, StackedDistanceMatrices
+from ._format import (PartialAggregateFormat, ResampledTablesFormat,
+                      AlphaDiversityStackDirectoryFormat,
+                      DistanceMatrixStackDirectoryFormat)
+from ._resample import StackedTables
+
+
+@plugin.register_transformer
+def _1(data: PartialAggregate) -> PartialAggregateFormat:
+    ff = PartialAggregateFormat()
+    with ff.open() as fh:
+        data.save(fh)
+    return ff
+
+
+@plugin.register_transformer
+def _2(ff: PartialAggregateFormat) -> PartialAggregate:
+    return PartialAggregate.load(str(ff))
+
+
+@plugin.register_transformer
+def _3(data: StackedTables) -> ResampledTablesFormat:
+    ff = ResampledTablesFormat()
+    data.save(str(ff))
+    return ff
+
+
+@plugin.register_transformer
+def _4(ff: ResampledTablesFormat) -> StackedTables:
+    return StackedTables.load(str(ff))
+
+
+@plugin.register_transformer
+def _5(data: StackedAlphaDiversities
+       ) -> AlphaDiversityStackDirectoryFormat:
+    ff = AlphaDiversityStackDirectoryFormat()
+    data.save(str(ff))
+    return ff
+
+
+@plugin.register_transformer
+def _6(ff: AlphaDiversityStackDirectoryFormat) -> StackedAlphaDiversities:
+    return StackedAlphaDiversities.load(str(ff))
+
+
+@plugin.register_transformer
+def _7(data: StackedDistanceMatrices
+       ) -> DistanceMatrixStackDirectoryFormat:
+    ff = DistanceMatrixStackDirectoryFormat()
+    data.save(str(ff))
+    return ff
+
+
+@plugin.register_transformer
+def _8(ff: DistanceMatrixStackDirectoryFormat) -> StackedDistanceMatrices:
+    return StackedDistanceMatrices.load(str(ff))
@@ -0,0 +1,25 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, Caporaso Lab (https://cap-lab.bio).
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from qiime2.plugin import SemanticType
+
+from q2_types.sample_data import SampleData
+
+
+AlphaDiversityPartialAggregate = SemanticType(
+    'AlphaDiversityPartialAggregate', variant_of=SampleData.field['type'])
+
+AlphaDiversityStack = SemanticType(
+    'AlphaDiversityStack', variant_of=SampleData.field['type'])
+
+DistanceMatrixPartialAggregate = SemanticType(
+    'DistanceMatrixPartialAggregate')
+
+DistanceMatrixStack = SemanticType('DistanceMatrixStack')
+
+ResampledTables = SemanticType('ResampledTables')
@@ -6,6 +6,8 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import importlib
+
 from qiime2.plugin import (Plugin, Int, Range, Collection, Str, Choices, Bool,
                            Float, Metadata, Visualization, Citations, List)
 
@@ -25,6 +27,17 @@ from q2_types.distance_matrix import DistanceMatrix
 from q2_types.ordination import PCoAResults
 
 import q2_boots
+from q2_boots._type import (AlphaDiversityPartialAggregate,
+                            AlphaDiversityStack,
+                            DistanceMatrixPartialAggregate,
+                            DistanceMatrixStack, ResampledTables)
+from q2_boots._format import (PartialAggregateFormat,
+                              PartialAggregateDirectoryFormat,
+                              ResampledTablesFormat,
+                              ResampledTablesDirectoryFormat,
+                              NumpyArrayFormat, StackMetadataFormat,
+                              AlphaDiversityStackDirectoryFormat,
+                              DistanceMatrixStackDirectoryFormat)
 from q2_boots._examples import (_resample_bootstrap_example,
                                 _resample_rarefaction_example,
                                 _alpha_rarefaction_example,
@@ -50,6 +63,34 @@ plugin = Plugin(
     citations=[citations['Raspet2025']]
 )
 
+plugin.register_formats(PartialAggregateFormat,
+                        PartialAggregateDirectoryFormat,
+                        ResampledTablesFormat,
+                        ResampledTablesDirectoryFormat,
+                        NumpyArrayFormat, StackMetadataFormat,
+                        AlphaDiversityStackDirectoryFormat,
+                        DistanceMatrixStackDirectoryFormat)
+plugin.register_semantic_types(AlphaDiversityPartialAggregate,
+                               AlphaDiversityStack,
+                               DistanceMatrixPartialAggregate,
+                               DistanceMatrixStack,
+                               ResampledTables)
+plugin.register_semantic_type_to_format(
+    SampleData[AlphaDiversityPartialAggregate],
+    artifact_format=PartialAggregateDirectoryFormat)
+plugin.register_semantic_type_to_format(
+    DistanceMatrixPartialAggregate,
+    artifact_format=PartialAggregateDirectoryFormat)
+plugin.register_semantic_type_to_format(
+    ResampledTables,
+    artifact_format=ResampledTablesDirectoryFormat)
+plugin.register_semantic_type_to_format(
+    SampleData[AlphaDiversityStack],
+    artifact_format=AlphaDiversityStackDirectoryFormat)
+plugin.register_semantic_type_to_format(
+    DistanceMatrixStack,
+    artifact_format=DistanceMatrixStackDirectoryFormat)
+
 
 _feature_table_description = 'The input feature table.'
 _phylogeny_description = (
@@ -66,7 +107,71 @@ _n_description = 'The number of resampled tables that should be generated.'
 _replacement_description = (
     'Resample `table` with replacement (i.e., bootstrap) or without '
     'replacement (i.e., rarefaction).')
+_n_jobs_description = (
+    'The number of processes to use for resampling. Each iteration draws '
+    'from its own independent random number stream, and resampled tables '
+    'are returned in iteration order regardless of the number of '
+    'processes.')
+_random_seed_description = (
+    'Seed for the random number generator. A separate random number stream '
+    'is derived from this seed for each of the `n` iterations, so runs with '
+    'the same seed and parameters produce identical results, however the '
+    'iterations are split across processes. If not provided, a random seed '
+    'is used. If a seed is provided and the Q2_BOOTS_CACHE_DIR environment '
+    'variable is set, resampled tables are cached in its `q2-boots` '
+    'subdirectory, and reused by later runs (of this or other q2-boots '
+    'actions) on the same table with the same `sampling_depth`, '
+    '`replacement` and seed. The cache '
+    'is limited to Q2_BOOTS_CACHE_MAX_BYTES bytes (4 GiB by default), and '
+    'the least recently used entries are removed first.')
 _resampled_tables_description = 'The `n` resampled tables.'
+_convergence_parameters = {
+    'convergence_tolerance': Float % Range(0, None),
+    'convergence_batch_size': Int % Range(1, None)
+}
+_convergence_parameter_descriptions = {
+    'convergence_tolerance': (
+        'If provided, `n` is the largest number of iterations, and '
+        'iterations are run in batches of `convergence_batch_size` until no '
+        'value of any running average (i.e., an alpha diversity value of a '
+        'sample, or a distance between two samples) changed by more than '
+        'this between two consecutive batches. The running average is '
+        'computed with the requested average method, except that the '
+        'per-cell mean is used for the medoid methods. Running medians are '
+        'only checked for a fixed random subset of 256 values (or all '
+        'values, if there are fewer). The final average is computed from '
+        'the results of all iterations that were run, and their number is '
+        'recorded in the provenance of the averages (e.g., as the `n` '
+        'parameter of `alpha-average-stacked` or `beta-average-stacked`).'),
+    'convergence_batch_size': (
+        'The number of iterations between convergence checks. Ignored if '
+        '`convergence_tolerance` is not provided.')
+}
+_precision_parameters = {
+    'precision': Str % Choices('float64', 'float32')
+}
+_precision_parameter_descriptions = {
+    'precision': (
+        'The floating point precision that diversity values are computed '
+        'and averaged in, and that stacked results are stored in. float32 '
+        'halves memory use and the size of stacked results, and keeps about '
+        'seven significant digits, which is ample for averages over '
+        'resampled tables. Metrics that are computed by '
+        'q2-diversity rather than by q2-boots itself are always computed in '
+        'float64. Averages are always returned as float64.')
+}
+_existing_results_description = (
+    'The results of an earlier run of this action on the same input, with '
+    'the same parameters and `random_seed` but a smaller `n`. If provided, '
+    'only the remaining iterations are computed, continuing the random '
+    'number streams of the earlier run, and they are added to these '
+    'results. The parameters of the earlier run are not checked, so it is '
+    'up to the user to make sure they match.')
+_existing_partial_aggregate_description = (
+    'A partial aggregate of results computed earlier from the same samples, '
+    'for example on the first iterations of a collection that was later '
+    'extended. If provided, only `data` is aggregated, and the average '
+    'covers both the partial aggregate and `data`.')
 _pc_dimensions_description = (
     'Number of principal coordinate dimensions to present in the 2D '
     'scatterplot.')
@@ -80,23 +185,29 @@ _scatter_plot_description = (
 # Resampling
 
 _resample_inputs = {
-    'table': FeatureTable[Frequency]
+    'table': FeatureTable[Frequency],
+    'existing_tables': Collection[FeatureTable[Frequency]]
 }
 _resample_parameters = {
     'sampling_depth': Int % Range(1, None),
     'n': Int % Range(1, None),
-    'replacement': Bool
+    'replacement': Bool,
+    'n_jobs': Int % Range(1, None),
+    'random_seed': Int % Range(0, None)
 }
 _resample_outputs = {
     'resampled_tables': Collection[FeatureTable[Frequency]]
 }
 _resample_input_descriptions = {
-    'table': _feature_table_description
+    'table': _feature_table_description,
+    'existing_tables': _existing_results_description
 }
 _resample_parameter_descriptions = {
     'sampling_depth': _sampling_depth_description,
     'n': _n_description,
-    'replacement': _replacement_description
+    'replacement': _replacement_description,
+    'n_jobs': _n_jobs_description,
+    'random_seed': _random_seed_description
 }
 _resample_output_descriptions = {
     'resampled_tables': _resampled_tables_description
@@ -122,8 +233,32 @@ plugin.pipelines.register_function(
     }
 )
 
+plugin.methods.register_function(
+    function=q2_boots.resample_stacked,
+    inputs={'table': FeatureTable[Frequency]},
+    parameters=_resample_parameters,
+    outputs={'resampled_tables': ResampledTables},
+    input_descriptions={'table': _feature_table_description},
+    parameter_descriptions=_resample_parameter_descriptions,
+    output_descriptions={
+        'resampled_tables': ('The `n` resampled tables, stored in a single '
+                             'artifact.')
+    },
+    name='Resample feature table, returning `n` feature tables in a single '
+         'artifact.',
+    description=('Resample `table` to `sampling_depth` total observations '
+                 'with replacement (i.e., bootstrapping) or without '
+                 'replacement (i.e., rarefaction) `n` times, as `resample` '
+                 'does. The resampled tables are stored together in a '
+                 'single compressed HDF5 file that shares the sample and '
+                 'feature IDs of all tables, rather than as `n` separate '
+                 'artifacts, which is much faster to write and read for '
+                 'large `n`. The result can be passed as the `table` of '
+                 '`alpha-collection` and `beta-collection`.')
+)
+
 _diversity_inputs = {
-    'table': FeatureTable[Frequency | RelativeFrequency | PresenceAbsence],
+    'table': FeatureTable[Frequency],
     'phylogeny': Phylogeny[Rooted]
 }
 
@@ -132,6 +267,20 @@ _diversity_input_descriptions = {
     'phylogeny': _phylogeny_description
 }
 
+_collection_inputs = {
+    **_diversity_inputs,
+    'table': FeatureTable[Frequency] | ResampledTables
+}
+
+_collection_input_descriptions = {
+    **_diversity_input_descriptions,
+    'table': ('The input feature table, or resampled tables from '
+              '`resample-stacked`. If resampled tables are provided, the '
+              'first `n` of them are used rather than resampling, and '
+              '`sampling_depth`, `replacement` and `random_seed` (if '
+              'provided) must match the values they were drawn with.')
+}
+
 _alpha_average_parameters = {
     'average_method': Str % Choices('mean', 'median')
 }
@@ -140,20 +289,45 @@ _alpha_average_parameter_descriptions = {
     'average_method': 'Method to use for averaging.'
 }
 
+_stacked_average_n_description = (
+    'The number of results to average, i.e., the first `n` of those in '
+    '`data`. If not provided, all of them are averaged. When this action is '
+    'run by a pipeline with `convergence_tolerance`, this is the number of '
+    'iterations that were run before the average converged.')
+
 _average_alpha_diversity_description = (
     'The average alpha diversity vector.')
 
+_sketch_capacity_description = (
+    'The size of the quantile sketch used to compute medians. At most about '
+    'three times this many values are retained per sample (alpha diversity) '
+    'or pair of samples (beta diversity), regardless of the number of '
+    'results aggregated. Medians are exact if no more than this many '
+    'results are aggregated in total, and approximate otherwise, with a '
+    'rank error on the order of one over this value (e.g., the value '
+    'returned is typically within a few percentiles of the true median for '
+    'a sketch size of 32). Larger values give more accurate medians at the '
+    'cost of larger partial aggregates.')
+_partial_aggregate_description = (
+    'A partial aggregate that can be merged with others, computed on '
+    'other subsets of iterations, to compute the final average.')
+_partial_aggregates_description = (
+    'Partial aggregates to be merged. These must have been computed on the '
+    'same samples.')
+
 plugin.methods.register_function(
     function=q2_boots.alpha_average,
     inputs={
-        'data': Collection[SampleData[AlphaDiversity]]
+        'data': Collection[SampleData[AlphaDiversity]],
+        'partial_aggregate': SampleData[AlphaDiversityPartialAggregate]
     },
     parameters=_alpha_average_parameters,
     outputs={
         'average_alpha_diversity': SampleData[AlphaDiversity]
     },
     input_descriptions={
-        'data': 'Alpha diversity vectors to be averaged.'
+        'data': 'Alpha diversity vectors to be averaged.',
+        'partial_aggregate': _existing_partial_aggregate_description
     },
     output_descriptions={
         'average_alpha_diversity': _average_alpha_diversity_description
@@ -165,6 +339,83 @@ plugin.methods.register_function(
                  'diversity vectors computed from the same samples.')
 )
 
+plugin.methods.register_function(
+    function=q2_boots.alpha_average_stacked,
+    inputs={
+        'data': SampleData[AlphaDiversityStack]
+    },
+    parameters={
+        **_alpha_average_parameters,
+        'n': Int % Range(1, None)
+    },
+    outputs={
+        'average_alpha_diversity': SampleData[AlphaDiversity]
+    },
+    input_descriptions={
+        'data': 'Stacked alpha diversity vectors to be averaged.'
+    },
+    output_descriptions={
+        'average_alpha_diversity': _average_alpha_diversity_description
+    },
+    parameter_descriptions={
+        **_alpha_average_parameter_descriptions,
+        'n': _stacked_average_n_description
+    },
+    name='Average stacked alpha diversity vectors.',
+    description=('Compute the per-sample average across alpha diversity '
+                 'vectors stored in a single artifact (e.g., by '
+                 '`alpha-collection-stacked`), as `alpha-average` does for '
+                 'a collection of alpha diversity vectors.')
+)
+
+plugin.methods.register_function(
+    function=q2_boots.alpha_partial_aggregate,
+    inputs={
+        'data': Collection[SampleData[AlphaDiversity]]
+    },
+    parameters={'sketch_capacity': Int % Range(2, None)},
+    outputs={
+        'partial_aggregate': SampleData[AlphaDiversityPartialAggregate]
+    },
+    input_descriptions={
+        'data': 'Alpha diversity vectors to be aggregated.'
+    },
+    output_descriptions={
+        'partial_aggregate': _partial_aggregate_description
+    },
+    parameter_descriptions={'sketch_capacity': _sketch_capacity_description},
+    name='Partially aggregate alpha diversity vectors.',
+    description=('Summarize a collection of alpha diversity vectors computed '
+                 'from the same samples, for example on one of several '
+                 'machines that each ran a subset of the iterations, so that '
+                 'the summaries can later be merged into a single average '
+                 'with `alpha-merge-aggregates`.')
+)
+
+plugin.methods.register_function(
+    function=q2_boots.alpha_merge_aggregates,
+    inputs={
+        'aggregates': Collection[SampleData[AlphaDiversityPartialAggregate]]
+    },
+    parameters=_alpha_average_parameters,
+    outputs={
+        'average_alpha_diversity': SampleData[AlphaDiversity]
+    },
+    input_descriptions={
+        'aggregates': _partial_aggregates_description
+    },
+    output_descriptions={
+        'average_alpha_diversity': _average_alpha_diversity_description
+    },
+    parameter_descriptions=_alpha_average_parameter_descriptions,
+    name='Merge partial aggregates of alpha diversity vectors.',
+    description=('Merge any number of partial aggregates of alpha diversity '
+                 'vectors and compute the per-sample average across all of '
+                 'the alpha diversity vectors they summarize. Means are '
+                 'exact, and medians are exact unless more than '
+                 '`sketch-capacity` vectors were aggregated in total.')
+)
+
 _alpha_collection_parameters = {
     'sampling_depth': Int % Range(1, None),
     'metric': Str % Choices(alpha_metrics['NONPHYLO']['IMPL'] |
@@ -172,22 +423,32 @@ _alpha_collection_parameters = {
                             alpha_metrics['PHYLO']['IMPL'] |
                             alpha_metrics['PHYLO']['UNIMPL']),
     'n': Int % Range(1, None),
-    'replacement': Bool
+    'replacement': Bool,
+    'random_seed': Int % Range(0, None),
+    **_precision_parameters
 }
 
 _alpha_collection_parameter_descriptions = {
     'sampling_depth': _sampling_depth_description,
     'metric': 'The alpha diversity metric to be computed.',
     'n': _n_description,
-    'replacement': _replacement_description
+    'replacement': _replacement_description,
+    'random_seed': _random_seed_description,
+    **_precision_parameter_descriptions
 }
 
 plugin.pipelines.register_function(
     function=q2_boots.alpha_collection,
-    inputs=_diversity_inputs,
+    inputs={
+        **_collection_inputs,
+        'existing_alpha_diversities': Collection[SampleData[AlphaDiversity]]
+    },
     parameters=_alpha_collection_parameters,
     outputs={'alpha_diversities': Collection[SampleData[AlphaDiversity]]},
-    input_descriptions=_diversity_input_descriptions,
+    input_descriptions={
+        **_collection_input_descriptions,
+        'existing_alpha_diversities': _existing_results_description
+    },
     parameter_descriptions=_alpha_collection_parameter_descriptions,
     output_descriptions={
         'alpha_diversities': ('`n` alpha diversity vectors, each containing '
@@ -205,9 +466,35 @@ plugin.pipelines.register_function(
                  )
 )
 
-_alpha_parameters = _alpha_collection_parameters | _alpha_average_parameters
+plugin.pipelines.register_function(
+    function=q2_boots.alpha_collection_stacked,
+    inputs=_collection_inputs,
+    parameters=_alpha_collection_parameters,
+    outputs={'alpha_diversities': SampleData[AlphaDiversityStack]},
+    input_descriptions=_collection_input_descriptions,
+    parameter_descriptions=_alpha_collection_parameter_descriptions,
+    output_descriptions={
+        'alpha_diversities': ('`n` alpha diversity vectors, stored as a '
+                              'single samples by iterations array.'),
+    },
+    name=('Perform resampled alpha diversity, returning `n` result vectors '
+          'in a single artifact.'),
+    description=('Given a single feature table as input, this action '
+                 'resamples the feature table `n` times to a total '
+                 'frequency of `sampling depth` per sample, and then '
+                 'computes the specified alpha diversity metric on each '
+                 'resulting `table`, as `alpha-collection` does. The '
+                 'results are stored in a single artifact rather than as '
+                 '`n` separate artifacts, which is much faster to write and '
+                 'read for large `n`, and can be averaged with '
+                 '`alpha-average-stacked`.')
+)
+
+_alpha_parameters = (_alpha_collection_parameters | _alpha_average_parameters |
+                     _convergence_parameters)
 _alpha_parameter_descriptions = (_alpha_collection_parameter_descriptions |
-                                 _alpha_average_parameter_descriptions)
+                                 _alpha_average_parameter_descriptions |
+                                 _convergence_parameter_descriptions)
 
 plugin.pipelines.register_function(
     function=q2_boots.alpha,
@@ -233,25 +520,38 @@ plugin.pipelines.register_function(
     }
 )
 
+_beta_average_methods = ['non-metric-mean', 'non-metric-median', 'medoid',
+                         'approx-medoid']
+
 _beta_average_parameters = {
-    'average_method': Str % Choices(['non-metric-mean',
-                                     'non-metric-median',
-                                     'medoid'])
+    'average_method': Str % Choices(_beta_average_methods),
+    **_precision_parameters
 }
 
 _beta_average_parameter_descriptions = {
-    'average_method': 'Method to use for averaging.'
+    'average_method': ('Method to use for averaging. `approx-medoid` '
+                       'shortlists candidate medoids using a random '
+                       'projection of the distance matrices, and returns '
+                       'the candidate with the smallest exact sum of '
+                       'distances. It is much faster than `medoid` for '
+                       'large data sets or large values of `n`, but may not '
+                       'return the exact medoid.'),
+    **_precision_parameter_descriptions
 }
 
 plugin.methods.register_function(
     function=q2_boots.beta_average,
     inputs={
         'data': Collection[DistanceMatrix],
+        'partial_aggregate': DistanceMatrixPartialAggregate
     },
     parameters=_beta_average_parameters,
     outputs={'average_distance_matrix': DistanceMatrix},
     input_descriptions={
-        'data': 'Distance matrices to be average.'
+        'data': 'Distance matrices to be average.',
+        'partial_aggregate': (_existing_partial_aggregate_description +
+                              ' Only the non-metric average methods can be '
+                              'used with a partial aggregate.')
     },
     output_descriptions={
         'average_distance_matrix': 'The average distance matrix.',
@@ -262,6 +562,111 @@ plugin.methods.register_function(
                  'distance matrices.')
 )
 
+plugin.methods.register_function(
+    function=q2_boots.beta_average_stacked,
+    inputs={
+        'data': DistanceMatrixStack
+    },
+    parameters={
+        **_beta_average_parameters,
+        'n': Int % Range(1, None)
+    },
+    outputs={'average_distance_matrix': DistanceMatrix},
+    input_descriptions={
+        'data': 'Stacked distance matrices to be averaged.'
+    },
+    output_descriptions={
+        'average_distance_matrix': 'The average distance matrix.',
+    },
+    parameter_descriptions={
+        **_beta_average_parameter_descriptions,
+        'n': _stacked_average_n_description
+    },
+    name='Average stacked beta diversity distance matrices.',
+    description=('Compute the average distance matrix across distance '
+                 'matrices stored in a single artifact (e.g., by '
+                 '`beta-collection-stacked`), as `beta-average` does for a '
+                 'collection of distance matrices. The stored distance '
+                 'matrices are read in blocks of pairs of samples, so they '
+                 'are never all loaded into memory.')
+)
+
+plugin.methods.register_function(
+    function=q2_boots.beta_variance,
+    inputs={
+        'data': Collection[DistanceMatrix],
+    },
+    parameters={},
+    outputs={'variance_distance_matrix': DistanceMatrix},
+    input_descriptions={
+        'data': 'Distance matrices to compute the per-cell variance of.'
+    },
+    output_descriptions={
+        'variance_distance_matrix': ('The per-cell sample variance of the '
+                                     'distance matrices. Note that the '
+                                     'values are variances of distances, '
+                                     'not distances.'),
+    },
+    parameter_descriptions={},
+    name='Per-cell variance of beta diversity distance matrices.',
+    description=('Compute the variance of each pairwise distance across a '
+                 'collection of distance matrices. Distance matrices are '
+                 'processed one at a time, so memory use does not depend on '
+                 'the size of the collection.')
+)
+
+plugin.methods.register_function(
+    function=q2_boots.beta_partial_aggregate,
+    inputs={
+        'data': Collection[DistanceMatrix],
+    },
+    parameters={'sketch_capacity': Int % Range(2, None)},
+    outputs={'partial_aggregate': DistanceMatrixPartialAggregate},
+    input_descriptions={
+        'data': 'Distance matrices to be aggregated.'
+    },
+    output_descriptions={
+        'partial_aggregate': _partial_aggregate_description,
+    },
+    parameter_descriptions={'sketch_capacity': _sketch_capacity_description},
+    name='Partially aggregate beta diversity distance matrices.',
+    description=('Summarize a collection of distance matrices computed from '
+                 'the same samples, for example on one of several machines '
+                 'that each ran a subset of the iterations, so that the '
+                 'summaries can later be merged into a single average with '
+                 '`beta-merge-aggregates`.')
+)
+
+plugin.methods.register_function(
+    function=q2_boots.beta_merge_aggregates,
+    inputs={
+        'aggregates': Collection[DistanceMatrixPartialAggregate],
+    },
+    parameters={
+        'average_method': Str % Choices('non-metric-mean',
+                                        'non-metric-median')
+    },
+    outputs={'average_distance_matrix': DistanceMatrix},
+    input_descriptions={
+        'aggregates': _partial_aggregates_description
+    },
+    output_descriptions={
+        'average_distance_matrix': 'The average distance matrix.',
+    },
+    parameter_descriptions={
+        'average_method': ('Method to use for averaging. The medoid cannot '
+                           'be computed from partial aggregates, so only the '
+                           'non-metric methods are available.')
+    },
+    name='Merge partial aggregates of beta diversity distance matrices.',
+    description=('Merge any number of partial aggregates of distance '
+                 'matrices and compute the average distance matrix across '
+                 'all of the distance matrices they summarize. Means are '
+                 'exact, and medians are exact unless more than '
+                 '`sketch-capacity` distance matrices were aggregated in '
+                 'total.')
+)
+
 _beta_collection_parameters = {
                 'metric': Str % Choices(beta_metrics['NONPHYLO']['IMPL'] |
                                         beta_metrics['NONPHYLO']['UNIMPL'] |
@@ -273,7 +678,9 @@ _beta_collection_parameters = {
                 'sampling_depth': Int % Range(1, None),
                 'bypass_tips': Bool,
                 'variance_adjusted': Bool,
-                'alpha': Float % Range(0, 1, inclusive_end=True)
+                'alpha': Float % Range(0, 1, inclusive_end=True),
+                'random_seed': Int % Range(0, None),
+                **_precision_parameters
 }
 
 _beta_collection_parameter_descriptions = {
@@ -291,16 +698,24 @@ _beta_collection_parameter_descriptions = {
     'variance_adjusted': ('Perform variance adjustment based on Chang et al. '
                           'BMC Bioinformatics (2011) for phylogenetic '
                           'diversity metrics.'),
-    'alpha': ('The alpha value used with the generalized UniFrac metric.')
+    'alpha': ('The alpha value used with the generalized UniFrac metric.'),
+    'random_seed': _random_seed_description,
+    **_precision_parameter_descriptions
 }
 
 
 plugin.pipelines.register_function(
     function=q2_boots.beta_collection,
-    inputs=_diversity_inputs,
+    inputs={
+        **_collection_inputs,
+        'existing_distance_matrices': Collection[DistanceMatrix]
+    },
     parameters=_beta_collection_parameters,
     outputs={'distance_matrices': Collection[DistanceMatrix]},
-    input_descriptions=_diversity_input_descriptions,
+    input_descriptions={
+        **_collection_input_descriptions,
+        'existing_distance_matrices': _existing_results_description
+    },
     output_descriptions={
         'distance_matrices': ('`n` beta diversity distance matrices, each '
                               'containing distances between all pairs of '
@@ -321,9 +736,36 @@ plugin.pipelines.register_function(
     }
 )
 
-_beta_parameters = _beta_collection_parameters | _beta_average_parameters
+plugin.pipelines.register_function(
+    function=q2_boots.beta_collection_stacked,
+    inputs=_collection_inputs,
+    parameters=_beta_collection_parameters,
+    outputs={'distance_matrices': DistanceMatrixStack},
+    input_descriptions=_collection_input_descriptions,
+    output_descriptions={
+        'distance_matrices': ('`n` beta diversity distance matrices, stored '
+                              'as a single iterations by pairs of samples '
+                              'array.')
+    },
+    parameter_descriptions=_beta_collection_parameter_descriptions,
+    name=('Perform resampled beta diversity, returning `n` distance '
+          'matrices in a single artifact.'),
+    description=('Given a single feature table as input, this action '
+                 'resamples the feature table `n` times to a total frequency '
+                 'of `sampling depth` per sample, and then computes the '
+                 'specified beta diversity metric on each resulting `table`, '
+                 'as `beta-collection` does. The condensed forms of the '
+                 'distance matrices are stored as the rows of a single '
+                 'memory-mappable array, with one shared list of sample ids, '
+                 'rather than as `n` separate artifacts, and can be averaged '
+                 'with `beta-average-stacked`.')
+)
+
+_beta_parameters = (_beta_collection_parameters | _beta_average_parameters |
+                    _convergence_parameters)
 _beta_parameter_descriptions = (_beta_collection_parameter_descriptions |
-                                _beta_average_parameter_descriptions)
+                                _beta_average_parameter_descriptions |
+                                _convergence_parameter_descriptions)
 
 plugin.pipelines.register_function(
     function=q2_boots.beta,
@@ -353,12 +795,13 @@ plugin.pipelines.register_function(
         'n': Int % Range(1, None),
         'sampling_depth': Int % Range(1, None),
         'alpha_average_method': Str % Choices('mean', 'median'),
-        'beta_average_method': Str % Choices('non-metric-mean',
-                                             'non-metric-median',
-                                             'medoid'),
+        'beta_average_method': Str % Choices(_beta_average_methods),
         'replacement': Bool,
         'pc_dimensions': Int,
-        'color_by': Str
+        'color_by': Str,
+        'random_seed': Int % Range(0, None),
+        **_convergence_parameters,
+        **_precision_parameters
     },
     outputs=[
         ('resampled_tables', Collection[FeatureTable[Frequency]]),
@@ -377,7 +820,10 @@ plugin.pipelines.register_function(
         'beta_average_method': 'Method to use for averaging beta diversity.',
         'replacement': _replacement_description,
         'pc_dimensions': _pc_dimensions_description,
-        'color_by': _color_by_description
+        'color_by': _color_by_description,
+        'random_seed': _random_seed_description,
+        **_convergence_parameter_descriptions,
+        **_precision_parameter_descriptions
     },
     output_descriptions={
         'resampled_tables': _resampled_tables_description,
@@ -425,9 +871,7 @@ plugin.pipelines.register_function(
                                 beta_metrics['NONPHYLO']['IMPL'] |
                                 beta_metrics['NONPHYLO']['UNIMPL'])],
         'alpha_average_method': Str % Choices('mean', 'median'),
-        'beta_average_method': Str % Choices('non-metric-mean',
-                                             'non-metric-median',
-                                             'medoid'),
+        'beta_average_method': Str % Choices(_beta_average_methods),
         'replacement': Bool,
         'kmer_size': Int,
         'tfidf': Bool,
@@ -437,8 +881,11 @@ plugin.pipelines.register_function(
                                 inclusive_end=False) | Int,
         'max_features': Int,
         'norm': Str % Choices(['None', 'l1', 'l2']),
+        'kmer_buckets': Int % Range(1, None),
         'pc_dimensions': Int,
-        'color_by': Str
+        'color_by': Str,
+        'random_seed': Int % Range(0, None),
+        **_precision_parameters
     },
     outputs=[
         ('resampled_tables', Collection[FeatureTable[Frequency]]),
@@ -475,8 +922,21 @@ plugin.pipelines.register_function(
         'norm': 'Normalization procedure applied to TF-IDF scores. Ignored '
                 'if tfidf=False. l2: Sum of squares of vector elements is 1. '
                 'l1: Sum of absolute values of vector elements is 1.',
+        'kmer_buckets': ('If provided, kmers are mapped to this many '
+                         'buckets by hashing them (i.e., the hashing '
+                         'trick), and the kmer tables count kmers per '
+                         'bucket. This bounds the number of features in '
+                         'each kmer table, and with it memory use, at the '
+                         'cost of collisions: with k distinct kmers, a '
+                         'fraction of about 1 - exp(-k / kmer_buckets) of '
+                         'them share their bucket with another kmer (e.g., '
+                         'about 10% if there are ten times as many buckets '
+                         'as kmers). Cannot be used with tfidf, max_df, '
+                         'min_df or max_features.'),
         'pc_dimensions': _pc_dimensions_description,
-        'color_by': _color_by_description
+        'color_by': _color_by_description,
+        'random_seed': _random_seed_description,
+        **_precision_parameter_descriptions
     },
     output_descriptions={
         'resampled_tables': _resampled_tables_description,
@@ -498,9 +958,17 @@ plugin.pipelines.register_function(
                  '`beta_average_method` parameters. The resulting average '
                  'alpha and beta diversity artifacts are returned, along with '
                  'a scatter plot integrated all alpha diversity metrics and '
-                 'the PCoA axes for all beta diversity metrics.'),
+                 'the PCoA axes for all beta diversity metrics. If the '
+                 'Q2_BOOTS_CACHE_DIR environment variable is set, the kmer '
+                 'profiles of the sequences are cached in its `q2-boots` '
+                 'subdirectory and reused by later runs with the same '
+                 'sequences and `kmer_size`. The cache is limited to '
+                 'Q2_BOOTS_CACHE_MAX_BYTES bytes (4 GiB by default), and '
+                 'the least recently used entries are removed first.'),
     examples={
         'Bootstrapped kmer diversity': _kmer_diversity_bootstrap_example
         },
     citations=[citations['Bokulich2024']]
 )
+
+importlib.import_module('q2_boots._transformer')
@@ -0,0 +1,230 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, Caporaso Lab (https://cap-lab.bio).
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import io
+from unittest import TestCase
+
+import numpy as np
+import numpy.testing as npt
+
+from q2_boots._aggregate import (RunningMoments, QuantileSketch,
+                                 PartialAggregate, ConvergenceMonitor,
+                                 merge_partial_aggregates)
+
+
+class RunningMomentsTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.values = np.random.default_rng(0).random((7, 5))
+
+    def test_mean_and_variance(self):
+        moments = RunningMoments()
+        for v in self.values:
+            moments.update(v)
+
+        self.assertEqual(moments.count, 7)
+        npt.assert_allclose(moments.mean, self.values.mean(axis=0))
+        npt.assert_allclose(moments.variance,
+                            self.values.var(axis=0, ddof=1))
+
+    def test_single_update(self):
+        moments = RunningMoments()
+        moments.update(self.values[0])
+
+        npt.assert_array_equal(moments.mean, self.values[0])
+        npt.assert_array_equal(moments.variance, np.zeros(5))
+
+    def test_merge(self):
+        moments1 = RunningMoments()
+        for v in self.values[:3]:
+            moments1.update(v)
+        moments2 = RunningMoments()
+        for v in self.values[3:]:
+            moments2.update(v)
+        moments1.merge(moments2)
+
+        self.assertEqual(moments1.count, 7)
+        npt.assert_allclose(moments1.mean, self.values.mean(axis=0))
+        npt.assert_allclose(moments1.variance,
+                            self.values.var(axis=0, ddof=1))
+
+
+class QuantileSketchTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.values = np.random.default_rng(0).random((1000, 5))
+
+    def test_median_exact(self):
+        for n in (1, 2, 7, 8):
+            sketch = QuantileSketch(capacity=8)
+            for v in self.values[:n]:
+                sketch.update(v)
+            npt.assert_allclose(sketch.median(),
+                                np.median(self.values[:n], axis=0))
+
+    def test_median_approximate(self):
+        sketch = QuantileSketch(capacity=32)
+        for v in self.values:
+            sketch.update(v)
+
+        self.assertLess(sum(len(rows) for rows in sketch.levels), 200)
+        # values are uniform on [0, 1), so the median's rank error is close
+        # to its absolute error
+        npt.assert_allclose(sketch.median(),
+                            np.median(self.values, axis=0), atol=0.05)
+
+    def test_size_is_bounded(self):
+        sketch = QuantileSketch(capacity=16)
+        for v in np.random.default_rng(0).random((10000, 2)):
+            sketch.update(v)
+
+        num_rows = sum(len(rows) for rows in sketch.levels)
+        self.assertLessEqual(num_rows, 3 * 16 + 8 * len(sketch.levels))
+
+    def test_merge(self):
+        sketch1 = QuantileSketch(capacity=8)
+        for v in self.values[:3]:
+            sketch1.update(v)
+        sketch2 = QuantileSketch(capacity=8)
+        for v in self.values[3:6]:
+            sketch2.update(v)
+        sketch1.merge(sketch2)
+
+        npt.assert_allclose(sketch1.median(),
+                            np.median(self.values[:6], axis=0))
+
+
+class PartialAggregateTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.values = np.random.default_rng(0).random((9, 3))
+        self.ids = ('S1', 'S2', 'S3')
+
+    def _aggregate(self, values, ids=None):
+        aggregate = PartialAggregate(ids or self.ids, 'x', sketch_capacity=4)
+        for v in values:
+            aggregate.update(v)
+        return aggregate
+
+    def test_merge(self):
+        observed = merge_partial_aggregates([self._aggregate(self.values[:2]),
+                                             self._aggregate(self.values[2:5]),
+                                             self._aggregate(self.values[5:])])
+
+        self.assertEqual(observed.count, 9)
+        self.assertEqual(observed.ids, self.ids)
+        self.assertEqual(observed.name, 'x')
+        npt.assert_allclose(observed.average('mean'),
+                            self.values.mean(axis=0))
+
+    def test_merge_exact_median(self):
+        aggregate1 = self._aggregate(self.values[:2])
+        aggregate1.merge(self._aggregate(self.values[2:4]))
+
+        npt.assert_allclose(aggregate1.average('median'),
+                            np.median(self.values[:4], axis=0))
+
+    def test_merge_mismatched_ids(self):
+        aggregate1 = self._aggregate(self.values[:2])
+        aggregate2 = self._aggregate(self.values[2:], ids=('S1', 'S2', 'S4'))
+
+        with self.assertRaisesRegex(ValueError, 'same IDs'):
+            aggregate1.merge(aggregate2)
+
+    def test_invalid_average_method(self):
+        with self.assertRaisesRegex(ValueError, 'Unknown average method w'):
+            self._aggregate(self.values).average('w')
+
+    def test_save_load(self):
+        aggregate = self._aggregate(self.values)
+        fh = io.BytesIO()
+        aggregate.save(fh)
+        fh.seek(0)
+        observed = PartialAggregate.load(fh)
+
+        self.assertEqual(observed.ids, self.ids)
+        self.assertEqual(observed.name, 'x')
+        self.assertEqual(observed.count, 9)
+        self.assertEqual(observed.sketch.capacity, 4)
+        npt.assert_array_equal(observed.average('mean'),
+                               aggregate.average('mean'))
+        npt.assert_array_equal(observed.average('median'),
+                               aggregate.average('median'))
+        npt.assert_array_equal(observed.moments.variance,
+                               aggregate.moments.variance)
+
+
+class ConvergenceMonitorTests(TestCase):
+
+    def test_converged(self):
+        monitor = ConvergenceMonitor(0.5, {'a': 'mean'})
+        monitor.update('a', [1., 2.])
+        # there is nothing to compare to at the first check
+        self.assertFalse(monitor.converged())
+
+        monitor.update('a', [1., 5.])
+        # the mean of S2 changed from 2 to 3.5
+        self.assertFalse(monitor.converged())
+
+        monitor.update('a', [1., 4.])
+        # the mean of S2 changed from 3.5 to 3.33
+        self.assertTrue(monitor.converged())
+
+    def test_all_keys(self):
+        monitor = ConvergenceMonitor(0.1, {'a': 'mean', 'b': 'median'})
+        monitor.update('a', [1.])
+        monitor.update('b', [1.])
+        self.assertFalse(monitor.converged())
+
+        monitor.update('a', [1.])
+        monitor.update('b', [3.])
+        self.assertFalse(monitor.converged())
+
+        monitor.update('a', [1.])
+        monitor.update('b', [2.])
+        self.assertTrue(monitor.converged())
+
+    def test_undefined_values(self):
+        monitor = ConvergenceMonitor(0.1, {'a': 'mean'})
+        monitor.update('a', [np.nan, 1.])
+        self.assertFalse(monitor.converged())
+        monitor.update('a', [np.nan, 1.])
+        self.assertTrue(monitor.converged())
+
+    def test_median_subset(self):
+        monitor = ConvergenceMonitor(0.1, {'a': 'median'},
+                                     max_median_elements=4)
+        rng = np.random.default_rng(0)
+        values = rng.random((9, 10))
+        for row in values:
+            monitor.update('a', row)
+        elements = monitor.median_elements['a']
+        self.assertEqual(len(elements), 4)
+        self.assertEqual(len(set(elements)), 4)
+        # only the values of the subset are kept
+        self.assertEqual(np.shape(monitor.median_values['a']), (9, 4))
+        monitor.converged()
+        npt.assert_array_equal(monitor._previous_averages['a'],
+                               np.median(values[:, elements], axis=0))
+
+        # the subset is the same in every monitor
+        other_monitor = ConvergenceMonitor(0.1, {'a': 'median'},
+                                           max_median_elements=4)
+        other_monitor.update('a', values[0])
+        npt.assert_array_equal(other_monitor.median_elements['a'], elements)
+
+    def test_median_without_subset(self):
+        monitor = ConvergenceMonitor(0.1, {'a': 'median'})
+        monitor.update('a', [1., 5.])
+        monitor.update('a', [2., 7.])
+        monitor.update('a', [9., 6.])
+        self.assertFalse(monitor.converged())
+        npt.assert_array_equal(monitor._previous_averages['a'], [2., 6.])
@@ -13,7 +13,9 @@ from skbio import TreeNode
 import qiime2
 from qiime2.plugin.testing import TestPluginBase
 
-from q2_boots import alpha_average
+from q2_boots import (alpha_average, alpha_average_stacked,
+                      alpha_partial_aggregate, alpha_merge_aggregates)
+from q2_boots._collection import StackedAlphaDiversities
 
 
 class AlphaAverageTests(TestPluginBase):
@@ -50,6 +52,83 @@ class AlphaAverageTests(TestPluginBase):
         with self.assertRaisesRegex(KeyError, "'w'.*'median' and 'mean'"):
             alpha_average(vector_collection, average_method='w')
 
+    def test_average_stacked_n(self):
+        vector1 = pd.Series([1., 200.,], index=['S1', 'S2'], name='x')
+        vector2 = pd.Series([3., 300.,], index=['S1', 'S2'], name='x')
+        vector3 = pd.Series([900., 3000.,], index=['S1', 'S2'], name='x')
+        stack = StackedAlphaDiversities.from_vectors(
+            [vector1, vector2, vector3])
+
+        for average_method in ('median', 'mean'):
+            observed = alpha_average_stacked(stack, average_method, n=2)
+            expected = alpha_average({0: vector1, 1: vector2},
+                                     average_method)
+            pdt.assert_series_equal(observed, expected)
+
+
+class AlphaPartialAggregateTests(TestPluginBase):
+    package = 'q2_boots'
+
+    def setUp(self):
+        super().setUp()
+        vectors = [pd.Series([1., 200.,], index=['S1', 'S2'], name='x'),
+                   pd.Series([3., 300.,], index=['S1', 'S2'], name='x'),
+                   pd.Series([900., 3000.,], index=['S1', 'S2'], name='x'),
+                   pd.Series([4., 2.,], index=['S1', 'S2'], name='x')]
+        self.vector_collection = dict(enumerate(vectors))
+
+    def test_merge_matches_average(self):
+        aggregates = {
+            'a': alpha_partial_aggregate({0: self.vector_collection[0]}),
+            'b': alpha_partial_aggregate({1: self.vector_collection[1],
+                                          2: self.vector_collection[2],
+                                          3: self.vector_collection[3]})}
+
+        for average_method in ('mean', 'median'):
+            observed = alpha_merge_aggregates(aggregates, average_method)
+            expected = alpha_average(self.vector_collection, average_method)
+            pdt.assert_series_equal(observed, expected)
+
+    def test_average_with_partial_aggregate(self):
+        aggregate = alpha_partial_aggregate({0: self.vector_collection[0],
+                                             1: self.vector_collection[1]})
+        new_vectors = {2: self.vector_collection[2],
+                       3: self.vector_collection[3]}
+
+        for average_method in ('mean', 'median'):
+            observed = alpha_average(new_vectors, average_method,
+                                     partial_aggregate=aggregate)
+            expected = alpha_average(self.vector_collection, average_method)
+            pdt.assert_series_equal(observed, expected)
+        # the partial aggregate is not modified
+        self.assertEqual(aggregate.count, 2)
+
+    def test_invalid_average_method(self):
+        aggregate = alpha_partial_aggregate({0: self.vector_collection[0]})
+
+        with self.assertRaisesRegex(KeyError, "'w'.*'median' and 'mean'"):
+            alpha_average({1: self.vector_collection[1]},
+                          average_method='w', partial_aggregate=aggregate)
+        with self.assertRaisesRegex(KeyError, "'w'.*'median' and 'mean'"):
+            alpha_merge_aggregates({'a': aggregate}, average_method='w')
+
+    def test_merge_artifacts(self):
+        partial_aggregate = self.plugin.methods['alpha_partial_aggregate']
+        merge_aggregates = self.plugin.methods['alpha_merge_aggregates']
+        vectors = {k: qiime2.Artifact.import_data(
+                        'SampleData[AlphaDiversity]', v)
+                   for k, v in self.vector_collection.items()}
+
+        aggregate1, = partial_aggregate(data={0: vectors[0], 1: vectors[1]})
+        aggregate2, = partial_aggregate(data={2: vectors[2], 3: vectors[3]})
+        observed, = merge_aggregates(
+            aggregates={'a': aggregate1, 'b': aggregate2},
+            average_method='median')
+
+        expected = pd.Series([3.5, 250.,], index=['S1', 'S2'], name='x')
+        pdt.assert_series_equal(observed.view(pd.Series), expected,
+                                check_names=False)
+
 
 class AlphaCollectionTests(TestPluginBase):
     package = 'q2_boots'
@@ -160,6 +239,134 @@ class AlphaCollectionTests(TestPluginBase):
             observed_series = alpha_vector.view(pd.Series)
             pdt.assert_series_equal(observed_series, expected_series)
 
+    def test_alpha_collection_random_seed(self):
+        table1 = pd.DataFrame(data=[[1, 1, 5], [0, 4, 9]],
+                              columns=['F1', 'F2', 'F3'],
+                              index=['S1', 'S2'])
+        table1 = qiime2.Artifact.import_data(
+            "FeatureTable[Frequency]", table1, view_type=pd.DataFrame
+        )
+
+        observed1, = self.alpha_collection_pipeline(
+            table=table1, sampling_depth=5, metric='shannon', n=10,
+            replacement=True, random_seed=0)
+        observed2, = self.alpha_collection_pipeline(
+            table=table1, sampling_depth=5, metric='shannon', n=10,
+            replacement=True, random_seed=0)
+        for vector1, vector2 in zip(observed1.values(), observed2.values()):
+            pdt.assert_series_equal(vector1.view(pd.Series),
+                                    vector2.view(pd.Series))
+
+    def test_alpha_collection_matches_resample_then_alpha(self):
+        table1 = pd.DataFrame(data=[[1, 1, 5], [0, 4, 9], [3, 3, 3]],
+                              columns=['F1', 'F2', 'F3'],
+                              index=['S1', 'S2', 'S3'])
+        table1 = qiime2.Artifact.import_data(
+            "FeatureTable[Frequency]", table1, view_type=pd.DataFrame
+        )
+        resample = self.plugin.actions['resample']
+        alpha = qiime2.sdk.PluginManager().plugins['diversity'].actions[
+            'alpha']
+
+        for replacement in (True, False):
+            tables, = resample(table=table1, sampling_depth=5, n=10,
+                               replacement=replacement, random_seed=0)
+            for metric in ('shannon', 'observed_features', 'chao1'):
+                observed, = self.alpha_collection_pipeline(
+                    table=table1, sampling_depth=5, metric=metric, n=10,
+                    replacement=replacement, random_seed=0)
+                self.assertEqual(len(observed), 10)
+                for vector, table in zip(observed.values(),
+                                         tables.values()):
+                    expected, = alpha(table=table, metric=metric)
+                    pdt.assert_series_equal(vector.view(pd.Series),
+                                            expected.view(pd.Series),
+                                            check_names=False,
+                                            check_dtype=False)
+
+    def test_alpha_collection_extend_existing(self):
+        table1 = pd.DataFrame(data=[[1, 1, 5], [0, 4, 9]],
+                              columns=['F1', 'F2', 'F3'],
+                              index=['S1', 'S2'])
+        table1 = qiime2.Artifact.import_data(
+            "FeatureTable[Frequency]", table1, view_type=pd.DataFrame
+        )
+
+        for metric in ('shannon', 'simpson'):
+            expected, = self.alpha_collection_pipeline(
+                table=table1, sampling_depth=5, metric=metric, n=10,
+                replacement=True, random_seed=0)
+            existing, = self.alpha_collection_pipeline(
+                table=table1, sampling_depth=5, metric=metric, n=4,
+                replacement=True, random_seed=0)
+            observed, = self.alpha_collection_pipeline(
+                table=table1, sampling_depth=5, metric=metric, n=10,
+                replacement=True, random_seed=0,
+                existing_alpha_diversities=existing)
+            self.assertEqual(len(observed), 10)
+            for vector1, vector2 in zip(observed.values(),
+                                        expected.values()):
+                pdt.assert_series_equal(vector1.view(pd.Series),
+                                        vector2.view(pd.Series))
+
+    def test_alpha_collection_stacked_tables(self):
+        table1 = pd.DataFrame(data=[[1, 1, 5], [0, 4, 9]],
+                              columns=['F1', 'F2', 'F3'],
+                              index=['S1', 'S2'])
+        table1 = qiime2.Artifact.import_data(
+            "FeatureTable[Frequency]", table1, view_type=pd.DataFrame
+        )
+        stacked, = self.plugin.methods['resample_stacked'](
+            table=table1, sampling_depth=5, n=10, replacement=True,
+            random_seed=0)
+
+        for metric in ('shannon', 'simpson'):
+            expected, = self.alpha_collection_pipeline(
+                table=table1, sampling_depth=5, metric=metric, n=6,
+                replacement=True, random_seed=0)
+            observed, = self.alpha_collection_pipeline(
+                table=stacked, sampling_depth=5, metric=metric, n=6,
+                replacement=True)
+            self.assertEqual(len(observed), 6)
+            for vector1, vector2 in zip(observed.values(),
+                                        expected.values()):
+                pdt.assert_series_equal(vector1.view(pd.Series),
+                                        vector2.view(pd.Series))
+
+        with self.assertRaisesRegex(ValueError, 'sampling depth of 5'):
+            self.alpha_collection_pipeline(
+                table=stacked, sampling_depth=4, metric='shannon', n=6,
+                replacement=True)
+
+    def test_alpha_collection_stacked(self):
+        table1 = pd.DataFrame(data=[[1, 1, 5], [0, 4, 9]],
+                              columns=['F1', 'F2', 'F3'],
+                              index=['S1', 'S2'])
+        table1 = qiime2.Artifact.import_data(
+            "FeatureTable[Frequency]", table1, view_type=pd.DataFrame
+        )
+        collection_stacked = self.plugin.pipelines['alpha_collection_stacked']
+        average_stacked = self.plugin.methods['alpha_average_stacked']
+        average = self.plugin.methods['alpha_average']
+
+        for metric in ('shannon', 'simpson'):
+            stacked, = collection_stacked(
+                table=table1, sampling_depth=5, metric=metric, n=10,
+                replacement=True, random_seed=0)
+            collection, = self.alpha_collection_pipeline(
+                table=table1, sampling_depth=5, metric=metric, n=10,
+                replacement=True, random_seed=0)
+            self.assertEqual(str(stacked.type),
+                             'SampleData[AlphaDiversityStack]')
+
+            for average_method in ('mean', 'median'):
+                observed, = average_stacked(data=stacked,
+                                            average_method=average_method)
+                expected, = average(data=collection,
+                                    average_method=average_method)
+                pdt.assert_series_equal(observed.view(pd.Series),
+                                        expected.view(pd.Series))
+
     def test_alpha_collection_invalid_input(self):
         table1 = pd.DataFrame(data=[[1, 1], [0, 4]],
                               columns=['F1', 'F2'],
@@ -178,6 +385,20 @@ class AlphaCollectionTests(TestPluginBase):
                                            metric='xyz', n=88,
                                            replacement=False)
 
+    def test_alpha_collection_relative_frequency(self):
+        table1 = pd.DataFrame(data=[[0.5, 0.5], [0., 1.]],
+                              columns=['F1', 'F2'],
+                              index=['S1', 'S2'])
+        table1 = qiime2.Artifact.import_data(
+            "FeatureTable[RelativeFrequency]", table1, view_type=pd.DataFrame
+        )
+
+        for replacement in (True, False):
+            with self.assertRaisesRegex(TypeError, 'RelativeFrequency'):
+                self.alpha_collection_pipeline(
+                    table=table1, sampling_depth=1, metric='shannon', n=10,
+                    replacement=replacement)
+
 
 class AlphaTests(TestPluginBase):
     package = 'q2_boots'
@@ -236,6 +457,30 @@ class AlphaTests(TestPluginBase):
         self.assertTrue(1.0 < observed_series['S1'] < 2.0)
         self.assertEqual(observed_series['S2'], 1.0)
 
+    def test_alpha_convergence(self):
+        table1 = pd.DataFrame(data=[[1, 1, 5], [0, 4, 9]],
+                              columns=['F1', 'F2', 'F3'],
+                              index=['S1', 'S2'])
+        table1 = qiime2.Artifact.import_data(
+            "FeatureTable[Frequency]", table1, view_type=pd.DataFrame
+        )
+        alpha_collection = self.plugin.pipelines['alpha_collection']
+        alpha_average = self.plugin.methods['alpha_average']
+
+        for metric in ('shannon', 'simpson'):
+            # with a tolerance this large, the averages always converge at
+            # the first check, after two batches
+            observed, = self.alpha_pipeline(
+                table=table1, sampling_depth=5, metric=metric, n=100,
+                replacement=True, random_seed=0, average_method='mean',
+                convergence_tolerance=1e9, convergence_batch_size=3)
+            collection, = alpha_collection(
+                table=table1, sampling_depth=5, metric=metric, n=6,
+                replacement=True, random_seed=0)
+            expected, = alpha_average(data=collection, average_method='mean')
+            pdt.assert_series_equal(observed.view(pd.Series),
+                                    expected.view(pd.Series))
+
     def test_alpha_wo_replacement(self):
         table1 = pd.DataFrame(data=[[1, 1], [0, 4]],
                               columns=['F1', 'F2'],
@@ -6,9 +6,12 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import io
 from unittest import TestCase, main
 
+import numpy as np
 import pandas as pd
+import scipy.spatial.distance
 import numpy.testing as npt
 import qiime2
 
@@ -16,8 +19,10 @@ import skbio
 
 from qiime2.plugin.testing import TestPluginBase
 
-from q2_boots import beta_average
-from q2_boots._beta import _per_cell_average, _medoid
+from q2_boots import (beta_average, beta_average_stacked, beta_variance,
+                      beta_partial_aggregate, beta_merge_aggregates)
+from q2_boots._collection import StackedDistanceMatrices
+from q2_boots._beta import _per_cell_average, _medoid, _approx_medoid
 
 
 class BetaAverageTests(TestCase):
@@ -83,11 +88,151 @@ class BetaAverageTests(TestCase):
                                        'a4': self.a}, "medoid"),
                          self.a)
 
+    def test_approx_medoid(self):
+        observed = beta_average(self.dms, "approx-medoid")
+        self.assertEqual(observed, self.c)
+
     def test_invalid(self):
         with self.assertRaisesRegex(ValueError, "Unknown average method.*xyz"):
             beta_average(self.dms, "xyz")
 
 
+class BetaAverageStackedTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(0)
+        self.dms = {}
+        for i in range(7):
+            points = rng.random((6, 3))
+            self.dms[i] = skbio.DistanceMatrix(
+                np.sqrt(((points[:, None] - points[None, :]) ** 2).sum(-1)),
+                ids=[f'S{j}' for j in range(6)])
+
+    def test_matches_beta_average(self):
+        for dtype in (np.float64, np.float32):
+            stack = StackedDistanceMatrices.from_distance_matrices(
+                self.dms.values(), len(self.dms), dtype=dtype)
+            for average_method in ('non-metric-mean', 'non-metric-median',
+                                   'medoid', 'approx-medoid'):
+                observed = beta_average_stacked(stack, average_method)
+                expected = beta_average(self.dms, average_method)
+                self.assertEqual(observed.ids, expected.ids)
+                npt.assert_allclose(observed.data, expected.data, rtol=1e-6)
+
+    def test_n(self):
+        stack = StackedDistanceMatrices.from_distance_matrices(
+            self.dms.values(), len(self.dms))
+        first_dms = {i: self.dms[i] for i in range(4)}
+        for average_method in ('non-metric-mean', 'non-metric-median',
+                               'medoid', 'approx-medoid'):
+            observed = beta_average_stacked(stack, average_method, n=4)
+            expected = beta_average(first_dms, average_method)
+            npt.assert_allclose(observed.data, expected.data)
+
+    def test_float32(self):
+        stack = StackedDistanceMatrices.from_distance_matrices(
+            self.dms.values(), len(self.dms), dtype=np.float32)
+        for average_method in ('non-metric-mean', 'non-metric-median',
+                               'medoid', 'approx-medoid'):
+            observed = beta_average_stacked(stack, average_method,
+                                            precision='float32')
+            expected = beta_average(self.dms, average_method)
+            # the average is upcast to float64
+            self.assertEqual(observed.data.dtype, np.float64)
+            npt.assert_allclose(observed.data, expected.data, rtol=1e-5)
+
+    def test_invalid(self):
+        stack = StackedDistanceMatrices.from_distance_matrices(
+            self.dms.values(), len(self.dms))
+        with self.assertRaisesRegex(ValueError, 'Unknown average method'):
+            beta_average_stacked(stack, 'mode')
+
+
+class BetaVarianceTests(TestCase):
+
+    def test_beta_variance(self):
+        a = skbio.DistanceMatrix([[0, 2, 99],
+                                  [2, 0, 1],
+                                  [99, 1, 0]], ids=('S1', 'S2', 'S3'))
+        b = skbio.DistanceMatrix([[0, 4, 1],
+                                  [4, 0, 3],
+                                  [1, 3, 0]], ids=('S1', 'S2', 'S3'))
+        observed = beta_variance({'a': a, 'b': b})
+        exp = skbio.DistanceMatrix([[0.0, 2.0, 4802.0],
+                                    [2.0, 0.0, 2.0],
+                                    [4802.0, 2.0, 0.0]],
+                                   ids=('S1', 'S2', 'S3'))
+        self.assertEqual(observed, exp)
+
+        self.assertEqual(beta_variance({'a': a}),
+                         skbio.DistanceMatrix(np.zeros((3, 3)),
+                                              ids=('S1', 'S2', 'S3')))
+
+
+class BetaPartialAggregateTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.dms = {
+            'a': skbio.DistanceMatrix([[0, 2, 99],
+                                       [2, 0, 1],
+                                       [99, 1, 0]], ids=('S1', 'S2', 'S3')),
+            'b': skbio.DistanceMatrix([[0, 4, 1],
+                                       [4, 0, 2],
+                                       [1, 2, 0]], ids=('S1', 'S2', 'S3')),
+            'c': skbio.DistanceMatrix([[0, 6, 2],
+                                       [6, 0, 3],
+                                       [2, 3, 0]], ids=('S1', 'S2', 'S3'))}
+
+    def test_merge_matches_average(self):
+        aggregates = {
+            'x': beta_partial_aggregate({'a': self.dms['a']}),
+            'y': beta_partial_aggregate({'b': self.dms['b'],
+                                         'c': self.dms['c']})}
+
+        for average_method in ('non-metric-mean', 'non-metric-median'):
+            observed = beta_merge_aggregates(aggregates, average_method)
+            expected = beta_average(self.dms, average_method)
+            self.assertEqual(observed.ids, expected.ids)
+            npt.assert_allclose(observed.data, expected.data)
+
+    def test_average_with_partial_aggregate(self):
+        aggregate = beta_partial_aggregate({'a': self.dms['a']})
+        new_dms = {'b': self.dms['b'], 'c': self.dms['c']}
+
+        for average_method in ('non-metric-mean', 'non-metric-median'):
+            observed = beta_average(new_dms, average_method,
+                                    partial_aggregate=aggregate)
+            expected = beta_average(self.dms, average_method)
+            self.assertEqual(observed.ids, expected.ids)
+            npt.assert_allclose(observed.data, expected.data)
+
+        with self.assertRaisesRegex(ValueError, "Unknown average method"):
+            beta_average(new_dms, 'medoid', partial_aggregate=aggregate)
+
+    def test_saved_size_is_bounded(self):
+        rng = np.random.default_rng(0)
+        ids = [f'S{i}' for i in range(30)]
+        dms = {i: skbio.DistanceMatrix(
+                   scipy.spatial.distance.squareform(rng.random(435)),
+                   ids=ids)
+               for i in range(2000)}
+        aggregate = beta_partial_aggregate(dms)
+        fh = io.BytesIO()
+        aggregate.save(fh)
+
+        self.assertEqual(aggregate.count, 2000)
+        # the sketch holds about 3 * 32 distance matrices, not 2000
+        self.assertLess(len(fh.getvalue()), 128 * 435 * 8)
+        npt.assert_allclose(aggregate.average('median'), 0.5, atol=0.1)
+
+    def test_invalid(self):
+        aggregates = {'x': beta_partial_aggregate(self.dms)}
+        with self.assertRaisesRegex(ValueError, "Unknown average method"):
+            beta_merge_aggregates(aggregates, 'medoid')
+
+
 class BetaAverageHelperTests(TestCase):
 
     def setUp(self):
@@ -119,10 +264,82 @@ class BetaAverageHelperTests(TestCase):
 
         self.assertEqual(observed, exp)
 
+    def test_per_cell_average_blocked(self):
+        rng = np.random.default_rng(0)
+        ids = [f'S{i}' for i in range(9)]
+        dms = []
+        for _ in range(5):
+            data = rng.random((9, 9))
+            data = data + data.T
+            np.fill_diagonal(data, 0)
+            dms.append(skbio.DistanceMatrix(data, ids=ids))
+        stacked = np.asarray([dm.data for dm in dms])
+
+        for average_method, average_fn in [('median', np.median),
+                                           ('mean', np.mean)]:
+            expected = skbio.DistanceMatrix(average_fn(stacked, axis=0),
+                                            ids=ids)
+            for max_block_bytes in (1, 8 * 5 * 10, 2 ** 20):
+                observed = _per_cell_average(
+                    dms, average_method, max_block_bytes=max_block_bytes)
+                self.assertEqual(observed.ids, expected.ids)
+                npt.assert_allclose(observed.data, expected.data)
+                observed = _per_cell_average(
+                    dms, average_method, max_block_bytes=max_block_bytes,
+                    dtype=np.float32)
+                self.assertEqual(observed.data.dtype, np.float64)
+                npt.assert_allclose(observed.data, expected.data, rtol=1e-6)
+
+    def test_per_cell_average_single_sample(self):
+        dm = skbio.DistanceMatrix([[0.0]], ids=['S1'])
+        self.assertEqual(_per_cell_average([dm, dm], 'median'), dm)
+
+    def test_medoid_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        ids = [f'S{i}' for i in range(12)]
+        dms = []
+        for _ in range(25):
+            data = rng.random((12, 12))
+            data = data + data.T
+            np.fill_diagonal(data, 0)
+            dms.append(skbio.DistanceMatrix(data, ids=ids))
+
+        condensed = np.asarray([dm.condensed_form() for dm in dms])
+        distances = np.linalg.norm(
+            condensed[:, np.newaxis] - condensed[np.newaxis, :], axis=2)
+        expected = dms[np.argmin(distances.sum(axis=1))]
+
+        self.assertEqual(_medoid(dms), expected)
+        self.assertEqual(_medoid(dms, max_block_bytes=8 * 25 * 7), expected)
+
+        # a handful of candidates from the random projection is enough to
+        # find the exact medoid of these data
+        observed = _approx_medoid(dms, num_candidates=3)
+        self.assertEqual(observed, expected)
+        observed = _approx_medoid(dms, num_candidates=3,
+                                  max_block_bytes=8 * 256 * 7)
+        self.assertEqual(observed, expected)
+
+        # single precision doesn't change the medoid of these data
+        self.assertEqual(_medoid(dms, dtype=np.float32), expected)
+        self.assertEqual(
+            _approx_medoid(dms, num_candidates=3, dtype=np.float32), expected)
+
+    def test_approx_medoid(self):
+        observed = _approx_medoid(self.dms)
+        self.assertEqual(observed, self.c)
+
+        observed = _approx_medoid(self.dms, dimensions=2, num_candidates=1)
+        self.assertIn(observed, self.dms)
+
     def test_medoid(self):
         observed = _medoid(self.dms)
         self.assertEqual(observed, self.c)
 
+        # force one block per row of the upper triangle
+        observed = _medoid(self.dms, max_block_bytes=1)
+        self.assertEqual(observed, self.c)
+
 
 class BetaCollectionTests(TestPluginBase):
 
@@ -148,6 +365,158 @@ class BetaCollectionTests(TestPluginBase):
                 table=self.table1, metric='weighted_unifrac', sampling_depth=1,
                 n=10, replacement=False)
 
+    def test_beta_collection_relative_frequency(self):
+        table = qiime2.Artifact.import_data(
+            'FeatureTable[RelativeFrequency]',
+            pd.DataFrame(data=[[0.5, 0.5], [0., 1.]],
+                         columns=['F1', 'F2'],
+                         index=['S1', 'S2']),
+            view_type=pd.DataFrame)
+
+        for replacement in (True, False):
+            with self.assertRaisesRegex(TypeError, 'RelativeFrequency'):
+                self.beta_collection_pipeline(
+                    table=table, metric='braycurtis', sampling_depth=1,
+                    n=10, replacement=replacement)
+
+    def test_beta_collection_matches_resample_then_beta(self):
+        table = qiime2.Artifact.import_data(
+            'FeatureTable[Frequency]',
+            pd.DataFrame(data=[[1, 1, 5], [0, 4, 9], [3, 3, 3]],
+                         columns=['F1', 'F2', 'F3'],
+                         index=['S1', 'S2', 'S3']),
+            view_type=pd.DataFrame)
+        resample = self.plugin.actions['resample']
+        beta = qiime2.sdk.PluginManager().plugins['diversity'].actions[
+            'beta']
+
+        for replacement in (True, False):
+            tables, = resample(table=table, sampling_depth=5, n=8,
+                               replacement=replacement, random_seed=0)
+            for metric in ('braycurtis', 'jaccard', 'canberra'):
+                observed, = self.beta_collection_pipeline(
+                    table=table, metric=metric, sampling_depth=5, n=8,
+                    replacement=replacement, random_seed=0)
+                self.assertEqual(len(observed), 8)
+                for dm, resampled in zip(observed.values(), tables.values()):
+                    expected, = beta(table=resampled, metric=metric)
+                    dm = dm.view(skbio.DistanceMatrix)
+                    expected = expected.view(skbio.DistanceMatrix)
+                    self.assertEqual(dm.ids, expected.ids)
+                    npt.assert_allclose(dm.data, expected.data)
+
+    def test_beta_collection_phylogenetic_matches_resample_then_beta(self):
+        table = qiime2.Artifact.import_data(
+            'FeatureTable[Frequency]',
+            pd.DataFrame(data=[[1, 1, 5], [0, 4, 9], [3, 3, 3]],
+                         columns=['F1', 'F2', 'F3'],
+                         index=['S1', 'S2', 'S3']),
+            view_type=pd.DataFrame)
+        phylogeny = qiime2.Artifact.import_data(
+            'Phylogeny[Rooted]',
+            skbio.TreeNode.read(['((F1:1.0,F2:0.5):2.0,F3:0.25);']))
+        resample = self.plugin.actions['resample']
+        beta_phylogenetic = qiime2.sdk.PluginManager().plugins[
+            'diversity'].actions['beta_phylogenetic']
+
+        for replacement in (True, False):
+            tables, = resample(table=table, sampling_depth=5, n=8,
+                               replacement=replacement, random_seed=0)
+            for metric in ('unweighted_unifrac', 'weighted_unifrac'):
+                observed, = self.beta_collection_pipeline(
+                    table=table, metric=metric, phylogeny=phylogeny,
+                    sampling_depth=5, n=8, replacement=replacement,
+                    random_seed=0)
+                self.assertEqual(len(observed), 8)
+                for dm, resampled in zip(observed.values(), tables.values()):
+                    expected, = beta_phylogenetic(
+                        table=resampled, phylogeny=phylogeny, metric=metric)
+                    dm = dm.view(skbio.DistanceMatrix)
+                    expected = expected.view(skbio.DistanceMatrix)
+                    self.assertEqual(dm.ids, expected.ids)
+                    npt.assert_allclose(dm.data, expected.data, atol=1e-12)
+
+    def test_beta_collection_extend_existing(self):
+        table = qiime2.Artifact.import_data(
+            'FeatureTable[Frequency]',
+            pd.DataFrame(data=[[1, 1, 5], [0, 4, 9], [3, 3, 3]],
+                         columns=['F1', 'F2', 'F3'],
+                         index=['S1', 'S2', 'S3']),
+            view_type=pd.DataFrame)
+
+        for metric in ('braycurtis', 'canberra'):
+            expected, = self.beta_collection_pipeline(
+                table=table, metric=metric, sampling_depth=5, n=8,
+                replacement=True, random_seed=0)
+            existing, = self.beta_collection_pipeline(
+                table=table, metric=metric, sampling_depth=5, n=3,
+                replacement=True, random_seed=0)
+            observed, = self.beta_collection_pipeline(
+                table=table, metric=metric, sampling_depth=5, n=8,
+                replacement=True, random_seed=0,
+                existing_distance_matrices=existing)
+            self.assertEqual(len(observed), 8)
+            for dm1, dm2 in zip(observed.values(), expected.values()):
+                self.assertEqual(dm1.view(skbio.DistanceMatrix),
+                                 dm2.view(skbio.DistanceMatrix))
+
+    def test_beta_collection_stacked(self):
+        table = qiime2.Artifact.import_data(
+            'FeatureTable[Frequency]',
+            pd.DataFrame(data=[[1, 1, 5], [0, 4, 9], [3, 3, 3]],
+                         columns=['F1', 'F2', 'F3'],
+                         index=['S1', 'S2', 'S3']),
+            view_type=pd.DataFrame)
+        beta_collection_stacked = \
+            self.plugin.pipelines['beta_collection_stacked']
+
+        for metric in ('braycurtis', 'canberra'):
+            expected, = self.beta_collection_pipeline(
+                table=table, metric=metric, sampling_depth=5, n=8,
+                replacement=True, random_seed=0)
+            observed, = beta_collection_stacked(
+                table=table, metric=metric, sampling_depth=5, n=8,
+                replacement=True, random_seed=0)
+            self.assertEqual(str(observed.type), 'DistanceMatrixStack')
+            stack = observed.view(StackedDistanceMatrices)
+            self.assertEqual(len(stack), 8)
+            for i, dm in enumerate(expected.values()):
+                self.assertEqual(stack.distance_matrix(i),
+                                 dm.view(skbio.DistanceMatrix))
+
+            observed, = beta_collection_stacked(
+                table=table, metric=metric, sampling_depth=5, n=8,
+                replacement=True, random_seed=0, precision='float32')
+            stack = observed.view(StackedDistanceMatrices)
+            self.assertEqual(stack.values.dtype, np.float32)
+            for i, dm in enumerate(expected.values()):
+                npt.assert_allclose(stack.distance_matrix(i).data,
+                                    dm.view(skbio.DistanceMatrix).data,
+                                    rtol=1e-6)
+
+    def test_beta_collection_stacked_tables(self):
+        table = qiime2.Artifact.import_data(
+            'FeatureTable[Frequency]',
+            pd.DataFrame(data=[[1, 1, 5], [0, 4, 9], [3, 3, 3]],
+                         columns=['F1', 'F2', 'F3'],
+                         index=['S1', 'S2', 'S3']),
+            view_type=pd.DataFrame)
+        stacked, = self.plugin.methods['resample_stacked'](
+            table=table, sampling_depth=5, n=8, replacement=True,
+            random_seed=0)
+
+        for metric in ('braycurtis', 'canberra'):
+            expected, = self.beta_collection_pipeline(
+                table=table, metric=metric, sampling_depth=5, n=8,
+                replacement=True, random_seed=0)
+            observed, = self.beta_collection_pipeline(
+                table=stacked, metric=metric, sampling_depth=5, n=8,
+                replacement=True, random_seed=0)
+            self.assertEqual(len(observed), 8)
+            for dm1, dm2 in zip(observed.values(), expected.values()):
+                self.assertEqual(dm1.view(skbio.DistanceMatrix),
+                                 dm2.view(skbio.DistanceMatrix))
+
     def test_beta_collection_w_replacement(self):
         # At a sampling depth of 2, with self.table1, and when sampling with
         # replacement, there are three possible Jaccard distance matrices.
@@ -234,6 +603,33 @@ class BetaTests(TestPluginBase):
         self.table1 = qiime2.Artifact.import_data(
             "FeatureTable[Frequency]", table1, view_type=pd.DataFrame)
 
+    def test_beta_convergence(self):
+        table = qiime2.Artifact.import_data(
+            'FeatureTable[Frequency]',
+            pd.DataFrame(data=[[1, 1, 5], [0, 4, 9], [3, 3, 3]],
+                         columns=['F1', 'F2', 'F3'],
+                         index=['S1', 'S2', 'S3']),
+            view_type=pd.DataFrame)
+        beta_collection = self.plugin.pipelines['beta_collection']
+        beta_average = self.plugin.methods['beta_average']
+
+        for metric in ('braycurtis', 'canberra'):
+            # with a tolerance this large, the averages always converge at
+            # the first check, after two batches
+            observed, = self.beta_pipeline(
+                table=table, metric=metric, sampling_depth=5, n=100,
+                replacement=True, random_seed=0,
+                average_method='non-metric-mean', convergence_tolerance=1e9,
+                convergence_batch_size=3)
+            collection, = beta_collection(
+                table=table, metric=metric, sampling_depth=5, n=6,
+                replacement=True, random_seed=0)
+            expected, = beta_average(data=collection,
+                                     average_method='non-metric-mean')
+            npt.assert_allclose(
+                observed.view(skbio.DistanceMatrix).data,
+                expected.view(skbio.DistanceMatrix).data)
+
     def test_beta_w_replacement(self):
         # At a sampling depth of 2, with self.table1, and when sampling with
         # replacement, there are three possible Jaccard distance matrices.
@@ -0,0 +1,129 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, Caporaso Lab (https://cap-lab.bio).
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import pathlib
+import tempfile
+from unittest import TestCase, mock
+
+from q2_boots._cache import DiskCache, cache_key
+
+
+class DiskCacheTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self._temp_dir.name)
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+        super().tearDown()
+
+    def test_get_put(self):
+        cache = DiskCache(self.root / 'a')
+        self.assertIsNone(cache.get(cache_key('x')))
+
+        cache.put(cache_key('x'), lambda fh: fh.write(b'hello'))
+        self.assertEqual(cache.get(cache_key('x')).read_bytes(), b'hello')
+
+    def test_failed_put(self):
+        cache = DiskCache(self.root / 'a')
+
+        def write(fh):
+            fh.write(b'hel')
+            raise ValueError('oops')
+
+        with self.assertRaisesRegex(ValueError, 'oops'):
+            cache.put(cache_key('x'), write)
+        self.assertIsNone(cache.get(cache_key('x')))
+        self.assertEqual(list((self.root / 'a').iterdir()), [])
+
+    def test_least_recently_used_evicted(self):
+        x, y, z = cache_key('x'), cache_key('y'), cache_key('z')
+        cache = DiskCache(self.root / 'a', max_bytes=10)
+        other_cache = DiskCache(self.root / 'b', max_bytes=10)
+        cache.put(x, lambda fh: fh.write(b'1234'))
+        other_cache.put(y, lambda fh: fh.write(b'1234'))
+        os.utime(cache.get(x), (0, 0))
+        os.utime(other_cache.get(y), (1, 1))
+        # reading x makes it the most recently used entry
+        cache.get(x)
+
+        cache.put(z, lambda fh: fh.write(b'1234'))
+        self.assertIsNotNone(cache.get(x))
+        self.assertIsNone(other_cache.get(y))
+        self.assertIsNotNone(cache.get(z))
+
+    def test_entry_larger_than_cap_not_added(self):
+        x, y = cache_key('x'), cache_key('y')
+        cache = DiskCache(self.root / 'a', max_bytes=10)
+        cache.put(x, lambda fh: fh.write(b'1234'))
+
+        cache.put(y, lambda fh: fh.write(b'12345678901'))
+        self.assertIsNone(cache.get(y))
+        # other entries are not evicted to make room for it
+        self.assertIsNotNone(cache.get(x))
+        self.assertEqual(list((self.root / 'a').iterdir()),
+                         [self.root / 'a' / x])
+
+    def test_new_entry_not_evicted(self):
+        x, y = cache_key('x'), cache_key('y')
+        cache = DiskCache(self.root / 'a', max_bytes=10)
+        cache.put(x, lambda fh: fh.write(b'1234'))
+        # x looks more recently used than the entry about to be added, as
+        # it could with a coarse modification time resolution
+        os.utime(cache.get(x), (2 ** 31, 2 ** 31))
+
+        cache.put(y, lambda fh: fh.write(b'12345678'))
+        self.assertIsNotNone(cache.get(y))
+        self.assertIsNone(cache.get(x))
+
+    def test_foreign_files_not_evicted(self):
+        with mock.patch.dict(os.environ,
+                             {'Q2_BOOTS_CACHE_DIR': str(self.root),
+                              'Q2_BOOTS_CACHE_MAX_BYTES': '4'}):
+            cache = DiskCache.from_environment('a')
+        # files in the cache root, in other directories of the cache root,
+        # and files in the cache's own directory that are not entries
+        foreign = [self.root / 'notes.txt',
+                   self.root / 'other' / 'data.txt',
+                   self.root / 'other' / cache_key('y'),
+                   self.root / 'q2-boots' / 'a' / 'notes.txt']
+        for path in foreign:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(b'12345678')
+            os.utime(path, (0, 0))
+
+        cache.put(cache_key('x'), lambda fh: fh.write(b'1234'))
+        os.utime(cache.directory / cache_key('x'), (1, 1))
+        cache.put(cache_key('z'), lambda fh: fh.write(b'1234'))
+        for path in foreign:
+            self.assertEqual(path.read_bytes(), b'12345678')
+        self.assertIsNotNone(cache.get(cache_key('z')))
+        # only the cache's own entries count towards its size cap
+        self.assertIsNone(cache.get(cache_key('x')))
+
+    def test_from_environment(self):
+        with mock.patch.dict(os.environ, {}, clear=True):
+            self.assertIsNone(DiskCache.from_environment('a'))
+
+        with mock.patch.dict(os.environ,
+                             {'Q2_BOOTS_CACHE_DIR': str(self.root),
+                              'Q2_BOOTS_CACHE_MAX_BYTES': '42'}):
+            cache = DiskCache.from_environment('a')
+        self.assertEqual(cache.directory, self.root / 'q2-boots' / 'a')
+        self.assertEqual(cache.max_bytes, 42)
+
+
+class CacheKeyTests(TestCase):
+
+    def test_cache_key(self):
+        self.assertEqual(cache_key('a', b'b'), cache_key(b'a', 'b'))
+        self.assertNotEqual(cache_key('ab', 'c'), cache_key('a', 'bc'))
+        self.assertNotEqual(cache_key('a'), cache_key('a', ''))
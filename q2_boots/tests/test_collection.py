@@ -0,0 +1,178 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, Caporaso Lab (https://cap-lab.bio).
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pandas.testing as pdt
+import skbio
+
+from q2_boots._alpha import alpha_average
+from q2_boots._collection import (StackedAlphaDiversities,
+                                  StackedDistanceMatrices)
+
+
+class StackedAlphaDiversitiesTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        vectors = [pd.Series([1., 200., np.nan], index=['S1', 'S2', 'S3'],
+                             name='x'),
+                   pd.Series([3., 300., np.nan], index=['S1', 'S2', 'S3'],
+                             name='x'),
+                   # the samples of a vector are aligned with the first one
+                   pd.Series([3000., np.nan, 900.], index=['S2', 'S3', 'S1'],
+                             name='x'),
+                   pd.Series([4., 2., np.nan], index=['S1', 'S2', 'S3'],
+                             name='x')]
+        self.vector_collection = dict(enumerate(vectors))
+
+    def test_from_vectors(self):
+        stack = StackedAlphaDiversities.from_vectors(
+            self.vector_collection.values())
+        self.assertEqual(len(stack), 4)
+        self.assertEqual(stack.name, 'x')
+        self.assertEqual(list(stack.ids), ['S1', 'S2', 'S3'])
+        npt.assert_array_equal(stack.values,
+                               [[1., 3., 900., 4.],
+                                [200., 300., 3000., 2.],
+                                [np.nan, np.nan, np.nan, np.nan]])
+
+    def test_from_vectors_float32(self):
+        stack = StackedAlphaDiversities.from_vectors(
+            self.vector_collection.values(), dtype=np.float32)
+        self.assertEqual(stack.values.dtype, np.float32)
+        for average_method in ('mean', 'median'):
+            observed = stack.average(average_method)
+            # averages are returned as float64
+            self.assertEqual(observed.dtype, np.float64)
+            pdt.assert_series_equal(
+                observed,
+                alpha_average(self.vector_collection, average_method))
+
+    def test_average_matches_alpha_average(self):
+        stack = StackedAlphaDiversities.from_vectors(
+            self.vector_collection.values())
+        for average_method in ('mean', 'median'):
+            pdt.assert_series_equal(
+                stack.average(average_method),
+                alpha_average(self.vector_collection, average_method))
+
+    def test_invalid_average_method(self):
+        stack = StackedAlphaDiversities.from_vectors(
+            self.vector_collection.values())
+        with self.assertRaisesRegex(KeyError, 'Invalid average method'):
+            stack.average('mode')
+
+    def test_head(self):
+        stack = StackedAlphaDiversities.from_vectors(
+            self.vector_collection.values())
+        observed = stack.head(2)
+        self.assertEqual(len(observed), 2)
+        self.assertEqual(observed.name, 'x')
+        for average_method in ('mean', 'median'):
+            pdt.assert_series_equal(
+                observed.average(average_method),
+                alpha_average({0: self.vector_collection[0],
+                               1: self.vector_collection[1]},
+                              average_method))
+        with self.assertRaisesRegex(ValueError, '5 alpha.*only 4'):
+            stack.head(5)
+
+    def test_save_load(self):
+        stack = StackedAlphaDiversities.from_vectors(
+            self.vector_collection.values())
+        with tempfile.TemporaryDirectory() as directory:
+            stack.save(directory)
+            observed = StackedAlphaDiversities.load(directory)
+            self.assertIsInstance(observed.values, np.memmap)
+            npt.assert_array_equal(observed.values, stack.values)
+            pdt.assert_index_equal(observed.ids, stack.ids)
+            self.assertEqual(observed.name, 'x')
+            del observed
+
+
+class StackedDistanceMatricesTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        ids = ('S1', 'S2', 'S3')
+        self.dms = [skbio.DistanceMatrix([[0, 2, 99], [2, 0, 1], [99, 1, 0]],
+                                         ids=ids),
+                    skbio.DistanceMatrix([[0, 4, 1], [4, 0, 2], [1, 2, 0]],
+                                         ids=ids),
+                    skbio.DistanceMatrix([[0, 6, 2], [6, 0, 3], [2, 3, 0]],
+                                         ids=ids)]
+
+    def test_from_distance_matrices(self):
+        stack = StackedDistanceMatrices.from_distance_matrices(self.dms, 3)
+        self.assertEqual(len(stack), 3)
+        self.assertEqual(stack.ids, ('S1', 'S2', 'S3'))
+        self.assertEqual(stack.values.dtype, np.float64)
+        npt.assert_array_equal(stack.values,
+                               [[2, 99, 1], [4, 1, 2], [6, 2, 3]])
+        self.assertEqual(stack.distance_matrix(1), self.dms[1])
+
+    def test_head(self):
+        stack = StackedDistanceMatrices.from_distance_matrices(self.dms, 3)
+        observed = stack.head(2)
+        self.assertEqual(len(observed), 2)
+        self.assertEqual(observed.ids, ('S1', 'S2', 'S3'))
+        self.assertEqual(observed.distance_matrix(1), self.dms[1])
+        with self.assertRaisesRegex(ValueError, '4 distance.*only 3'):
+            stack.head(4)
+
+    def test_from_distance_matrices_float32(self):
+        stack = StackedDistanceMatrices.from_distance_matrices(
+            self.dms, 3, dtype=np.float32)
+        self.assertEqual(stack.values.dtype, np.float32)
+        # rows are returned as float64 distance matrices
+        self.assertEqual(stack.distance_matrix(2), self.dms[2])
+        self.assertEqual(stack.distance_matrix(2).data.dtype, np.float64)
+
+    def test_from_distance_matrices_fewer_than_max(self):
+        stack = StackedDistanceMatrices.from_distance_matrices(self.dms, 10)
+        self.assertEqual(len(stack), 3)
+        npt.assert_array_equal(stack.values[2], [6, 2, 3])
+
+    def test_from_distance_matrices_empty(self):
+        with self.assertRaisesRegex(ValueError, 'At least one'):
+            StackedDistanceMatrices.from_distance_matrices([], 3)
+
+    def test_from_distance_matrices_single_sample(self):
+        dm = skbio.DistanceMatrix([[0]], ids=['S1'])
+        stack = StackedDistanceMatrices.from_distance_matrices([dm, dm], 2)
+        self.assertEqual(stack.values.shape, (2, 0))
+        self.assertEqual(list(stack.column_blocks(5)), [])
+
+    def test_column_blocks(self):
+        stack = StackedDistanceMatrices.from_distance_matrices(
+            self.dms, 3, dtype=np.float32)
+        blocks = list(stack.column_blocks(2))
+        self.assertEqual([block.shape for block in blocks], [(3, 2), (3, 1)])
+        for block in blocks:
+            self.assertEqual(block.dtype, np.float64)
+        npt.assert_array_equal(np.hstack(blocks), stack.values)
+        for block in stack.column_blocks(2, np.float32):
+            self.assertEqual(block.dtype, np.float32)
+
+    def test_save_load(self):
+        for dtype in (np.float64, np.float32):
+            stack = StackedDistanceMatrices.from_distance_matrices(
+                self.dms, 3, dtype=dtype)
+            with tempfile.TemporaryDirectory() as directory:
+                stack.save(directory)
+                observed = StackedDistanceMatrices.load(directory)
+                self.assertIsInstance(observed.values, np.memmap)
+                self.assertEqual(observed.values.dtype, dtype)
+                npt.assert_array_equal(observed.values, stack.values)
+                self.assertEqual(observed.ids, stack.ids)
+                del observed
@@ -38,6 +38,30 @@ class CoreMetricsTests(TestPluginBase):
         metadata.index.name = 'sample-id'
         self.metadata = qiime2.Metadata(metadata)
 
+    def test_core_metrics_convergence(self):
+        output = self.core_metrics(table=self.table1,
+                                   sampling_depth=2,
+                                   metadata=self.metadata,
+                                   replacement=True,
+                                   n=100,
+                                   random_seed=0,
+                                   convergence_tolerance=1e9,
+                                   convergence_batch_size=4)
+        # with a tolerance this large, the averages always converge at the
+        # first check, after two batches
+        self.assertEqual(list(output[0].keys()),
+                         [f'resampled-table-{i}' for i in range(8)])
+
+        expected = self.core_metrics(table=self.table1,
+                                     sampling_depth=2,
+                                     metadata=self.metadata,
+                                     replacement=True,
+                                     n=8,
+                                     random_seed=0)
+        for key, table in expected[0].items():
+            pdt.assert_frame_equal(output[0][key].view(pd.DataFrame),
+                                   table.view(pd.DataFrame))
+
     def test_core_metrics_wo_replacement(self):
         output = self.core_metrics(table=self.table1,
                                    sampling_depth=2,
@@ -207,3 +231,66 @@ class CoreMetricsTests(TestPluginBase):
 
         # vizard scatter plot returned
         self.assertEqual(output[5].type, Visualization)
+
+    def test_core_metrics_matches_per_metric_pipelines(self):
+        table = qiime2.Artifact.import_data(
+            'FeatureTable[Frequency]',
+            pd.DataFrame(data=[[1, 1, 5], [0, 4, 9], [3, 3, 3]],
+                         columns=['F1', 'F2', 'F3'],
+                         index=['S1', 'S2', 'S3']),
+            view_type=pd.DataFrame)
+        phylogeny = qiime2.Artifact.import_data(
+            'Phylogeny[Rooted]',
+            skbio.TreeNode.read(['((F1:1.0,F2:1.0):2.0,F3:0.5);']))
+        alpha_collection = self.plugin.pipelines['alpha_collection']
+        alpha_average = self.plugin.methods['alpha_average']
+        beta_collection = self.plugin.pipelines['beta_collection']
+        beta_average = self.plugin.methods['beta_average']
+
+        for replacement in (True, False):
+            output = self.core_metrics(table=table,
+                                       phylogeny=phylogeny,
+                                       sampling_depth=5,
+                                       metadata=self.metadata,
+                                       replacement=replacement,
+                                       n=10,
+                                       random_seed=0,
+                                       alpha_average_method='mean',
+                                       beta_average_method='non-metric-mean')
+
+            for alpha_metric, observed in output[1].items():
+                vectors, = alpha_collection(
+                    table=table, phylogeny=phylogeny, sampling_depth=5,
+                    metric=alpha_metric, n=10, replacement=replacement,
+                    random_seed=0)
+                expected, = alpha_average(data=vectors, average_method='mean')
+                pdt.assert_series_equal(observed.view(pd.Series),
+                                        expected.view(pd.Series))
+
+            for beta_metric, observed in output[2].items():
+                dms, = beta_collection(
+                    table=table, phylogeny=phylogeny, sampling_depth=5,
+                    metric=beta_metric, n=10, replacement=replacement,
+                    random_seed=0)
+                expected, = beta_average(data=dms,
+                                         average_method='non-metric-mean')
+                observed = observed.view(skbio.DistanceMatrix)
+                expected = expected.view(skbio.DistanceMatrix)
+                self.assertEqual(observed.ids, expected.ids)
+                npt.assert_allclose(observed.data, expected.data)
+
+    def test_core_metrics_relative_frequency(self):
+        table = qiime2.Artifact.import_data(
+            'FeatureTable[RelativeFrequency]',
+            pd.DataFrame(data=[[0.5, 0.5], [0., 1.]],
+                         columns=['F1', 'F2'],
+                         index=['S1', 'S2']),
+            view_type=pd.DataFrame)
+
+        for replacement in (True, False):
+            with self.assertRaisesRegex(TypeError, 'RelativeFrequency'):
+                self.core_metrics(table=table,
+                                  sampling_depth=1,
+                                  metadata=self.metadata,
+                                  replacement=replacement,
+                                  n=10)
@@ -6,6 +6,14 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+from collections import Counter
+import os
+import tempfile
+from unittest import TestCase, mock
+
+import biom
+import numpy as np
+import numpy.testing as npt
 import qiime2
 from qiime2.plugin.testing import TestPluginBase
 from qiime2.plugin import Visualization
@@ -13,6 +21,9 @@ import pandas as pd
 import pandas.testing as pdt
 import skbio
 
+from q2_boots._kmer_diversity import (_KmerProfiles, _get_kmer_profiles,
+                                      _fnv1a)
+
 
 class KmerDiversityTests(TestPluginBase):
 
@@ -87,3 +98,135 @@ class KmerDiversityTests(TestPluginBase):
                                expected_jaccard.to_data_frame())
 
         self.assertEqual(output[5].type, Visualization)
+
+    def test_kmer_table_matches_kmerizer(self):
+        # with default parameters, kmer tables are computed natively, and
+        # must match those of q2-kmerizer (including the case of kmer ids)
+        seqs_to_kmers = qiime2.sdk.PluginManager().plugins[
+            'kmerizer'].actions['seqs_to_kmers']
+        table = qiime2.Artifact.import_data(
+            "FeatureTable[Frequency]",
+            pd.DataFrame(data=[[1, 3], [2, 4]],
+                         columns=['F1', 'F2'],
+                         index=['S1', 'S2']),
+            view_type=pd.DataFrame)
+
+        expected, = seqs_to_kmers(sequences=self.sequences1, table=table)
+        expected = expected.view(pd.DataFrame)
+        profiles = _KmerProfiles.from_sequences(
+            self.sequences1.view(pd.Series), kmer_size=16)
+        observed = profiles.kmer_table(
+            table.view(biom.Table)).to_dataframe(dense=True).T
+
+        self.assertEqual(sorted(observed.columns), sorted(expected.columns))
+        pdt.assert_frame_equal(observed.loc[expected.index, expected.columns],
+                               expected, check_names=False,
+                               check_dtype=False)
+
+    def test_kmer_diversity_kmer_buckets(self):
+        output = self.kmer_diversity(table=self.table1,
+                                     sequences=self.sequences1,
+                                     sampling_depth=2,
+                                     metadata=self.metadata,
+                                     replacement=False,
+                                     n=2,
+                                     kmer_buckets=8)
+        for e in output[1].values():
+            self.assertLessEqual(e.view(pd.DataFrame).shape[1], 8)
+
+        with self.assertRaisesRegex(ValueError, 'kmer_buckets'):
+            self.kmer_diversity(table=self.table1,
+                                sequences=self.sequences1,
+                                sampling_depth=2,
+                                metadata=self.metadata,
+                                replacement=False,
+                                n=2,
+                                tfidf=True,
+                                kmer_buckets=8)
+
+
+class KmerProfilesTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.sequences = pd.Series(
+            [skbio.DNA('ACGTACGTAC'), skbio.DNA('AAAA'), skbio.DNA('AC'),
+             skbio.DNA('GTACNNAC')],
+            index=['F1', 'F2', 'F3', 'F4'])
+
+    def test_from_sequences(self):
+        profiles = _KmerProfiles.from_sequences(self.sequences, 3)
+        observed = pd.DataFrame(profiles.matrix.toarray(),
+                                index=profiles.feature_ids,
+                                columns=profiles.kmer_ids)
+
+        for feature_id, sequence in self.sequences.items():
+            sequence = str(sequence)
+            expected = Counter(sequence[i:i + 3]
+                               for i in range(len(sequence) - 2))
+            observed_counts = observed.loc[feature_id]
+            self.assertEqual(
+                dict(observed_counts[observed_counts > 0]), expected)
+
+    def test_from_sequences_hashed(self):
+        profiles = _KmerProfiles.from_sequences(self.sequences, 3)
+        hashed_profiles = _KmerProfiles.from_sequences(self.sequences, 3,
+                                                       buckets=4)
+
+        self.assertEqual(hashed_profiles.matrix.shape, (4, 4))
+        self.assertEqual(list(hashed_profiles.kmer_ids),
+                         ['kmer-bucket-0', 'kmer-bucket-1', 'kmer-bucket-2',
+                          'kmer-bucket-3'])
+        # each bucket holds the counts of the kmers hashed to it
+        kmers = np.array([list(kmer.encode('ascii'))
+                          for kmer in profiles.kmer_ids], dtype=np.uint8)
+        buckets = _fnv1a(kmers) % np.uint64(4)
+        for bucket in range(4):
+            npt.assert_array_equal(
+                hashed_profiles.matrix[:, bucket].toarray().ravel(),
+                profiles.matrix[:, buckets == bucket].sum(axis=1).A1)
+
+    def test_fnv1a(self):
+        data = np.frombuffer(b'afoobar', dtype=np.uint8)
+        npt.assert_array_equal(
+            _fnv1a(np.stack([data[:1], data[1:2]])),
+            np.array([0xaf63dc4c8601ec8c, 0xaf63db4c8601ead9],
+                     dtype=np.uint64))
+        self.assertEqual(_fnv1a(data[np.newaxis, 1:])[0],
+                         np.uint64(0x85944171f73967e8))
+
+    def test_missing_sequence(self):
+        sequences = self.sequences.reindex(['F1', 'F5'])
+        with self.assertRaisesRegex(ValueError, 'F5'):
+            _KmerProfiles.from_sequences(sequences, 3)
+
+    def test_kmer_table(self):
+        profiles = _KmerProfiles.from_sequences(self.sequences, 3)
+        table = biom.Table(np.array([[2, 0], [0, 1], [5, 0]]),
+                           ['F2', 'F4', 'F3'], ['S1', 'S2'])
+
+        observed = profiles.kmer_table(table).to_dataframe(dense=True)
+        expected = pd.DataFrame(
+            [[4., 0.], [0., 1.], [0., 1.], [0., 1.], [0., 1.], [0., 1.],
+             [0., 1.]],
+            index=['AAA', 'ACN', 'CNN', 'GTA', 'NAC', 'NNA', 'TAC'],
+            columns=['S1', 'S2'])
+        pdt.assert_frame_equal(observed.sort_index(), expected,
+                               check_names=False)
+
+    def test_cached_kmer_profiles(self):
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                mock.patch.dict(os.environ,
+                                {'Q2_BOOTS_CACHE_DIR': cache_dir}):
+            expected = _get_kmer_profiles(self.sequences, 3)
+            with mock.patch.object(_KmerProfiles, 'from_sequences') as m:
+                observed = _get_kmer_profiles(self.sequences, 3)
+                m.assert_not_called()
+                # a different kmer size is a different cache entry
+                _get_kmer_profiles(self.sequences, 4)
+                m.assert_called_once()
+
+        self.assertEqual(list(observed.feature_ids),
+                         list(expected.feature_ids))
+        self.assertEqual(list(observed.kmer_ids), list(expected.kmer_ids))
+        self.assertEqual((observed.matrix != expected.matrix).nnz, 0)
@@ -0,0 +1,222 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2024, Caporaso Lab (https://cap-lab.bio).
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from unittest import TestCase
+
+import numpy as np
+import numpy.testing as npt
+import scipy.sparse
+import scipy.spatial.distance
+import skbio
+
+from q2_boots._metrics import (alpha_diversities, beta_diversities,
+                               PhylogenyIndex, _braycurtis)
+
+
+class AlphaDiversitiesTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        # a stack of three tables with the same non-zero structure, where
+        # some of the counts in the later tables have been zeroed out
+        rng = np.random.default_rng(0)
+        matrix = scipy.sparse.random(20, 6, density=0.4, format='csc',
+                                     random_state=0)
+        matrix.data = rng.integers(1, 50, size=matrix.nnz)
+        matrix[0, :] = 1
+        self.indices = matrix.indices
+        self.indptr = matrix.indptr
+        counts = np.tile(matrix.data, (3, 1))
+        counts[1:][rng.random(counts[1:].shape) < 0.3] = 0
+        # leave a single feature in one sample of the last table
+        counts[2, self.indptr[3]:self.indptr[4]] = 0
+        counts[2, self.indptr[3]] = 7
+        self.counts = counts
+
+    def _dense(self, i):
+        return scipy.sparse.csc_matrix(
+            (self.counts[i], self.indices, self.indptr)).toarray().T
+
+    def test_matches_skbio(self):
+        observed = alpha_diversities(
+            self.counts, self.indptr,
+            ['observed_features', 'shannon', 'pielou_e'])
+
+        for i in range(len(self.counts)):
+            dense = self._dense(i)
+            npt.assert_array_equal(
+                observed['observed_features'][i],
+                [skbio.diversity.alpha.observed_features(s) for s in dense])
+            npt.assert_allclose(
+                observed['shannon'][i],
+                [skbio.diversity.alpha.shannon(s) for s in dense])
+            npt.assert_allclose(
+                observed['pielou_e'][i],
+                [skbio.diversity.alpha.pielou_e(s) for s in dense])
+
+    def test_single_feature(self):
+        observed = alpha_diversities(self.counts, self.indptr,
+                                     ['shannon', 'pielou_e'])
+
+        self.assertEqual(observed['shannon'][2, 3], 0.0)
+        self.assertFalse(np.signbit(observed['shannon'][2, 3]))
+        npt.assert_equal(observed['pielou_e'][2, 3],
+                         skbio.diversity.alpha.pielou_e(np.array([7])))
+
+    def test_float32(self):
+        metrics = ['observed_features', 'shannon', 'pielou_e']
+        expected = alpha_diversities(self.counts, self.indptr, metrics)
+        observed = alpha_diversities(self.counts, self.indptr, metrics,
+                                     dtype=np.float32)
+        npt.assert_array_equal(observed['observed_features'],
+                               expected['observed_features'])
+        for metric in ('shannon', 'pielou_e'):
+            self.assertEqual(observed[metric].dtype, np.float32)
+            npt.assert_allclose(observed[metric], expected[metric],
+                                rtol=1e-5)
+
+    def test_only_requested_metrics(self):
+        observed = alpha_diversities(self.counts, self.indptr, ['shannon'])
+        self.assertEqual(list(observed), ['shannon'])
+        self.assertEqual(observed['shannon'].shape, (3, 6))
+
+
+class PhylogenyIndexTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tree = skbio.TreeNode.read(
+            ['(((F1:1.0,F2:2.0):0.5,(F3:0.25,(F4:1.0,F5:3.0):1.5):2.0):1.0,'
+             '(F6:4.0,(F7:0.5,F8:1.0):0.75):0.1)root:9.0;'])
+        self.feature_ids = np.array(['F8', 'F1', 'F3', 'F5', 'F2', 'F7',
+                                     'F4'])
+        rng = np.random.default_rng(0)
+        self.dense = rng.integers(0, 3, size=(4, 5, 7))
+        self.dense[:, :, 0] = 1
+        self.dense[0, 0] = [0, 0, 0, 0, 1, 0, 0]
+        matrix = scipy.sparse.csc_matrix(np.ones((7, 5)))
+        self.indices = matrix.indices
+        self.indptr = matrix.indptr
+        self.counts = self.dense.reshape(4, -1)
+
+    def test_faith_pd_matches_skbio(self):
+        index = PhylogenyIndex(self.tree)
+        observed = index.faith_pd(self.counts, self.indices, self.indptr,
+                                  self.feature_ids)
+
+        self.assertEqual(observed.shape, (4, 5))
+        for i, table in enumerate(self.dense):
+            for j, sample in enumerate(table):
+                expected = skbio.diversity.alpha.faith_pd(
+                    sample, taxa=self.feature_ids, tree=self.tree)
+                # scikit-bio includes the length of the root branch
+                self.assertAlmostEqual(observed[i, j], expected - 9.0)
+
+    def test_single_feature(self):
+        index = PhylogenyIndex(self.tree)
+        observed = index.faith_pd(self.counts, self.indices, self.indptr,
+                                  self.feature_ids)
+        # F2 only
+        self.assertAlmostEqual(observed[0, 0], 2.0 + 0.5 + 1.0)
+
+    def test_missing_feature(self):
+        index = PhylogenyIndex(self.tree)
+        feature_ids = self.feature_ids.copy()
+        feature_ids[3] = 'F9'
+        with self.assertRaisesRegex(ValueError, 'represented by the phylo'):
+            index.faith_pd(self.counts, self.indices, self.indptr,
+                           feature_ids)
+
+
+class BetaDiversitiesTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        # the root has no branch length, since scikit-bio would include it
+        self.tree = skbio.TreeNode.read(
+            ['(((F1:1.0,F2:2.0):0.5,(F3:0.25,(F4:1.0,F5:3.0):1.5):2.0):1.0,'
+             '(F6:4.0,(F7:0.5,F8:1.0):0.75):0.1)root;'])
+        self.feature_ids = np.array(['F8', 'F1', 'F3', 'F5', 'F2', 'F7',
+                                     'F4', 'F9'])
+        rng = np.random.default_rng(0)
+        # F9 is not in the tree, but it is never observed
+        self.dense = rng.integers(0, 3, size=(3, 6, 8))
+        self.dense[:, :, 7] = 0
+        self.dense[:, :, 0] += 1
+        self.dense[1, 2] = self.dense[1, 3]
+        # the non-zero structure shared by all tables
+        structure = (self.dense > 0).any(axis=0)
+        matrix = scipy.sparse.csc_matrix(structure.T)
+        self.indices = matrix.indices
+        self.indptr = matrix.indptr
+        self.counts = np.stack([d[structure] for d in self.dense])
+
+    def test_unifrac_matches_skbio(self):
+        observed = beta_diversities(
+            self.counts, self.indices, self.indptr, self.feature_ids,
+            ['unweighted_unifrac', 'weighted_unifrac'],
+            PhylogenyIndex(self.tree))
+
+        for metric in ('unweighted_unifrac', 'weighted_unifrac'):
+            self.assertEqual(observed[metric].shape, (3, 15))
+            for i, table in enumerate(self.dense):
+                expected = skbio.diversity.beta_diversity(
+                    metric, table, taxa=self.feature_ids, tree=self.tree,
+                    validate=False)
+                npt.assert_allclose(observed[metric][i],
+                                    expected.condensed_form(), atol=1e-12)
+
+    def test_nonphylogenetic_matches_scipy(self):
+        observed = beta_diversities(
+            self.counts, self.indices, self.indptr, self.feature_ids,
+            ['braycurtis', 'jaccard'])
+
+        for i, table in enumerate(self.dense):
+            npt.assert_allclose(
+                observed['braycurtis'][i],
+                scipy.spatial.distance.pdist(table, 'braycurtis'))
+            # jaccard is computed on presence/absence
+            npt.assert_allclose(
+                observed['jaccard'][i],
+                scipy.spatial.distance.pdist(table > 0, 'jaccard'))
+
+    def test_sparse_braycurtis_matches_scipy(self):
+        rng = np.random.default_rng(0)
+        dense = (rng.integers(1, 5, size=(20, 50)) *
+                 (rng.random((20, 50)) < 0.1))
+        # a sample with no features in common with any other sample, and two
+        # samples with no features at all
+        dense[:, 0] = 0
+        dense[5] = 0
+        dense[5, 0] = 2
+        dense[[3, 8]] = 0
+        table = scipy.sparse.csr_matrix(dense.astype(float))
+        table.eliminate_zeros()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            expected = scipy.spatial.distance.pdist(dense, 'braycurtis')
+        npt.assert_allclose(_braycurtis(table), expected)
+
+    def test_float32(self):
+        metrics = ['braycurtis', 'jaccard', 'unweighted_unifrac',
+                   'weighted_unifrac']
+        expected = beta_diversities(
+            self.counts, self.indices, self.indptr, self.feature_ids,
+            metrics, PhylogenyIndex(self.tree))
+        observed = beta_diversities(
+            self.counts, self.indices, self.indptr, self.feature_ids,
+            metrics, PhylogenyIndex(self.tree), dtype=np.float32)
+        for metric in metrics:
+            self.assertEqual(observed[metric].dtype, np.float32)
+            npt.assert_allclose(observed[metric], expected[metric],
+                                rtol=1e-5)
+
+    def test_single_metric(self):
+        observed = beta_diversities(
+            self.counts, self.indices, self.indptr, self.feature_ids,
+            ['weighted_unifrac'], PhylogenyIndex(self.tree))
+        self.assertEqual(list(observed), ['weighted_unifrac'])
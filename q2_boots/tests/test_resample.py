@@ -6,11 +6,25 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+from concurrent.futures import ThreadPoolExecutor
+import os
+import pathlib
+import tempfile
+from unittest import TestCase, mock
+
+import biom
+import numpy as np
+import numpy.testing as npt
 import pandas as pd
+import pandas.testing as pdt
 
 import qiime2
 from qiime2.plugin.testing import TestPluginBase
 
+from q2_boots._resample import (_subsample_counts, _draw_subsamples,
+                                _resampled_stacks, _ResampledStack,
+                                StackedTables)
+
 
 class ResampleTests(TestPluginBase):
     package = 'q2_boots.tests'
@@ -68,6 +82,85 @@ class ResampleTests(TestPluginBase):
                                              replacement=True)
         self.assertEqual(len(obs_tables), 2)
 
+    def test_expected_n_tables_parallel(self):
+        obs_tables, = self.resample_pipeline(table=self.table_artifact2,
+                                             sampling_depth=2,
+                                             n=9,
+                                             replacement=False,
+                                             n_jobs=2)
+        self.assertEqual(list(obs_tables.keys()),
+                         [f'resampled-table-{i}' for i in range(9)])
+
+    def test_random_seed(self):
+        tables1, = self.resample_pipeline(table=self.table_artifact2,
+                                          sampling_depth=20,
+                                          n=6,
+                                          replacement=True,
+                                          random_seed=42)
+        tables2, = self.resample_pipeline(table=self.table_artifact2,
+                                          sampling_depth=20,
+                                          n=6,
+                                          replacement=True,
+                                          random_seed=42,
+                                          n_jobs=3)
+        self.assertEqual(tables1.keys(), tables2.keys())
+        for key in tables1:
+            pdt.assert_frame_equal(tables1[key].view(pd.DataFrame),
+                                   tables2[key].view(pd.DataFrame))
+
+    def test_extend_existing_tables(self):
+        expected, = self.resample_pipeline(table=self.table_artifact2,
+                                           sampling_depth=20,
+                                           n=6,
+                                           replacement=False,
+                                           random_seed=42)
+        existing, = self.resample_pipeline(table=self.table_artifact2,
+                                           sampling_depth=20,
+                                           n=2,
+                                           replacement=False,
+                                           random_seed=42)
+        observed, = self.resample_pipeline(table=self.table_artifact2,
+                                           sampling_depth=20,
+                                           n=6,
+                                           replacement=False,
+                                           random_seed=42,
+                                           existing_tables=existing)
+        self.assertEqual(list(observed.keys()), list(expected.keys()))
+        for key in expected:
+            pdt.assert_frame_equal(observed[key].view(pd.DataFrame),
+                                   expected[key].view(pd.DataFrame))
+
+    def test_extend_existing_tables_too_many(self):
+        existing, = self.resample_pipeline(table=self.table_artifact2,
+                                           sampling_depth=20,
+                                           n=3,
+                                           replacement=False)
+        with self.assertRaisesRegex(ValueError, 'already contains 3'):
+            self.resample_pipeline(table=self.table_artifact2,
+                                   sampling_depth=20,
+                                   n=2,
+                                   replacement=False,
+                                   existing_tables=existing)
+
+    def test_resample_stacked(self):
+        resample_stacked = self.plugin.methods['resample_stacked']
+        stacked, = resample_stacked(table=self.table_artifact2,
+                                    sampling_depth=20,
+                                    n=5,
+                                    replacement=False,
+                                    random_seed=42)
+        self.assertEqual(str(stacked.type), 'ResampledTables')
+        expected, = self.resample_pipeline(table=self.table_artifact2,
+                                           sampling_depth=20,
+                                           n=5,
+                                           replacement=False,
+                                           random_seed=42)
+
+        stack, = stacked.view(StackedTables).stacks
+        self.assertEqual(len(stack), 5)
+        for i, table in enumerate(expected.values()):
+            self.assertEqual(stack.table(i), table.view(biom.Table))
+
     def test_w_replacement(self):
         obs_tables, = self.resample_pipeline(table=self.table_artifact3,
                                              sampling_depth=2,
@@ -164,3 +257,322 @@ class ResampleTests(TestPluginBase):
             obs_table = obs_table.view(pd.DataFrame)
             sids = list(obs_table.index)
             self.assertEqual(sids, ['S1', 'S2', 'S3'])
+
+
+class SubsampleCountsTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        # two samples: the first with three features, the second with one
+        self.counts = np.array([30, 20, 9, 42])
+        self.indptr = np.array([0, 3, 4])
+
+    def test_shape_and_depth(self):
+        for replacement in (True, False):
+            obs = _subsample_counts(self.counts, self.indptr, 25,
+                                    replacement, _seeds(7))
+            self.assertEqual(obs.shape, (7, 4))
+            npt.assert_array_equal(obs[:, :3].sum(axis=1), [25] * 7)
+            npt.assert_array_equal(obs[:, 3], [25] * 7)
+
+    def test_compact_dtype(self):
+        # counts can't exceed the sampling depth, so they are stored as the
+        # smallest unsigned integer type that can hold it
+        for sampling_depth, dtype in [(25, np.uint8), (256, np.uint16),
+                                      (70000, np.uint32)]:
+            obs = _subsample_counts(self.counts * 10000, self.indptr,
+                                    sampling_depth, True, _seeds(2))
+            self.assertEqual(obs.dtype, dtype)
+            npt.assert_array_equal(obs[:, 3], [sampling_depth] * 2)
+
+    def test_wo_replacement_never_exceeds_counts(self):
+        counts = np.array([1, 1, 5, 3])
+        indptr = np.array([0, 4])
+        obs = _subsample_counts(counts, indptr, 9, False, _seeds(100))
+        self.assertTrue((obs <= counts).all())
+
+        # drawing every observation without replacement always returns
+        # the input counts
+        obs = _subsample_counts(counts, indptr, 10, False, _seeds(10))
+        npt.assert_array_equal(obs, np.tile(counts, (10, 1)))
+
+    def test_w_replacement_can_exceed_counts(self):
+        counts = np.array([1, 1])
+        indptr = np.array([0, 2])
+        obs = _subsample_counts(counts, indptr, 2, True, _seeds(100))
+        self.assertTrue((obs == 2).any())
+
+    def test_iterations_independent_of_grouping(self):
+        seeds = _seeds(10)
+        for replacement in (True, False):
+            expected = _subsample_counts(self.counts, self.indptr, 25,
+                                         replacement, seeds)
+            for i, seed in enumerate(seeds):
+                obs = _subsample_counts(self.counts, self.indptr, 25,
+                                        replacement, [seed])
+                npt.assert_array_equal(obs[0], expected[i])
+
+    def test_parallel_matches_serial(self):
+        seeds = _seeds(10)
+        for replacement in (True, False):
+            expected = list(_draw_subsamples(
+                self.counts, self.indptr, 25, replacement, seeds, n_jobs=1))
+            observed = list(_draw_subsamples(
+                self.counts, self.indptr, 25, replacement, seeds, n_jobs=2))
+            npt.assert_array_equal(observed, expected)
+
+    def test_parallel_submits_bounded_window(self):
+        seeds = _seeds(200)
+        submitted = []
+
+        # threads share the submitted list, and the worker state
+        class Executor(ThreadPoolExecutor):
+            def submit(self, fn, *args):
+                submitted.append(args[0])
+                return super().submit(fn, *args)
+
+        expected = list(_draw_subsamples(
+            self.counts, self.indptr, 25, True, seeds, n_jobs=1))
+        with mock.patch('q2_boots._resample.ProcessPoolExecutor', Executor):
+            draws = _draw_subsamples(self.counts, self.indptr, 25, True,
+                                     seeds, n_jobs=2)
+            observed = [next(draws)]
+            # 2 * n_jobs chunks, plus the one replacing the chunk consumed
+            self.assertEqual(len(submitted), 5)
+            observed.extend(draws)
+
+        self.assertEqual(sum(len(chunk) for chunk in submitted), 200)
+        npt.assert_array_equal(observed, expected)
+
+
+class ResampledStacksTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.table = biom.Table(np.array([[0, 1, 4], [1, 1, 0], [3, 2, 9]]),
+                                ['F1', 'F2', 'F3'], ['S1', 'S2', 'S3'])
+
+    def test_stack_size_does_not_change_tables(self):
+        seeds = _seeds(5)
+        expected, = _resampled_stacks(self.table, 3, False, seeds)
+        self.assertEqual(len(expected), 5)
+        observed = list(_resampled_stacks(self.table, 3, False, seeds,
+                                          max_stack_bytes=1))
+        self.assertEqual([len(stack) for stack in observed], [1] * 5)
+        for i, stack in enumerate(observed):
+            self.assertEqual(stack.table(0), expected.table(i))
+
+    def test_stack_size_uses_compute_dtype(self):
+        # 7 non-zero counts, stored as uint8 but computed on as float64
+        # (8 bytes each) or float32 (4 bytes each)
+        stacks = list(_resampled_stacks(self.table, 3, False, _seeds(10),
+                                        max_stack_bytes=7 * 8 * 2))
+        self.assertEqual(stacks[0].data.dtype, np.uint8)
+        self.assertEqual([len(stack) for stack in stacks], [2] * 5)
+
+        stacks = list(_resampled_stacks(self.table, 3, False, _seeds(10),
+                                        max_stack_bytes=7 * 8 * 2,
+                                        dtype=np.float32))
+        self.assertEqual([len(stack) for stack in stacks], [4, 4, 2])
+
+    def test_tables(self):
+        stack, = _resampled_stacks(self.table, 5, False, _seeds(3))
+        npt.assert_array_equal(stack.sample_ids, ['S3'])
+        for i in range(len(stack)):
+            table = stack.table(i)
+            npt.assert_array_equal(table.sum(axis='sample'), [5])
+            # features that were not drawn are removed
+            self.assertTrue((table.sum(axis='observation') > 0).all())
+
+    def test_compact_dtypes(self):
+        stack, = _resampled_stacks(self.table, 3, False, _seeds(3))
+        self.assertEqual(stack.data.dtype, np.uint8)
+        self.assertEqual(stack.indices.dtype, np.int32)
+        self.assertEqual(stack.indptr.dtype, np.int32)
+        # resampled tables are float64, as biom.Table frequencies are
+        self.assertEqual(stack.table(0).matrix_data.dtype, np.float64)
+
+    def test_relative_frequencies(self):
+        table = self.table.norm(axis='sample', inplace=False)
+        for replacement in (True, False):
+            with self.assertRaisesRegex(ValueError, 'non-negative integer'):
+                list(_resampled_stacks(table, 1, replacement, _seeds(3)))
+
+    def test_negative_counts(self):
+        table = biom.Table(np.array([[0, 1, 4], [1, -1, 0], [3, 2, 9]]),
+                           ['F1', 'F2', 'F3'], ['S1', 'S2', 'S3'])
+        for replacement in (True, False):
+            with self.assertRaisesRegex(ValueError, 'non-negative integer'):
+                list(_resampled_stacks(table, 1, replacement, _seeds(3)))
+
+    def test_from_table(self):
+        stack = _ResampledStack.from_table(self.table)
+        self.assertEqual(len(stack), 1)
+        self.assertEqual(stack.table(0), self.table)
+
+
+class StackedTablesTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.table = biom.Table(np.array([[0, 1, 4], [1, 1, 0], [3, 2, 9]]),
+                                ['F1', 'F2', 'F3'], ['S1', 'S2', 'S3'])
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self._temp_dir.name) / 'tables.h5'
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+        super().tearDown()
+
+    def _save(self, random_seed=42):
+        seeds = np.random.SeedSequence(random_seed).spawn(7)
+        expected, = _resampled_stacks(self.table, 3, False, seeds)
+        stacks = _resampled_stacks(self.table, 3, False, seeds,
+                                   max_stack_bytes=1)
+        StackedTables(stacks, 3, False, random_seed).save(self.path)
+        return expected
+
+    def test_round_trip(self):
+        expected = self._save()
+
+        stacked_tables = StackedTables.load(self.path)
+        self.assertEqual(stacked_tables.sampling_depth, 3)
+        self.assertFalse(stacked_tables.replacement)
+        self.assertEqual(stacked_tables.random_seed, 42)
+        self.assertEqual(len(stacked_tables.stacks), 7)
+        observed, = stacked_tables.stacks
+        self.assertEqual(observed.data.dtype, np.uint8)
+        npt.assert_array_equal(observed.data, expected.data)
+        for i in range(7):
+            self.assertEqual(observed.table(i), expected.table(i))
+
+    def test_unseeded(self):
+        self._save(random_seed=None)
+        self.assertIsNone(StackedTables.load(self.path).random_seed)
+
+    def test_select(self):
+        expected = self._save()
+        stacks = StackedTables.load(self.path).stacks.select(2, 6)
+        stacks.max_stack_bytes = 1
+        self.assertEqual(len(stacks), 4)
+        observed = list(stacks)
+        self.assertEqual([len(stack) for stack in observed], [1] * 4)
+        for i, stack in enumerate(observed, start=2):
+            npt.assert_array_equal(stack.data[0], expected.data[i])
+
+    def test_select_stack_size(self):
+        self._save()
+        for dtype, expected in ((np.float64, [2, 2, 2, 1]),
+                                (np.float32, [4, 3])):
+            stacks = StackedTables.load(self.path).stacks.select(0, 7, dtype)
+            # 7 non-zero counts per table, stored as uint8
+            stacks.max_stack_bytes = 7 * 8 * 2
+            self.assertEqual([len(stack) for stack in stacks], expected)
+
+    def test_validate(self):
+        self._save()
+        stacked_tables = StackedTables.load(self.path)
+        stacked_tables.validate(3, 7, False, 42)
+        stacked_tables.validate(3, 2, False)
+        with self.assertRaisesRegex(ValueError, 'sampling depth of 3'):
+            stacked_tables.validate(4, 7, False, 42)
+        with self.assertRaisesRegex(ValueError, 'replacement=False'):
+            stacked_tables.validate(3, 7, True, 42)
+        with self.assertRaisesRegex(ValueError, 'random seed 42'):
+            stacked_tables.validate(3, 7, False, 43)
+        with self.assertRaisesRegex(ValueError, 'only 7 are stored'):
+            stacked_tables.validate(3, 8, False, 42)
+
+
+class CachedResampledStacksTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.table = biom.Table(np.array([[0, 1, 4], [1, 1, 0], [3, 2, 9]]),
+                                ['F1', 'F2', 'F3'], ['S1', 'S2', 'S3'])
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = pathlib.Path(self._temp_dir.name)
+        self._environ = mock.patch.dict(
+            os.environ, {'Q2_BOOTS_CACHE_DIR': self._temp_dir.name})
+        self._environ.start()
+
+    def tearDown(self):
+        self._environ.stop()
+        self._temp_dir.cleanup()
+        super().tearDown()
+
+    def _data(self, seeds, cache=True, sampling_depth=3):
+        stack, = _resampled_stacks(self.table, sampling_depth, False, seeds,
+                                   cache=cache)
+        return stack.data
+
+    def _entries(self):
+        return list(
+            (self.cache_dir / 'q2-boots' / 'resampled-counts').iterdir())
+
+    def test_cache_matches_draws(self):
+        seeds = np.random.SeedSequence(42).spawn(5)
+        expected = self._data(seeds, cache=False)
+        self.assertFalse(self.cache_dir.exists() and
+                         any(self.cache_dir.iterdir()))
+
+        npt.assert_array_equal(self._data(seeds), expected)
+        self.assertEqual(len(self._entries()), 1)
+        with mock.patch('q2_boots._resample._subsample_counts') as draw:
+            npt.assert_array_equal(self._data(seeds), expected)
+            draw.assert_not_called()
+
+    def test_cache_is_extended(self):
+        seeds = np.random.SeedSequence(42).spawn(8)
+        expected = self._data(seeds, cache=False)
+
+        npt.assert_array_equal(self._data(seeds[:3]), expected[:3])
+        npt.assert_array_equal(self._data(seeds[3:]), expected[3:])
+        entry, = self._entries()
+        npt.assert_array_equal(np.load(entry), expected)
+        with mock.patch('q2_boots._resample._subsample_counts') as draw:
+            npt.assert_array_equal(self._data(seeds[2:6]), expected[2:6])
+            draw.assert_not_called()
+
+    def test_cache_key(self):
+        seeds = np.random.SeedSequence(42).spawn(2)
+        self._data(seeds)
+        self._data(np.random.SeedSequence(43).spawn(2))
+        self._data(seeds, sampling_depth=4)
+        self.assertEqual(len(self._entries()), 3)
+
+    def test_cache_is_truncated_if_stopped_early(self):
+        seeds = np.random.SeedSequence(42).spawn(6)
+        expected = self._data(seeds, cache=False)
+
+        stacks = _resampled_stacks(self.table, 3, False, seeds,
+                                   max_stack_bytes=1, cache=True)
+        next(stacks)
+        next(stacks)
+        stacks.close()
+        entry, = self._entries()
+        npt.assert_array_equal(np.load(entry), expected[:2])
+
+        npt.assert_array_equal(self._data(seeds), expected)
+        npt.assert_array_equal(np.load(entry), expected)
+
+    def test_unreadable_entry(self):
+        seeds = np.random.SeedSequence(42).spawn(4)
+        expected = self._data(seeds, cache=False)
+        self._data(seeds)
+        entry, = self._entries()
+        entry.write_bytes(entry.read_bytes()[:-8])
+
+        npt.assert_array_equal(self._data(seeds), expected)
+        npt.assert_array_equal(np.load(entry), expected)
+
+    def test_unseeded(self):
+        # seeds that do not share a root are never cached
+        seeds = [np.random.SeedSequence(i) for i in range(3)]
+        self._data(seeds)
+        self.assertFalse(self.cache_dir.exists() and
+                         any(self.cache_dir.iterdir()))
+
+
+def _seeds(n):
+    return np.random.SeedSequence().spawn(n)